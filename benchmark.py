@@ -0,0 +1,457 @@
+"""Benchmark suite for WebClonerCore.
+
+Starts a local fixture HTTP server serving generated sites of a configurable
+shape, clones them with WebClonerCore.clone_website and stores the results as
+JSON so runs can be compared over time.
+
+Usage:
+    python benchmark.py                              # run the default scenarios
+    python benchmark.py --scenario asset_heavy --runs 3
+    python benchmark.py --pages 20 --assets 50 --asset-size 8192 --latency 0.01
+    python benchmark.py --scenario asset_heavy --http2   # h2c fixture, needs hypercorn and httpx[http2]
+    python benchmark.py --scenario client_rendered --render   # headless render mode, needs playwright
+    python benchmark.py --compare bench_results/old.json bench_results/new.json
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty
+from threading import Thread, Lock, Event
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import cloner
+from cloner import WebClonerCore
+
+
+class SiteShape:
+    """Shape of a generated fixture site"""
+
+    def __init__(self, pages=5, assets_per_page=10, asset_size=4096,
+                 latency=0.0, error_rate=0.0, shared_ratio=0.5, client_rendered=False):
+        self.pages = pages
+        self.assets_per_page = assets_per_page
+        self.asset_size = asset_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.shared_ratio = shared_ratio
+        self.client_rendered = client_rendered
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+SCENARIOS = {
+    'small': SiteShape(pages=5, assets_per_page=10, asset_size=4096),
+    'asset_heavy': SiteShape(pages=3, assets_per_page=100, asset_size=2048),
+    'large_assets': SiteShape(pages=2, assets_per_page=8, asset_size=1024 * 1024),
+    'slow_origin': SiteShape(pages=5, assets_per_page=10, asset_size=4096, latency=0.05),
+    'flaky': SiteShape(pages=5, assets_per_page=10, asset_size=4096, error_rate=0.05),
+    'client_rendered': SiteShape(pages=3, assets_per_page=10, asset_size=4096, client_rendered=True),
+}
+
+
+class FixtureSite:
+    """Generates deterministic pages and assets for a SiteShape"""
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.shared_assets = int(shape.assets_per_page * shape.shared_ratio)
+
+    def page_path(self, page):
+        return '/' if page == 0 else f'/page/{page}.html'
+
+    def image_paths(self, page):
+        paths = []
+        for i in range(self.shape.assets_per_page):
+            if i < self.shared_assets:
+                paths.append(f'/assets/shared_{i}.png')
+            else:
+                paths.append(f'/assets/img_{page}_{i}.png')
+        return paths
+
+    def render_page(self, page):
+        links = ''.join(f'<a href="{self.page_path(p)}">Page {p}</a>\n'
+                        for p in range(self.shape.pages) if p != page)
+        images = ''.join(f'<img src="{path}" alt="asset">\n' for path in self.image_paths(page))
+        body = links + images
+        if self.shape.client_rendered:
+            # Served empty, the way single-page apps are; only a browser sees the content
+            body = f'<div id="app"></div>\n<script>document.getElementById("app").innerHTML = {json.dumps(body)};</script>\n'
+        return (
+            '<!DOCTYPE html>\n<html><head>'
+            f'<title>Fixture page {page}</title>'
+            f'<link rel="stylesheet" href="/assets/style_{page}.css">'
+            f'<script src="/assets/script_{page}.js"></script>'
+            '</head><body>\n'
+            f'<h1>Fixture page {page}</h1>\n{body}'
+            '</body></html>\n'
+        ).encode('utf-8')
+
+    def render_css(self, page):
+        # The cloner saves stylesheets as they are, without following their url()s
+        return 'body { background: url("/assets/shared_bg.png"); }\n'.encode('utf-8')
+
+    def filler(self, path, size):
+        seed = hashlib.sha256(path.encode('utf-8')).digest()
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def should_fail(self, path):
+        if self.shape.error_rate <= 0:
+            return False
+        digest = hashlib.sha256(path.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.shape.error_rate
+
+    def resolve(self, path):
+        """Return (status, content_type, body) for a request path"""
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        if self.should_fail(path):
+            return 500, 'text/plain', b'injected error'
+        if path == '/':
+            return 200, 'text/html; charset=utf-8', self.render_page(0)
+        if path == '/robots.txt':
+            return 200, 'text/plain', b'User-agent: *\nAllow: /\n'
+
+        if path.startswith('/page/') and path.endswith('.html'):
+            try:
+                page = int(path[len('/page/'):-len('.html')])
+            except ValueError:
+                page = -1
+            if 0 < page < self.shape.pages:
+                return 200, 'text/html; charset=utf-8', self.render_page(page)
+        if path.startswith('/assets/style_'):
+            page = int(path[len('/assets/style_'):-len('.css')])
+            return 200, 'text/css', self.render_css(page)
+        if path.startswith('/assets/script_'):
+            return 200, 'application/javascript', b'console.log("fixture");\n'
+        if path.startswith('/assets/') and path.endswith('.png'):
+            return 200, 'image/png', self.filler(path, self.shape.asset_size)
+        return 404, 'text/plain', b'not found'
+
+
+class FixtureServer:
+    """Threaded local HTTP server for a FixtureSite, usable as a context manager"""
+
+    def __init__(self, site, host='127.0.0.1', port=0):
+        self.site = site
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if server.site.shape.latency:
+                    time.sleep(server.site.shape.latency)
+                status, content_type, body = server.site.resolve(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server._lock:
+                    server.requests += 1
+                    server.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def __enter__(self):
+        self._thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class H2FixtureServer(FixtureServer):
+    """Serves a FixtureSite over cleartext HTTP/2 (prior knowledge) with hypercorn"""
+
+    def __init__(self, site, host='127.0.0.1', port=0):
+        from hypercorn.config import Config
+
+        self.site = site
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = Lock()
+        if not port:
+            with socket.socket() as probe:
+                probe.bind((host, 0))
+                port = probe.getsockname()[1]
+        self.address = (host, port)
+        self.config = Config()
+        self.config.bind = [f'{host}:{port}']
+        self.config.accesslog = None
+        self.config.errorlog = None
+        self._loop = asyncio.new_event_loop()
+        self._stop = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.address[0]}:{self.address[1]}/'
+
+    async def app(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                await send({'type': message['type'] + '.complete'})
+                if message['type'] == 'lifespan.shutdown':
+                    return
+        if self.site.shape.latency:
+            await asyncio.sleep(self.site.shape.latency)
+        status, content_type, body = self.site.resolve(scope['path'])
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode()),
+                                (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += len(body)
+
+    def _serve(self, started):
+        from hypercorn.asyncio import serve
+
+        asyncio.set_event_loop(self._loop)
+        self._stop = asyncio.Event()
+        self._loop.call_soon(started.set)
+        self._loop.run_until_complete(serve(self.app, self.config, shutdown_trigger=self._stop.wait))
+
+    def __enter__(self):
+        started = Event()
+        self._thread = Thread(target=self._serve, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+        # Wait for the listening socket
+        for _ in range(100):
+            try:
+                socket.create_connection(self.address, timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(timeout=10)
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return 0  # Not measured
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _clone_in_child(url, shape, output_dir, verbose, queue, http2=False, render=False):
+    session = None
+    if http2:
+        session = WebClonerCore.create_session()
+        session.mount('http://', cloner.HTTP2Adapter(cloner.shared_adapter, http1=False))
+    web_cloner = WebClonerCore(session=session, render=render)
+    web_cloner.max_pages = shape.pages
+    sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with sink:
+        start = time.perf_counter()
+        result = web_cloner.clone_website(url, output_dir, 'bench')
+        end = time.perf_counter()
+    queue.put({
+        'success': result['success'],
+        'error': result.get('error'),
+        'wall_time': end - start,
+        'stages': result['metrics']['stages'],
+        'counters': result['metrics']['counters'],
+        'bytes_by_type': result['metrics']['bytes_by_type'],
+        'peak_rss_bytes': peak_rss_bytes(),
+    })
+
+
+def _wait_for_run(process, queue, timeout):
+    """The child's result; raises if it dies or runs past timeout seconds without one"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            pass
+        if not process.is_alive():
+            try:
+                return queue.get(timeout=1)  # Sent just before it exited
+            except Empty:
+                raise RuntimeError(f"Clone process exited with code {process.exitcode} without a result")
+        if time.monotonic() > deadline:
+            process.terminate()
+            raise RuntimeError(f"Clone process gave no result within {timeout}s")
+
+
+def run_clone(server, shape, verbose=False, http2=False, render=False, timeout=600):
+    """Clone the fixture site once in a child process so peak RSS is per run"""
+    output_dir = tempfile.mkdtemp(prefix='webcloner_bench_')
+    ctx = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    queue = ctx.Queue()
+    server.reset_counters()
+    try:
+        process = ctx.Process(target=_clone_in_child,
+                              args=(server.url, shape, output_dir, verbose, queue, http2, render))
+        process.start()
+        run = _wait_for_run(process, queue, timeout)
+        process.join()
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    wall = run['wall_time'] or 1e-9
+    run.update({
+        'requests': server.requests,
+        'bytes': server.bytes_sent,
+        'requests_per_sec': server.requests / wall,
+        'bytes_per_sec': server.bytes_sent / wall,
+    })
+    return run
+
+
+def run_scenario(name, shape, runs=1, verbose=False, http2=False, render=False, timeout=600):
+    """Run a scenario several times and summarise it"""
+    site = FixtureSite(shape)
+    server_class = H2FixtureServer if http2 else FixtureServer
+    with server_class(site) as server:
+        results = [run_clone(server, shape, verbose, http2, render, timeout) for _ in range(runs)]
+
+    walls = sorted(r['wall_time'] for r in results)
+    return {
+        'name': name,
+        'http2': http2,
+        'render': render,
+        'shape': shape.to_dict(),
+        'runs': results,
+        'summary': {
+            'wall_time_min': walls[0],
+            'wall_time_median': walls[len(walls) // 2],
+            'requests_per_sec_max': max(r['requests_per_sec'] for r in results),
+            'bytes_per_sec_max': max(r['bytes_per_sec'] for r in results),
+            'peak_rss_bytes_max': max(r['peak_rss_bytes'] for r in results),
+            'failures': sum(1 for r in results if not r['success']),
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(old_path, new_path):
+    """Print the change in headline numbers between two result files"""
+    with open(old_path, encoding='utf-8') as f:
+        old = {s['name']: s['summary'] for s in json.load(f)['scenarios']}
+    with open(new_path, encoding='utf-8') as f:
+        new = {s['name']: s['summary'] for s in json.load(f)['scenarios']}
+
+    for name in sorted(set(old) & set(new)):
+        print(name)
+        for key in ('wall_time_median', 'requests_per_sec_max', 'bytes_per_sec_max', 'peak_rss_bytes_max'):
+            before, after = old[name][key], new[name][key]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {key:<22} {before:>14.3f} -> {after:>14.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WebClonerCore against a local fixture site')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('--pages', type=int, help='Run a custom scenario with this many pages')
+    parser.add_argument('--assets', type=int, default=10, help='Assets per page for a custom scenario')
+    parser.add_argument('--asset-size', type=int, default=4096, help='Asset size in bytes for a custom scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='Injected latency per request (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of paths answering 500')
+    parser.add_argument('--runs', type=int, default=1, help='Runs per scenario')
+    parser.add_argument('--output', help='Result file (default: bench_results/bench_<timestamp>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit')
+    parser.add_argument('--verbose', action='store_true', help='Show clone status output')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for each clone run')
+    parser.add_argument('--http2', action='store_true',
+                        help='Serve the fixture over h2c and clone through the HTTP/2 adapter')
+    parser.add_argument('--render', action='store_true',
+                        help='Clone in headless render mode (needs playwright and a browser)')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.pages is not None:
+        scenarios = {'custom': SiteShape(pages=args.pages, assets_per_page=args.assets,
+                                         asset_size=args.asset_size,
+                                         latency=args.latency, error_rate=args.error_rate)}
+    else:
+        names = args.scenario or sorted(SCENARIOS)
+        scenarios = {name: SCENARIOS[name] for name in names}
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenarios': [],
+    }
+    for name, shape in scenarios.items():
+        print(f"Running {name}...")
+        scenario = run_scenario(name, shape, args.runs, args.verbose, args.http2, args.render, args.timeout)
+        summary = scenario['summary']
+        print(f"  wall {summary['wall_time_median']:.3f}s, "
+              f"{summary['requests_per_sec_max']:.1f} req/s, "
+              f"{summary['bytes_per_sec_max'] / 1024:.1f} KiB/s, "
+              f"peak RSS {summary['peak_rss_bytes_max'] / 1024 / 1024:.1f} MiB, "
+              f"failures {summary['failures']}")
+        report['scenarios'].append(scenario)
+
+    output = args.output or os.path.join(
+        'bench_results', f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,84 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
 from flask_socketio import SocketIO, emit
 import os
+import sys
 import requests
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from bs4.element import Tag, NavigableString, AttributeValueWithCharsetSubstitution
+from bs4.formatter import Formatter
+from html.parser import HTMLParser
+import html as html_lib
+import codecs
+import itertools
+import socket
+import ssl
+import weakref
+from requests.adapters import HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, get_encoding_from_headers, select_proxy
+import urllib3.util.connection
+from urllib3.util.request import ACCEPT_ENCODING
+import http.client
+import importlib.util
+from urllib.parse import (urljoin, urlparse, urlsplit, urlunsplit, urldefrag, quote, unquote,
+                          unquote_plus, unquote_to_bytes)
 import re
 import base64
 import mimetypes
-from threading import Thread
+from threading import Thread, Event, Lock, Condition, local, current_thread
 import time
 import zipfile
-import shutil
 import tempfile
+import zlib
+import difflib
+import sqlite3
+import mmap
+import struct
 import uuid
-from datetime import datetime
-from werkzeug.exceptions import abort
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from werkzeug.exceptions import abort, HTTPException
 from functools import wraps
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+import cProfile
+import pstats
+import io
+import json
+import queue
 import random
+from fnmatch import fnmatch
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import hashlib
+import heapq
+import bisect
+from array import array
+import gzip
+from urllib.robotparser import RobotFileParser
+from xml.etree import ElementTree
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    from playwright.sync_api import sync_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+except ImportError:
+    sync_playwright = None
 
 # Get port from environment variable (required for Render)
 port = int(os.environ.get('PORT', 5000))
@@ -24,19 +86,47 @@ port = int(os.environ.get('PORT', 5000))
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'web_cloner_secret_key_' + str(uuid.uuid4()))
 
+# Redis for the distributed clone job queue and the Socket.IO message queue.
+# Without it clone jobs run on worker threads inside the web process.
+redis_url = os.environ.get('REDIS_URL')
+clone_workers = int(os.environ.get('CLONE_WORKERS', 0 if redis_url else 4))
+
 # Configure SocketIO for production deployment with gevent
 socketio = SocketIO(app, 
                     async_mode='gevent',  
                     cors_allowed_origins="*",
+                    message_queue=redis_url,
                     logger=False,
                     engineio_logger=False)
 
-# Use a persistent directory in the app root for both local and Render
-base_output_dir = os.path.join(os.getcwd(), 'clones')
+# Transports the browser client may use. Long-polling needs sticky sessions, so
+# servers with several workers and no sticky load balancer use 'websocket' only.
+socketio_transports = [t.strip() for t in os.environ.get('SOCKETIO_TRANSPORTS', 'polling,websocket').split(',')
+                       if t.strip()]
+
+# Use a persistent directory in the app root for both local and Render.
+# Multi-node deployments point CLONES_DIR at a volume shared by all workers.
+base_output_dir = os.environ.get('CLONES_DIR', os.path.join(os.getcwd(), 'clones'))
 os.makedirs(base_output_dir, exist_ok=True)
 
-def retry(max_retries=3, delay=1):
-    """Retry decorator for download functions"""
+# Deleted clones are renamed into this directory and removed in the background.
+# It lives inside base_output_dir so the rename never crosses filesystems.
+trash_dir = os.path.join(base_output_dir, '.trash')
+trash_reap_files_per_sec = int(os.environ.get('TRASH_REAP_FILES_PER_SEC', 500))
+
+def is_reserved_name(name):
+    """Names starting with a dot are internal (trash, journals...) and never served"""
+    return name.startswith('.')
+
+# Profile every clone with cProfile (can also be enabled per WebClonerCore)
+profile_clones = os.environ.get('CLONE_PROFILE', '0') == '1'
+
+# Metrics of the most recent clones, exposed on /api/metrics/clones
+recent_clone_metrics = deque(maxlen=int(os.environ.get('CLONE_METRICS_HISTORY', 50)))
+
+def retry(max_retries=3, delay=1, on_retry=None, paced=()):
+    """Retry decorator for download functions; exceptions of the paced types are
+    retried without the backoff sleep, as something else already spaces the attempts"""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -46,30 +136,3378 @@ def retry(max_retries=3, delay=1):
                 except Exception as e:
                     if attempt == max_retries - 1:
                         raise e
-                    time.sleep(delay * (2 ** attempt) + random.uniform(0, 1))  # Exponential backoff
+                    if on_retry:
+                        on_retry(attempt + 1, e)
+                    if not isinstance(e, paced):
+                        time.sleep(delay * (2 ** attempt) + random.uniform(0, 1))  # Exponential backoff
             return None
         return wrapper
     return decorator
 
+class TrashReaper:
+    """Removes trashed clones in a background thread at a bounded file rate"""
+
+    def __init__(self, trash_path, files_per_second=500, batch_size=50):
+        self.trash_path = trash_path
+        self.trash_paths = {trash_path}  # Plus the .trash of every other directory trashed from
+        self.files_per_second = files_per_second
+        self.batch_size = batch_size
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._thread = None
+
+    def move_to_trash(self, path):
+        """Atomically rename path out of the served namespace and schedule its removal"""
+        # Paths outside the trash's directory (e.g. a benchmark's output) are trashed next
+        # to themselves: a rename into trash_path could cross filesystems
+        parent = os.path.dirname(os.path.abspath(path))
+        trash_path = self.trash_path
+        if parent != os.path.dirname(os.path.abspath(trash_path)):
+            trash_path = os.path.join(parent, os.path.basename(self.trash_path))
+            with self._lock:
+                self.trash_paths.add(trash_path)
+        os.makedirs(trash_path, exist_ok=True)
+        target = os.path.join(trash_path, f"{os.path.basename(path)}.{uuid.uuid4().hex}")
+        os.rename(path, target)
+        self.start()
+        self._wakeup.set()
+        return target
+
+    def start(self):
+        """Start the reaper thread if it is not already running"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._wakeup.set()  # Pick up leftovers from a previous run
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(timeout=60)
+            self._wakeup.clear()
+            with self._lock:
+                trash_paths = list(self.trash_paths)
+            for trash_path in trash_paths:
+                try:
+                    entries = os.listdir(trash_path)
+                except FileNotFoundError:
+                    continue
+                for entry in entries:
+                    try:
+                        self._reap(os.path.join(trash_path, entry))
+                    except Exception as e:
+                        print(f"Error reaping {entry}: {e}")
+
+    def _throttle(self, removed):
+        if self.files_per_second > 0 and removed % self.batch_size == 0:
+            time.sleep(self.batch_size / self.files_per_second)
+
+    def _reap(self, path):
+        if not os.path.isdir(path) or os.path.islink(path):
+            os.remove(path)
+            return
+
+        removed = 0
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+                removed += 1
+                self._throttle(removed)
+            for name in dirs:
+                dir_path = os.path.join(root, name)
+                if os.path.islink(dir_path):
+                    os.remove(dir_path)
+                else:
+                    os.rmdir(dir_path)
+        os.rmdir(path)
+
+trash_reaper = TrashReaper(trash_dir, trash_reap_files_per_sec)
+
+class MetricBuffer:
+    """Lock-light update buffer: writers only append, readers fold into totals
+
+    deque.append is atomic, so hot paths never wait on a lock. Pending updates
+    are folded when metrics are collected, or opportunistically by a writer
+    once the buffer grows past drain_threshold.
+    """
+
+    drain_threshold = 10000
+
+    def __init__(self, fold):
+        self._pending = deque()
+        self._fold = fold
+        self._lock = Lock()
+
+    def push(self, item):
+        self._pending.append(item)
+        if len(self._pending) > self.drain_threshold and self._lock.acquire(blocking=False):
+            try:
+                self._drain()
+            finally:
+                self._lock.release()
+
+    def _drain(self):
+        pending = self._pending
+        while True:
+            try:
+                item = pending.popleft()
+            except IndexError:
+                return
+            self._fold(item)
+
+    def collect(self):
+        with self._lock:
+            self._drain()
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Counter:
+    """Monotonic Prometheus counter"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.buffer = MetricBuffer(self._fold)
+
+    def _fold(self, item):
+        labels, amount = item
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def inc(self, amount=1, labels=()):
+        self.buffer.push((labels, amount))
+
+    def samples(self):
+        self.buffer.collect()
+        if not self.labelnames and not self.values:
+            yield self.name, '', 0
+        for labels, value in sorted(self.values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """Prometheus gauge, optionally computed by a callback at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def _fold(self, item):
+        labels, amount, absolute = item
+        self.values[labels] = amount if absolute else self.values.get(labels, 0) + amount
+
+    def inc(self, amount=1, labels=()):
+        self.buffer.push((labels, amount, False))
+
+    def dec(self, amount=1, labels=()):
+        self.buffer.push((labels, -amount, False))
+
+    def set(self, value, labels=()):
+        self.buffer.push((labels, value, True))
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as e:
+                print(f"Error computing gauge {self.name}: {e}")
+        return super().samples()
+
+class Histogram:
+    """Prometheus histogram with fixed buckets"""
+
+    kind = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.values = {}
+        self.buffer = MetricBuffer(self._fold)
+
+    def _fold(self, item):
+        labels, value = item
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        else:
+            entry[0][-1] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def observe(self, value, labels=()):
+        self.buffer.push((labels, value))
+
+    @contextmanager
+    def time(self, labels=()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def samples(self):
+        self.buffer.collect()
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket',
+                       _format_labels(self.labelnames, labels, ('le', _format_value(bound))), cumulative)
+            yield self.name + '_sum', _format_labels(self.labelnames, labels), total
+            yield self.name + '_count', _format_labels(self.labelnames, labels), count
+
+class MetricsRegistry:
+    """Process-wide metrics rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+_disk_usage_cache = {'value': 0, 'expires': 0.0}
+disk_usage_ttl = float(os.environ.get('DISK_USAGE_TTL', 60))
+
+def directory_size(path):
+    """Total size in bytes of all files below path"""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    return total
+
+def cached_disk_usage():
+    """Disk usage of base_output_dir, recomputed at most every disk_usage_ttl seconds"""
+    now = time.time()
+    if now >= _disk_usage_cache['expires']:
+        _disk_usage_cache['value'] = directory_size(base_output_dir)
+        _disk_usage_cache['expires'] = now + disk_usage_ttl
+    return _disk_usage_cache['value']
+
+metrics_registry = MetricsRegistry()
+clone_jobs_queued = metrics_registry.gauge(
+    'webcloner_clone_jobs_queued', 'Clone jobs submitted but not started yet',
+    function=lambda: job_queue.depth())
+clones_active = metrics_registry.gauge(
+    'webcloner_clones_active', 'Clone jobs currently running')
+clones_total = metrics_registry.counter(
+    'webcloner_clones_total', 'Finished clone jobs by result', ('result',))
+clone_duration = metrics_registry.histogram(
+    'webcloner_clone_duration_seconds', 'Wall time of clone jobs',
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+http_requests_total = metrics_registry.counter(
+    'webcloner_http_requests_total', 'Outgoing HTTP requests made while cloning', ('outcome',))
+http_request_duration = metrics_registry.histogram(
+    'webcloner_http_request_duration_seconds', 'Latency of outgoing HTTP requests')
+http_retries_total = metrics_registry.counter(
+    'webcloner_http_retries_total', 'Retried outgoing HTTP requests')
+download_bytes_total = metrics_registry.counter(
+    'webcloner_download_bytes_total', 'Response bytes downloaded while cloning')
+resource_cache_hits_total = metrics_registry.counter(
+    'webcloner_resource_cache_hits_total', 'Resources served from the dedup or shared asset cache')
+preview_requests_total = metrics_registry.counter(
+    'webcloner_preview_requests_total', 'Preview file requests by status code', ('status',))
+preview_request_duration = metrics_registry.histogram(
+    'webcloner_preview_request_duration_seconds', 'Latency of preview file requests')
+dns_lookups_total = metrics_registry.counter(
+    'webcloner_dns_lookups_total', 'Host name resolutions by DNS cache result', ('result',))
+http_slow_down_total = metrics_registry.counter(
+    'webcloner_http_slow_down_total', 'Upstream responses asking the cloner to back off (429, 503)')
+http_responses_by_protocol = metrics_registry.counter(
+    'webcloner_http_responses_by_protocol_total', 'Upstream HTTP responses by protocol version', ('version',))
+disk_usage_bytes = metrics_registry.gauge(
+    'webcloner_disk_usage_bytes', 'Bytes used below the clones directory', function=cached_disk_usage)
+
+# Pages larger than this (by Content-Length) are cloned in low-memory streaming mode
+low_memory_html_bytes = int(os.environ.get('LOW_MEMORY_HTML_BYTES', 8 * 1024 * 1024))
+stream_chunk_size = 64 * 1024
+
+CSS_URL_RE = re.compile(r'url\(["\']?([^"\')]+)["\']?\)')
+
+def _opening_tag(tag, formatter, eventual_encoding='utf-8'):
+    attrs = []
+    for key, val in formatter.attributes(tag):
+        if val is None:
+            attrs.append(key)
+            continue
+        if isinstance(val, (list, tuple)):
+            val = ' '.join(val)
+        elif isinstance(val, AttributeValueWithCharsetSubstitution):
+            val = val.encode(eventual_encoding)
+        elif not isinstance(val, str):
+            val = str(val)
+        attrs.append(str(key) + '=' + formatter.quoted_attribute_value(formatter.attribute_value(val)))
+    prefix = tag.prefix + ':' if tag.prefix else ''
+    attribute_string = ' ' + ' '.join(attrs) if attrs else ''
+    void_slash = (formatter.void_element_close_prefix or '') if tag.is_empty_element else ''
+    return '<' + prefix + tag.name + attribute_string + void_slash + '>'
+
+def _closing_tag(tag):
+    prefix = tag.prefix + ':' if tag.prefix else ''
+    return '</' + prefix + tag.name + '>'
+
+def iter_html_chunks(soup, chunk_size=stream_chunk_size, formatter='minimal'):
+    """Serialize a parsed document in chunks; joined, the output equals str(soup)"""
+    if not isinstance(formatter, Formatter):
+        formatter = soup.formatter_for_name(formatter)
+    pieces = []
+    size = 0
+    open_tags = []
+    for element in soup.descendants:
+        while open_tags and element.parent is not open_tags[-1]:
+            piece = _closing_tag(open_tags.pop())
+            pieces.append(piece)
+            size += len(piece)
+        if isinstance(element, Tag):
+            piece = _opening_tag(element, formatter)
+            if not element.is_empty_element:
+                open_tags.append(element)
+        else:
+            piece = element.output_ready(formatter)
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    while open_tags:
+        pieces.append(_closing_tag(open_tags.pop()))
+    if pieces:
+        yield ''.join(pieces)
+
+def write_html(soup, out):
+    """Write a parsed document to a text file without building the whole string first"""
+    written = 0
+    for chunk in iter_html_chunks(soup):
+        out.write(chunk)
+        written += len(chunk)
+    return written
+
+def sniff_html_encoding(response, head):
+    """Pick the charset of a streamed page from its headers or leading bytes"""
+    candidates = []
+    if 'charset' in response.headers.get('content-type', '').lower():
+        candidates.append(response.encoding)
+    match = re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', head[:4096], re.I)
+    if match:
+        candidates.append(match.group(1).decode('ascii'))
+    for candidate in candidates + ['utf-8']:
+        try:
+            return codecs.lookup(candidate).name
+        except (LookupError, TypeError):
+            continue
+
+# Elements whose text is never shown; the <title> is indexed on its own
+SEARCH_HIDDEN_TAGS = {'script', 'style', 'noscript', 'template', 'title'}
+
+class VisibleText:
+    """Title and visible text of a document, gathered from parser events up to max_chars"""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.title = []
+        self.pieces = []
+        self.size = 0
+        self._hidden = None
+
+    def start(self, tag):
+        if self._hidden is None and tag in SEARCH_HIDDEN_TAGS:
+            self._hidden = tag
+        self.pieces.append(' ')
+
+    def end(self, tag):
+        if tag == self._hidden:
+            self._hidden = None
+        self.pieces.append(' ')
+
+    def data(self, data):
+        if self._hidden == 'title':
+            self.title.append(data)
+        elif self._hidden is None and self.size < self.max_chars:
+            self.pieces.append(data)
+            self.size += len(data)
+
+    def result(self):
+        return ' '.join(''.join(self.title).split()), ' '.join(''.join(self.pieces).split())[:self.max_chars]
+
+class VisibleTextParser(HTMLParser):
+    """Feeds a VisibleText from HTML that is not otherwise parsed"""
+
+    def __init__(self, max_chars):
+        super().__init__(convert_charrefs=True)
+        self.text = VisibleText(max_chars)
+
+    def handle_starttag(self, tag, attrs):
+        self.text.start(tag)
+
+    def handle_endtag(self, tag):
+        self.text.end(tag)
+
+    def handle_data(self, data):
+        self.text.data(data)
+
+def soup_visible_text(soup, max_chars):
+    """(title, visible text) of a parsed document"""
+    text = VisibleText(max_chars)
+    for string in soup.find_all(string=True):
+        if type(string) is not NavigableString:
+            continue  # Comments, doctypes, CDATA
+        parent = string.parent.name if string.parent is not None else None
+        if parent == 'title':
+            text.title.append(string)
+        elif parent not in SEARCH_HIDDEN_TAGS:
+            text.data(string)
+            text.pieces.append(' ')
+            if text.size >= max_chars:
+                break
+    return text.result()
+
+class StreamingHTMLRewriter(HTMLParser):
+    """Rewrites asset URLs while a document streams from the network to disk
+
+    Only the current token is held in memory, so peak usage does not grow with
+    the page size, with one limit: the body of a <script> or <style> element is
+    held whole, by HTMLParser until its end tag and for <style> also to rewrite
+    its url()s. Tags whose attributes are unchanged are written back verbatim.
+    """
+
+    def __init__(self, out, rewrite_tag, rewrite_css, text=None):
+        super().__init__(convert_charrefs=False)
+        self.out = out
+        self.rewrite_tag = rewrite_tag
+        self.rewrite_css = rewrite_css
+        self.text = text  # Optional VisibleText for the search index
+        self._style = None
+
+    def _write_tag(self, tag, attrs, self_closing):
+        new_attrs = self.rewrite_tag(tag, attrs)
+        if new_attrs is None:
+            self.out.write(self.get_starttag_text())
+            return
+        parts = [tag]
+        for name, value in new_attrs:
+            parts.append(name if value is None else f'{name}="{html_lib.escape(value, quote=True)}"')
+        self.out.write('<' + ' '.join(parts) + ('/>' if self_closing else '>'))
+
+    def handle_starttag(self, tag, attrs):
+        self._write_tag(tag, attrs, False)
+        if tag == 'style':
+            self._style = []
+        if self.text:
+            self.text.start(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._write_tag(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if tag == 'style' and self._style is not None:
+            self.out.write(self.rewrite_css(''.join(self._style)))
+            self._style = None
+        self.out.write(f'</{tag}>')
+        if self.text:
+            self.text.end(tag)
+
+    def handle_data(self, data):
+        if self._style is not None:
+            self._style.append(data)
+        else:
+            self.out.write(data)
+            if self.text:
+                self.text.data(html_lib.unescape(data) if '&' in data else data)
+
+    def handle_entityref(self, name):
+        self.handle_data(f'&{name};')
+
+    def handle_charref(self, name):
+        self.handle_data(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.out.write(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.out.write(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self.out.write(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self.out.write(f'<![{data}]>')
+
+    def close(self):
+        super().close()
+        if self._style is not None:
+            self.out.write(''.join(self._style))
+            self._style = None
+
+def classify_content_type(content_type):
+    """Map a Content-Type header to a coarse asset class"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type.startswith('image/'):
+        return 'image'
+    if 'css' in content_type:
+        return 'css'
+    if 'javascript' in content_type or content_type.endswith('/ecmascript'):
+        return 'js'
+    if content_type.startswith('font/') or 'font' in content_type:
+        return 'font'
+    if 'html' in content_type:
+        return 'html'
+    if content_type.startswith(('video/', 'audio/')):
+        return 'media'
+    return 'other'
+
+# URL canonicalization: every dedup set and frontier is keyed by canonical_url()
+tracking_params = [param.strip().lower() for param in os.environ.get(
+    'TRACKING_PARAMS', 'utm_*,gclid,dclid,gbraid,wbraid,fbclid,msclkid,yclid,mc_cid,mc_eid,_ga,_gl,igshid'
+).split(',') if param.strip()]
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+PERCENT_ESCAPE_RE = re.compile(r'%([0-9A-Fa-f]{2})')
+URL_UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+def _normalize_escapes(part, safe):
+    """Decode escapes of unreserved characters, upper-case the rest and escape
+    anything that should not appear raw"""
+    def fix(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in URL_UNRESERVED else '%' + match.group(1).upper()
+    return quote(PERCENT_ESCAPE_RE.sub(fix, part), safe=safe + '%')
+
+def is_tracking_param(name):
+    name = unquote_plus(name).lower()
+    return any(fnmatch(name, pattern) for pattern in tracking_params)
+
+def canonical_url(url):
+    """Dedup key for a URL: no fragment or tracking parameters, lower-case scheme
+    and host, no default port, normalized percent-encoding and no trailing slash"""
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return urldefrag(url)[0]
+    host = (parts.hostname or '').rstrip('.')
+    try:
+        host = host.encode('idna').decode('ascii') if not host.isascii() else host.lower()
+    except UnicodeError:
+        host = host.lower()
+    if ':' in host:
+        host = f"[{host}]"
+    netloc = host if port in (None, DEFAULT_PORTS[scheme]) else f"{host}:{port}"
+    if parts.username is not None:
+        userinfo = parts.netloc.rpartition('@')[0]
+        netloc = f"{userinfo}@{netloc}"
+    path = _normalize_escapes(parts.path, "/!$&'()*+,;=:@") or '/'
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+    query = '&'.join(_normalize_escapes(pair, "!$'()*+,;=:@/?")
+                     for pair in parts.query.split('&')
+                     if pair and not is_tracking_param(pair.partition('=')[0]))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+canonical_scan_chars = 64 * 1024
+
+class _CanonicalLinkFinder(HTMLParser):
+    """Reads a document's head just far enough to find <link rel=canonical>"""
+
+    class Done(Exception):
+        pass
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.href = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body':
+            raise self.Done()
+        if tag == 'link':
+            values = dict(attrs)
+            if 'canonical' in (values.get('rel') or '').lower().split() and values.get('href'):
+                self.href = values['href'].strip()
+                raise self.Done()
+
+def find_canonical_link(html):
+    """href of a document's <link rel=canonical>, or None"""
+    finder = _CanonicalLinkFinder()
+    try:
+        finder.feed(html[:canonical_scan_chars])
+    except _CanonicalLinkFinder.Done:
+        pass
+    return finder.href
+
+def page_rel_path(url):
+    """Path, relative to the clone's root, an internal page is saved under"""
+    path = urlparse(url).path
+    if path.endswith('/') or not path:
+        rel_path = os.path.join(path.strip('/'), 'index.html')
+    else:
+        filename = os.path.basename(path)
+        if not filename.endswith('.html'):
+            filename += '.html'
+        rel_path = os.path.join(os.path.dirname(path).strip('/'), filename)
+    return rel_path.replace('\\', '/')
+
+HTML_WHITESPACE = ' \t\n\x0c\r'
+
+def _srcset_descriptors(value, pos):
+    """Tokenize the descriptors after a srcset URL; returns (tokens, position after the comma)"""
+    n = len(value)
+    while pos < n and value[pos] in HTML_WHITESPACE:
+        pos += 1
+    tokens, current, state = [], '', 'descriptor'
+    while True:
+        c = value[pos] if pos < n else None
+        pos += 1
+        if state == 'descriptor':
+            if c is None or c == ',':
+                if current:
+                    tokens.append(current)
+                return tokens, pos
+            if c in HTML_WHITESPACE:
+                if current:
+                    tokens.append(current)
+                current, state = '', 'after'
+            else:
+                current += c
+                if c == '(':
+                    state = 'parens'
+        elif state == 'parens':
+            if c is None:
+                tokens.append(current)
+                return tokens, pos
+            current += c
+            if c == ')':
+                state = 'descriptor'
+        else:  # After a descriptor, before the next one or the comma
+            if c is None:
+                return tokens, pos
+            if c not in HTML_WHITESPACE:
+                state = 'descriptor'
+                pos -= 1
+
+SRCSET_DENSITY_RE = re.compile(r'(?:\d+(?:\.\d+)?|\.\d+)(?:[eE][-+]?\d+)?')
+
+def _valid_srcset_descriptors(tokens):
+    """At most one width (integer > 0) or density (number >= 0), plus a height only with a width"""
+    seen = set()
+    for token in tokens:
+        kind, number = token[-1:].lower(), token[:-1]
+        if kind not in ('w', 'x', 'h') or kind in seen:
+            return False
+        if kind == 'x' and not SRCSET_DENSITY_RE.fullmatch(number):
+            return False
+        if kind != 'x' and (not number.isdigit() or int(number) == 0):
+            return False
+        seen.add(kind)
+    return not ('w' in seen and 'x' in seen) and not ('h' in seen and 'w' not in seen)
+
+def parse_srcset(value):
+    """Parse a srcset / imagesrcset attribute into (url, descriptor) candidates,
+    following the WHATWG algorithm: URLs may contain commas (data: URIs, query
+    strings) and candidates with invalid descriptors are dropped"""
+    candidates = []
+    pos, n = 0, len(value or '')
+    while True:
+        while pos < n and (value[pos] in HTML_WHITESPACE or value[pos] == ','):
+            pos += 1
+        if pos >= n:
+            return candidates
+        start = pos
+        while pos < n and value[pos] not in HTML_WHITESPACE:
+            pos += 1
+        url = value[start:pos]
+        if url.endswith(','):
+            # A trailing comma ends the candidate; it has no descriptors
+            url, tokens = url.rstrip(','), []
+        else:
+            tokens, pos = _srcset_descriptors(value, pos)
+        if url and _valid_srcset_descriptors(tokens):
+            candidates.append((url, ' '.join(tokens)))
+
+def serialize_srcset(candidates):
+    """Join (url, descriptor) candidates back into an attribute value"""
+    return ', '.join(f"{url.replace(' ', '%20')} {descriptor}".strip() for url, descriptor in candidates)
+
+# data: URIs up to this length stay inline; longer ones are extracted to assets/
+data_uri_inline_max_bytes = int(os.environ.get('DATA_URI_INLINE_MAX_BYTES', 2048))
+
+def parse_data_uri(data_uri):
+    """Split a data: URI into its MIME type and an iterator over the decoded
+    payload; base64 is decoded a chunk at a time so large payloads never need
+    a second full-size copy"""
+    header, _, data = data_uri[5:].partition(',')
+    params = [param.strip() for param in header.split(';')]
+    mime_type = params[0].lower() or 'text/plain'
+    if 'base64' not in (param.lower() for param in params[1:]):
+        return mime_type, iter([unquote_to_bytes(data)])
+    if '%' in data:
+        data = unquote(data)
+    
+    def chunks():
+        pending = ''
+        for start in range(0, len(data), stream_chunk_size):
+            piece = pending + ''.join(data[start:start + stream_chunk_size].split())
+            usable = len(piece) - len(piece) % 4
+            pending = piece[usable:]
+            if usable:
+                yield base64.b64decode(piece[:usable], validate=True)
+        pending = pending.rstrip('=')
+        if pending:
+            yield base64.b64decode(pending + '=' * (-len(pending) % 4), validate=True)
+    return mime_type, chunks()
+
+def guess_asset_type(url):
+    """Asset class implied by a URL's file extension, 'other' when unknown"""
+    return classify_content_type(mimetypes.guess_type(urlparse(url).path)[0])
+
+# <link rel=preload as=...> and friends
+PRELOAD_AS_TYPES = {'style': 'css', 'script': 'js', 'font': 'font', 'image': 'image',
+                    'audio': 'media', 'video': 'media', 'track': 'media'}
+
+def link_asset_type(rels, as_value=None):
+    """Asset class of a <link> from its rel tokens, None when the URL has to tell"""
+    rels = [rel.lower() for rel in rels]
+    if 'stylesheet' in rels:
+        return 'css'
+    if 'modulepreload' in rels:
+        return 'js'
+    if any(rel in ('icon', 'apple-touch-icon', 'apple-touch-icon-precomposed', 'mask-icon') for rel in rels):
+        return 'image'
+    if 'manifest' in rels:
+        return 'other'
+    return PRELOAD_AS_TYPES.get((as_value or '').lower())
+
+def is_third_party(host, page_host):
+    """True when host is outside the page's site (subdomains of it count as first party)"""
+    host, page_host = (host or '').lower(), (page_host or '').lower()
+    site = page_host[4:] if page_host.startswith('www.') else page_host
+    return not (host == page_host or host == site or host.endswith('.' + site))
+
+class ResourcePolicy:
+    """Declarative rules for which assets a clone downloads and in what order,
+    e.g. {"exclude_types": ["media"], "max_bytes": {"image": 500000},
+    "srcset": "best", "max_third_party_hosts": 0}"""
+
+    asset_types = ('css', 'js', 'font', 'image', 'media', 'html', 'other')
+    # <link rel> values naming hints or metadata rather than page assets
+    default_exclude_rels = ('preconnect', 'dns-prefetch', 'canonical', 'alternate', 'prev', 'next',
+                            'pingback', 'search', 'author', 'help', 'license', 'shortlink', 'edituri',
+                            'wlwmanifest', 'amphtml', 'me', 'webmention', 'bookmark', 'tag')
+    default_priority = ('css', 'js', 'font', 'image', 'media', 'other')
+    srcset_modes = ('best', 'all', 'none')
+    keys = ('include_types', 'exclude_types', 'include_hosts', 'exclude_hosts', 'include_rels',
+            'exclude_rels', 'max_bytes', 'srcset', 'max_third_party_hosts', 'priority')
+
+    def __init__(self, include_types=None, exclude_types=(), include_hosts=None, exclude_hosts=(),
+                 include_rels=None, exclude_rels=default_exclude_rels, max_bytes=None, srcset='best',
+                 max_third_party_hosts=None, priority=default_priority):
+        for name, types in (('include_types', include_types or ()), ('exclude_types', exclude_types),
+                            ('priority', priority)):
+            unknown = set(types) - set(self.asset_types)
+            if unknown:
+                raise ValueError(f"Unknown asset types in {name}: {', '.join(sorted(unknown))}")
+        if srcset not in self.srcset_modes:
+            raise ValueError(f"srcset must be one of {', '.join(self.srcset_modes)}")
+        if isinstance(max_bytes, dict):
+            if set(max_bytes) - set(self.asset_types):
+                raise ValueError("max_bytes keys must be asset types")
+            max_bytes = {k: int(v) for k, v in max_bytes.items()}
+        elif max_bytes is not None:
+            max_bytes = int(max_bytes)
+        if max_third_party_hosts is not None and int(max_third_party_hosts) < 0:
+            raise ValueError("max_third_party_hosts must be 0 or more")
+
+        self.include_types = set(include_types) if include_types is not None else None
+        self.exclude_types = set(exclude_types)
+        self.include_hosts = [h.lower() for h in include_hosts] if include_hosts is not None else None
+        self.exclude_hosts = [h.lower() for h in exclude_hosts]
+        self.include_rels = {r.lower() for r in include_rels} if include_rels is not None else None
+        self.exclude_rels = {r.lower() for r in exclude_rels}
+        self.max_bytes = max_bytes
+        self.srcset = srcset
+        self.max_third_party_hosts = int(max_third_party_hosts) if max_third_party_hosts is not None else None
+        self.priority_order = list(priority)
+
+    @classmethod
+    def from_dict(cls, spec):
+        """Build a policy from a JSON object; raises ValueError on bad input"""
+        if not isinstance(spec or {}, dict):
+            raise ValueError("Resource policy must be an object")
+        unknown = set(spec or {}) - set(cls.keys)
+        if unknown:
+            raise ValueError(f"Unknown resource policy keys: {', '.join(sorted(unknown))}")
+        try:
+            return cls(**(spec or {}))
+        except TypeError as e:
+            raise ValueError(f"Invalid resource policy: {e}")
+
+    def to_dict(self):
+        return {
+            'include_types': sorted(self.include_types) if self.include_types is not None else None,
+            'exclude_types': sorted(self.exclude_types),
+            'include_hosts': self.include_hosts,
+            'exclude_hosts': self.exclude_hosts,
+            'include_rels': sorted(self.include_rels) if self.include_rels is not None else None,
+            'exclude_rels': sorted(self.exclude_rels),
+            'max_bytes': self.max_bytes,
+            'srcset': self.srcset,
+            'max_third_party_hosts': self.max_third_party_hosts,
+            'priority': self.priority_order,
+        }
+
+    def merged(self, spec):
+        """Copy of this policy with the keys in spec overridden"""
+        if not spec:
+            return self
+        if not isinstance(spec, dict):
+            raise ValueError("Resource policy must be an object")
+        return self.from_dict(dict(self.to_dict(), **spec))
+
+    def allows_type(self, asset_type):
+        if self.include_types is not None and asset_type not in self.include_types:
+            return False
+        return asset_type not in self.exclude_types
+
+    def allows_host(self, host):
+        host = (host or '').lower()
+        if self.include_hosts is not None and not any(fnmatch(host, p) for p in self.include_hosts):
+            return False
+        return not any(fnmatch(host, p) for p in self.exclude_hosts)
+
+    def allows_rel(self, rels):
+        """Whether a <link> is worth fetching; it is skipped only if all its rel tokens are excluded"""
+        rels = [rel.lower() for rel in rels]
+        if self.include_rels is not None:
+            return any(rel in self.include_rels for rel in rels)
+        return not rels or any(rel not in self.exclude_rels for rel in rels)
+
+    def size_limit(self, asset_type):
+        if isinstance(self.max_bytes, dict):
+            return self.max_bytes.get(asset_type)
+        return self.max_bytes
+
+    def choose_srcset(self, candidates):
+        """Pick the (url, descriptor) srcset candidates to download"""
+        if self.srcset == 'all' or not candidates:
+            return list(candidates)
+        if self.srcset == 'none':
+            return []
+
+        def resolution(candidate):
+            # Widths outrank densities; a candidate without a descriptor is 1x
+            tokens = {token[-1:].lower(): token[:-1] for token in candidate[1].split()}
+            try:
+                if 'w' in tokens:
+                    return (1, float(tokens['w']))
+                return (0, float(tokens.get('x', 1)))
+            except ValueError:
+                return (0, 1.0)
+        return [max(candidates, key=resolution)]
+
+    def priority(self, asset_type):
+        """Fetch order rank; lower goes first"""
+        try:
+            return self.priority_order.index(asset_type)
+        except ValueError:
+            return len(self.priority_order)
+
+default_resource_policy = ResourcePolicy.from_dict(json.loads(os.environ.get('RESOURCE_POLICY') or '{}'))
+
+class CloneMetrics:
+    """Stage timers, per-host latency histograms and counters for one clone"""
+
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = {}
+        self.counters = {'requests': 0, 'bytes': 0, 'retries': 0, 'cache_hits': 0, 'errors': 0, 'skipped': 0}
+        self.bytes_by_type = {}
+        self.hosts = {}
+        self.profile = None
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of work and add it to the named stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        if name == 'retries':
+            http_retries_total.inc(amount)
+        elif name == 'cache_hits':
+            resource_cache_hits_total.inc(amount)
+
+    def observe_request(self, url, latency, size=0, error=False):
+        """Record one HTTP request in the per-host histogram and counters"""
+        http_requests_total.inc(1, ('error',) if error else ('ok',))
+        http_request_duration.observe(latency)
+        download_bytes_total.inc(size)
+        host = urlparse(url).netloc
+        with self._lock:
+            stats = self.hosts.get(host)
+            if stats is None:
+                stats = self.hosts[host] = {
+                    'requests': 0, 'errors': 0, 'bytes': 0, 'latency_sum': 0.0,
+                    'buckets': [0] * (len(self.latency_buckets) + 1),
+                }
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['latency_sum'] += latency
+            if error:
+                stats['errors'] += 1
+            for i, bound in enumerate(self.latency_buckets):
+                if latency <= bound:
+                    stats['buckets'][i] += 1
+                    break
+            else:
+                stats['buckets'][-1] += 1
+            self.counters['requests'] += 1
+            self.counters['bytes'] += size
+            if error:
+                self.counters['errors'] += 1
+
+    def record_asset(self, asset_type, size):
+        """Track where the saved bytes go, by asset class"""
+        with self._lock:
+            entry = self.bytes_by_type.setdefault(asset_type, {'files': 0, 'bytes': 0})
+            entry['files'] += 1
+            entry['bytes'] += size
+
+    def to_dict(self):
+        with self._lock:
+            bounds = [str(b) for b in self.latency_buckets] + ['+Inf']
+            return {
+                'started_at': self.started_at,
+                'duration': time.time() - self.started_at,
+                'stages': {name: round(value, 6) for name, value in self.stages.items()},
+                'counters': dict(self.counters),
+                'bytes_by_type': {k: dict(v) for k, v in self.bytes_by_type.items()},
+                'hosts': {
+                    host: {
+                        'requests': stats['requests'],
+                        'errors': stats['errors'],
+                        'bytes': stats['bytes'],
+                        'latency_avg': stats['latency_sum'] / stats['requests'] if stats['requests'] else 0.0,
+                        'latency_histogram': dict(zip(bounds, stats['buckets'])),
+                    }
+                    for host, stats in self.hosts.items()
+                },
+                'profile': self.profile,
+            }
+
+class AssetCache:
+    """Size-bounded LRU of downloaded asset bodies, shared by clones of the same host"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_item_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, url):
+        with self._lock:
+            item = self._items.get(url)
+            if item is not None:
+                self._items.move_to_end(url)
+            return item
+
+    def put(self, url, content, content_type):
+        if len(content) > self.max_item_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(url, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._items[url] = (content, content_type)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+BROWSER_USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                      '(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36')
+
+# Process-wide connection pooling shared by every clone job
+pool_max_hosts = int(os.environ.get('POOL_MAX_HOSTS', 100))
+pool_per_host = int(os.environ.get('POOL_PER_HOST', 10))
+pool_idle_timeout = float(os.environ.get('POOL_IDLE_TIMEOUT', 90))
+dns_cache_ttl = float(os.environ.get('DNS_CACHE_TTL', 300))
+
+class DNSCache:
+    """TTL-bounded, size-bounded cache of getaddrinfo results"""
+
+    def __init__(self, ttl=300, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def resolve(self, host, port, family=0, type=socket.SOCK_STREAM):
+        key = (host, port, family, type)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                dns_lookups_total.inc(1, ('hit',))
+                return entry[1]
+        dns_lookups_total.inc(1, ('miss',))
+        infos = socket.getaddrinfo(host, port, family, type)
+        with self._lock:
+            self._entries[key] = (now + self.ttl, infos)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return infos
+
+    def install(self):
+        """Route urllib3's connection setup (and so requests') through this cache"""
+        original = urllib3.util.connection.create_connection
+        if getattr(original, 'dns_cache', None) is self:
+            return
+        original = getattr(original, 'wrapped', original)
+
+        @wraps(original)
+        def create_connection(address, *args, **kwargs):
+            host, port = address
+            host = host.strip('[]')
+            family = urllib3.util.connection.allowed_gai_family()
+            try:
+                infos = self.resolve(host, port, family)
+            except socket.gaierror:
+                return original(address, *args, **kwargs)
+            error = None
+            for info in infos:
+                try:
+                    # An IP literal needs no lookup; TLS still uses the real host name
+                    return original((info[4][0], port), *args, **kwargs)
+                except OSError as e:
+                    error = e
+            raise error or OSError(f"No addresses for {host}")
+
+        create_connection.dns_cache = self
+        create_connection.wrapped = original
+        urllib3.util.connection.create_connection = create_connection
+
+class SessionReusingSSLContext(ssl.SSLContext):
+    """SSLContext that resumes the last TLS session per server name"""
+
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        # SSLContext takes its protocol here; __init__ is too late
+        return super().__new__(cls, protocol)
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, max_hosts=100):
+        self.max_hosts = max_hosts
+        self._tls_sessions = OrderedDict()
+        self._tls_sockets = {}
+        self._tls_lock = Lock()
+
+    def _session_for(self, host):
+        with self._tls_lock:
+            ref = self._tls_sockets.pop(host, None)
+            sock = ref() if ref else None
+            if sock is not None:
+                # TLS 1.3 tickets arrive after the handshake, so read them lazily
+                try:
+                    if sock.session is not None:
+                        self._tls_sessions[host] = sock.session
+                except (OSError, ValueError):
+                    pass
+            session = self._tls_sessions.get(host)
+            if session is not None and session.time + session.timeout < time.time():
+                del self._tls_sessions[host]
+                session = None
+            if session is not None:
+                self._tls_sessions.move_to_end(host)
+            while len(self._tls_sessions) > self.max_hosts:
+                self._tls_sessions.popitem(last=False)
+            return session
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        host = kwargs.get('server_hostname')
+        if host and kwargs.get('session') is None:
+            kwargs['session'] = self._session_for(host)
+        ssl_sock = super().wrap_socket(sock, *args, **kwargs)
+        if host:
+            with self._tls_lock:
+                self._tls_sockets[host] = weakref.ref(ssl_sock)
+        return ssl_sock
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter mounted on every clone session so connections, TLS state and
+    DNS answers are reused across clones, with per-host limits and idle eviction"""
+
+    def __init__(self, max_hosts=100, per_host=10, idle_timeout=90):
+        self.idle_timeout = idle_timeout
+        self._last_used = {}
+        self._next_sweep = 0.0
+        self._sweep_lock = Lock()
+        self.max_hosts = max_hosts
+        # urllib3 sets verify_mode and check_hostname on the context of every connection
+        # it opens, so each verify value gets its own context and pools, never mutated
+        self._ssl_contexts = {}
+        self._ssl_contexts_lock = Lock()
+        self._request = local()  # verify of the request being sent, for get_connection
+        self.ssl_context = self.ssl_context_for(True)
+        super().__init__(pool_connections=max_hosts, pool_maxsize=per_host)
+
+    def ssl_context_for(self, verify):
+        """One context per verify value (True, False or a CA bundle path), with the CA
+        bundle loaded once instead of once per connection"""
+        with self._ssl_contexts_lock:
+            ssl_context = self._ssl_contexts.get(verify)
+            if ssl_context is None:
+                ssl_context = SessionReusingSSLContext(max_hosts=self.max_hosts)
+                ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+                if not verify:
+                    ssl_context.check_hostname = False
+                    ssl_context.verify_mode = ssl.CERT_NONE
+                else:
+                    ca_bundle = DEFAULT_CA_BUNDLE_PATH if verify is True else verify
+                    if os.path.isdir(ca_bundle):
+                        ssl_context.load_verify_locations(capath=ca_bundle)
+                    else:
+                        ssl_context.load_verify_locations(cafile=ca_bundle)
+                self._ssl_contexts[verify] = ssl_context
+            return ssl_context
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('ssl_context', self.ssl_context)
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+    def get_connection(self, url, proxies=None):
+        if select_proxy(url, proxies) or not url.lower().startswith('https'):
+            return super().get_connection(url, proxies)
+        # The context is part of the pool key: verified and unverified requests never share pools
+        ssl_context = self.ssl_context_for(getattr(self._request, 'verify', True))
+        return self.poolmanager.connection_from_url(urlparse(url).geturl(),
+                                                    pool_kwargs={'ssl_context': ssl_context})
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if verify and url.lower().startswith('https') and conn.conn_kw.get('ssl_context') is not None:
+            # Already loaded into the pool's context
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+    def send(self, request, **kwargs):
+        self._request.verify = kwargs.get('verify', True)
+        parsed = urlparse(request.url)
+        default_port = 443 if parsed.scheme == 'https' else 80
+        now = time.monotonic()
+        self._last_used[(parsed.scheme, parsed.hostname, parsed.port or default_port)] = now
+        if now >= self._next_sweep:
+            self._evict_idle(now)
+        return super().send(request, **kwargs)
+
+    def _evict_idle(self, now):
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = now + max(self.idle_timeout / 4, 1)
+            pools = self.poolmanager.pools
+            for key in pools.keys():
+                last_used = self._last_used.get((key.key_scheme, key.key_host, key.key_port))
+                if last_used is None or now - last_used > self.idle_timeout:
+                    del pools[key]  # Closes the pool's idle connections
+            for host_key, last_used in list(self._last_used.items()):
+                if now - last_used > self.idle_timeout:
+                    self._last_used.pop(host_key, None)
+        except KeyError:
+            pass
+        finally:
+            self._sweep_lock.release()
+
+    def close(self):
+        # Sessions come and go; the shared pools live as long as the process
+        pass
+
+    def shutdown(self):
+        super().close()
+
+dns_cache = DNSCache(ttl=dns_cache_ttl)
+dns_cache.install()
+shared_adapter = SharedHTTPAdapter(pool_max_hosts, pool_per_host, pool_idle_timeout)
+
+# Optional HTTP/2 transport (pip install 'httpx[http2]'); anything it cannot
+# handle goes through shared_adapter over HTTP/1.1
+http2_enabled = os.environ.get('HTTP2', '0') == '1'
+# Speak cleartext HTTP/2 (h2c) to http:// origins without an Upgrade round trip
+http2_prior_knowledge = os.environ.get('HTTP2_PRIOR_KNOWLEDGE', '0') == '1'
+asset_fetch_concurrency = int(os.environ.get('ASSET_FETCH_CONCURRENCY', 8))
+
+HTTP_VERSIONS = {10: '1.0', 11: '1.1', 20: '2'}
+
+def httpx_accept_encoding():
+    """Content codings httpx can decode with the packages installed here"""
+    encodings = ['gzip', 'deflate']
+    for coding, modules in (('br', ('brotli', 'brotlicffi')), ('zstd', ('zstandard',))):
+        if any(importlib.util.find_spec(module) for module in modules):
+            encodings.append(coding)
+    return ', '.join(encodings)
+
+class HTTPXRawResponse(io.RawIOBase):
+    """Minimal urllib3-style raw body over a streamed httpx response, so the
+    rest of the cloner keeps using requests.Response. It is a readable raw
+    stream too, so it can be wrapped in io.BufferedReader like urllib3's"""
+
+    def __init__(self, response):
+        super().__init__()
+        self._response = response
+        self._chunks = response.iter_bytes()
+        self._buffer = bytearray()
+        self.status = response.status_code
+        self.version = 20 if response.http_version == 'HTTP/2' else 11
+        # For requests' cookie extraction
+        self.msg = http.client.HTTPMessage()
+        for name, value in response.headers.multi_items():
+            self.msg[name] = value
+        self._original_response = self
+
+    def read(self, amt=None, decode_content=True):
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._response.close()
+                break
+            self._buffer += chunk
+        if amt is None:
+            amt = len(self._buffer)
+        data = bytes(self._buffer[:amt])
+        del self._buffer[:amt]
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._response.close()
+        super().close()
+
+    def release_conn(self):
+        self._response.close()
+
+class HTTP2Adapter(HTTPAdapter):
+    """Transport adapter backed by one shared httpx client. Concurrent requests
+    to an origin are multiplexed over a single HTTP/2 connection; origins that
+    only offer HTTP/1.1 are spoken to over HTTP/1.1 by httpx, and origins that
+    break the HTTP/2 exchange are handed to the fallback adapter from then on"""
+
+    hop_by_hop_headers = ('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade')
+
+    def __init__(self, fallback, http1=True, max_hosts=100, idle_timeout=90):
+        super().__init__()
+        self.fallback = fallback
+        self.http1 = http1
+        self.max_hosts = max_hosts
+        self.idle_timeout = idle_timeout
+        self.accept_encoding = httpx_accept_encoding()
+        self._http1_origins = set()
+        self._clients = {}
+        self._clients_lock = Lock()
+        self._client_for(True)  # Fails here, not mid-clone, when h2 is missing
+
+    def _client_for(self, verify):
+        """One client per CA bundle (requests passes REQUESTS_CA_BUNDLE as verify)"""
+        with self._clients_lock:
+            client = self._clients.get(verify)
+            if client is None:
+                ssl_context = SessionReusingSSLContext(max_hosts=self.max_hosts)
+                ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+                ca_bundle = DEFAULT_CA_BUNDLE_PATH if verify is True else verify
+                if os.path.isdir(ca_bundle):
+                    ssl_context.load_verify_locations(capath=ca_bundle)
+                else:
+                    ssl_context.load_verify_locations(cafile=ca_bundle)
+                # http1=False with http:// URLs means HTTP/2 with prior knowledge (h2c)
+                client = self._clients[verify] = httpx.Client(
+                    http1=self.http1, http2=True, verify=ssl_context, trust_env=False, follow_redirects=False,
+                    limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.max_hosts,
+                                        keepalive_expiry=self.idle_timeout))
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        origin = urlparse(request.url)[:2]
+        if not verify or cert or select_proxy(request.url, proxies) or origin in self._http1_origins:
+            return self.fallback.send(request, stream=stream, timeout=timeout, verify=verify,
+                                      cert=cert, proxies=proxies)
+        client = self._client_for(verify)
+
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in self.hop_by_hop_headers and name.lower() != 'accept-encoding']
+        headers.append(('Accept-Encoding', self.accept_encoding))
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        try:
+            response = client.send(
+                client.build_request(request.method, request.url, headers=headers, content=request.body,
+                                          timeout=httpx.Timeout(read, connect=connect)),
+                stream=True)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except (httpx.RemoteProtocolError, httpx.LocalProtocolError) as e:
+            print(f"HTTP/2 exchange with {origin[1]} failed ({e}); using HTTP/1.1 for this host")
+            self._http1_origins.add(origin)
+            return self.fallback.send(request, stream=stream, timeout=timeout, verify=verify,
+                                      cert=cert, proxies=proxies)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        return self.build_httpx_response(request, response)
+
+    def build_httpx_response(self, request, response):
+        headers = CaseInsensitiveDict()
+        for name, value in response.headers.multi_items():
+            # Join repeated fields the way urllib3 does
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+
+        resp = requests.Response()
+        resp.status_code = response.status_code
+        resp.headers = headers
+        resp.encoding = get_encoding_from_headers(headers)
+        resp.raw = HTTPXRawResponse(response)
+        resp.reason = response.reason_phrase
+        resp.url = request.url
+        extract_cookies_to_jar(resp.cookies, request, resp.raw)
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self):
+        # Shared by every session, like shared_adapter
+        pass
+
+    def shutdown(self):
+        for client in self._clients.values():
+            client.close()
+
+def create_http2_adapters():
+    """HTTP/2 adapters to mount by URL prefix; empty when HTTP/2 is off or unavailable"""
+    adapters = {}
+    if not http2_enabled:
+        return adapters
+    if httpx is None:
+        print("HTTP2=1 but httpx is not installed; using HTTP/1.1")
+        return adapters
+    try:
+        adapters['https://'] = HTTP2Adapter(shared_adapter, max_hosts=pool_max_hosts,
+                                            idle_timeout=pool_idle_timeout)
+        if http2_prior_knowledge:
+            adapters['http://'] = HTTP2Adapter(shared_adapter, http1=False, max_hosts=pool_max_hosts,
+                                               idle_timeout=pool_idle_timeout)
+    except ImportError as e:
+        # httpx installed without the h2 extra
+        print(f"HTTP/2 unavailable ({e}); using HTTP/1.1")
+        adapters.clear()
+    return adapters
+
+http2_adapters = create_http2_adapters()
+
+# Crash-safe clone checkpoints, removed once a clone finishes
+journal_dir = os.path.join(base_output_dir, '.journals')
+journal_fsync_interval = float(os.environ.get('JOURNAL_FSYNC_SECONDS', 1.0))
+
+class CloneJournal:
+    """Append-only JSON-lines checkpoint of one clone: the job, the page
+    frontier, and every saved resource and page with its local path.
+    Whoever has it open holds an exclusive lock, released if the process dies"""
+
+    def __init__(self, path, fsync_interval=1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._lock = Lock()
+        self._next_fsync = 0.0
+
+    @classmethod
+    def for_clone(cls, clone_name):
+        return cls(os.path.join(journal_dir, f"{clone_name}.jsonl"), journal_fsync_interval)
+
+    def open(self):
+        """Open for appending; False if another live process has it open"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        f = open(self.path, 'a+b')
+        if fcntl:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        # Terminate a record torn by a crash so the next one starts on its own line
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        self._file = f
+        return True
+
+    def read(self):
+        """Replay the journal into the state of the interrupted run"""
+        state = {'job_id': None, 'url': None, 'policy': None, 'tenant': None, 'main_saved': False,
+                 'frontier': [], 'resources': {}, 'pages': {}}
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return state
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn by a crash
+                kind = record.get('t')
+                if kind == 'res':
+                    state['resources'][record['u']] = record['p']
+                elif kind == 'page':
+                    state['pages'][record['u']] = record['p']
+                elif kind == 'frontier':
+                    state['frontier'] = record['u']
+                elif kind == 'frontier+':
+                    state['frontier'].extend(record['u'])
+                elif kind == 'main':
+                    state['main_saved'] = True
+                elif kind == 'start':
+                    state['job_id'], state['url'] = record.get('job'), record.get('u')
+                    state['policy'], state['tenant'] = record.get('policy'), record.get('tenant')
+        return state
+
+    def reset(self, record):
+        """Drop previous progress and start over with a single record"""
+        with self._lock:
+            self._file.truncate(0)
+        self.append(record)
+
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            now = time.monotonic()
+            if now >= self._next_fsync:
+                os.fsync(self._file.fileno())
+                self._next_fsync = now + self.fsync_interval
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def discard(self):
+        """Forget the checkpoint once the clone has finished"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+# Optional image optimization (needs Pillow), run in a process pool once a clone's assets are saved
+image_optimize = os.environ.get('IMAGE_OPTIMIZE', '0') == '1'
+image_max_dimension = int(os.environ.get('IMAGE_MAX_DIMENSION', 2560))
+image_quality = int(os.environ.get('IMAGE_QUALITY', 82))
+image_webp_variants = os.environ.get('IMAGE_WEBP', '0') == '1'
+image_optimize_workers = int(os.environ.get('IMAGE_OPTIMIZE_WORKERS', 0)) or None
+image_cache_dir = os.path.join(base_output_dir, '.image_cache')
+
+# Animated GIFs, SVGs and icons are left alone
+OPTIMIZABLE_IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+
+def _encode_image(image, image_format, quality, icc_profile):
+    buffer = io.BytesIO()
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True, icc_profile=icc_profile)
+    elif image_format == 'PNG':
+        image.save(buffer, 'PNG', optimize=True, icc_profile=icc_profile)
+    else:
+        image.save(buffer, 'WEBP', quality=quality, method=4, icc_profile=icc_profile)
+    return buffer.getvalue()
+
+def optimize_image(data, image_format, max_dimension, quality, webp):
+    """Re-encode image bytes without metadata, downscaled to max_dimension;
+    returns (bytes, webp variant bytes or None), each only if it is an improvement"""
+    with Image.open(io.BytesIO(data)) as original:
+        if getattr(original, 'is_animated', False):
+            return data, None
+        icc_profile = original.info.get('icc_profile')
+        # Bake the EXIF rotation into the pixels before the EXIF block is dropped
+        image = ImageOps.exif_transpose(original)
+        resized = max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        encoded = _encode_image(image, image_format, quality, icc_profile)
+        if not resized and len(encoded) >= len(data):
+            encoded = data
+        variant = None
+        if webp and image_format != 'WEBP':
+            variant = _encode_image(image, 'WEBP', quality, icc_profile)
+            if len(variant) >= len(encoded):
+                variant = None
+    return encoded, variant
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(stream_chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def optimize_image_files(paths, digest, max_dimension, quality, webp, cache_dir):
+    """Process-pool task: optimize image files sharing one content hash into the
+    cache shared across clones, keyed by that hash. The caller copies the
+    results returned ('encoded_path', 'variant_path') over the clone's files,
+    so the clone's own writes stay in its process"""
+    image_format = OPTIMIZABLE_IMAGE_FORMATS[os.path.splitext(paths[0])[1].lower()]
+    with open(paths[0], 'rb') as f:
+        data = f.read()
+    key = f"{digest}_{max_dimension}_{quality}_{image_format}"
+    cached_path = os.path.join(cache_dir, key)
+    # An empty variant file records that WebP was not smaller
+    variant_path = cached_path + '.webp'
+    cached = os.path.exists(cached_path) and (not webp or os.path.exists(variant_path))
+    if cached:
+        with open(cached_path, 'rb') as f:
+            encoded = f.read()
+        os.utime(cached_path)  # Recently used entries survive cleanup
+        variant = None
+        if webp:
+            with open(variant_path, 'rb') as f:
+                variant = f.read() or None
+    else:
+        encoded, variant = optimize_image(data, image_format, max_dimension, quality, webp)
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = [(cached_path, encoded)] + ([(variant_path, variant or b'')] if webp else [])
+        for target, payload in entries:
+            temp_path = f"{target}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, target)
+
+    return {'before': len(data), 'after': len(encoded),
+            'webp': len(variant) if variant is not None else None, 'cached': cached,
+            'encoded_path': cached_path if encoded != data else None,
+            'variant_path': variant_path if variant is not None else None}
+
+_image_pool = None
+_image_pool_lock = Lock()
+
+def image_pool():
+    """Shared process pool for image optimization, created on first use"""
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            # Never fork: the server's other threads may hold locks the child would inherit taken
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _image_pool = ProcessPoolExecutor(max_workers=image_optimize_workers,
+                                              mp_context=multiprocessing.get_context(method))
+        return _image_pool
+
+# Page discovery beyond the main page's links: robots.txt, sitemaps and a crawl budget
+crawl_max_pages = int(os.environ.get('CRAWL_MAX_PAGES', 10))
+crawl_rate = float(os.environ.get('CRAWL_RATE', 0))  # Page requests per second per domain; 0 = unpaced
+respect_robots = os.environ.get('RESPECT_ROBOTS', '1') == '1'
+robots_user_agent = os.environ.get('ROBOTS_USER_AGENT', 'WebClonerPro')
+robots_cache_ttl = float(os.environ.get('ROBOTS_CACHE_TTL', 3600))
+sitemap_discovery = os.environ.get('SITEMAP_DISCOVERY', '1') == '1'
+sitemap_max_urls = int(os.environ.get('SITEMAP_MAX_URLS', 50000))
+robots_max_bytes = 512 * 1024
+
+class RobotsCache:
+    """TTL-bounded cache of parsed robots.txt files, one per origin"""
+
+    def __init__(self, ttl=3600, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, url, fetch):
+        """RobotFileParser for url's origin; fetch(robots_url) returns a response"""
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc.lower()}"
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(origin)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(origin)
+                return entry[1]
+        parser = RobotFileParser(origin + '/robots.txt')
+        try:
+            response = fetch(origin + '/robots.txt')
+            if response.status_code in (401, 403):
+                parser.disallow_all = True
+            elif response.status_code >= 400:
+                parser.allow_all = True
+            else:
+                parser.parse(response.content[:robots_max_bytes].decode('utf-8', 'replace').splitlines())
+        except Exception as e:
+            # Unreachable robots.txt: crawl as if there were none, but ask again sooner
+            print(f"Error fetching robots.txt for {origin}: {e}")
+            parser.allow_all = True
+            now -= self.ttl * 0.9
+        with self._lock:
+            self._entries[origin] = (now + self.ttl, parser)
+            self._entries.move_to_end(origin)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return parser
+
+robots_cache = RobotsCache(ttl=robots_cache_ttl)
+
+def _xml_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def iter_sitemap(url, fetch, max_urls=50000, max_depth=2):
+    """Yield (page_url, priority) from a sitemap or sitemap index, parsing the XML
+    (gzipped or not) as it streams in; fetch(url) returns a streamed response"""
+    remaining = [max_urls]
+    
+    def walk(sitemap_url, depth):
+        try:
+            response = fetch(sitemap_url)
+        except Exception as e:
+            print(f"Error fetching sitemap {sitemap_url}: {e}")
+            return
+        nested = []
+        try:
+            if response.status_code != 200:
+                return
+            response.raw.decode_content = True
+            response.raw.auto_close = False  # Let the buffered reader see EOF rather than a closed file
+            source = io.BufferedReader(response.raw, stream_chunk_size)
+            if source.peek(2)[:2] == b'\x1f\x8b':
+                source = gzip.GzipFile(fileobj=source)
+            root = None
+            for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+                if root is None:
+                    root = elem
+                if event != 'end' or _xml_name(elem.tag) not in ('url', 'sitemap'):
+                    continue
+                fields = {_xml_name(child.tag): (child.text or '').strip() for child in elem}
+                loc = fields.get('loc')
+                if loc and _xml_name(elem.tag) == 'sitemap':
+                    nested.append(loc)
+                elif loc:
+                    try:
+                        priority = min(max(float(fields.get('priority') or 0.5), 0.0), 1.0)
+                    except ValueError:
+                        priority = 0.5
+                    yield loc, priority
+                    remaining[0] -= 1
+                    if remaining[0] <= 0:
+                        return
+                # Finished entries are dropped so memory stays flat however long the file is
+                root.clear()
+        except Exception as e:
+            print(f"Error reading sitemap {sitemap_url}: {e}")
+        finally:
+            response.close()
+        if depth < max_depth:
+            for loc in nested:
+                if remaining[0] <= 0:
+                    return
+                yield from walk(loc, depth + 1)
+    
+    return walk(url, 0)
+
+# Crawl bookkeeping: Python sets and dicts of URLs, or fingerprints and a spill
+# file whose memory use does not grow with the crawl ('auto' picks by page budget)
+crawl_state = os.environ.get('CRAWL_STATE', 'auto')
+crawl_state_compact_pages = int(os.environ.get('CRAWL_STATE_COMPACT_PAGES', 10000))
+crawl_store_cache_kib = int(os.environ.get('CRAWL_STORE_CACHE_KIB', 2048))
+
+def url_fingerprint(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+class FingerprintSet:
+    """Set of URLs kept as 64-bit hashes: a sorted array (8 bytes per URL) plus
+    a small buffer of recent additions merged in as it grows. A false positive
+    takes two URLs with the same 64-bit hash"""
+
+    def __init__(self, min_buffer=4096):
+        self.min_buffer = min_buffer
+        self._sorted = array('Q')
+        self._recent = set()
+        self._lock = Lock()
+
+    def _has(self, fingerprint):
+        if fingerprint in self._recent:
+            return True
+        index = bisect.bisect_left(self._sorted, fingerprint)
+        return index < len(self._sorted) and self._sorted[index] == fingerprint
+
+    def add(self, key):
+        fingerprint = url_fingerprint(key)
+        with self._lock:
+            if self._has(fingerprint):
+                return
+            self._recent.add(fingerprint)
+            # Merging costs O(n); a buffer growing with the array keeps it amortized O(log n)
+            if len(self._recent) >= max(self.min_buffer, len(self._sorted) // 8):
+                self._sorted = array('Q', sorted(itertools.chain(self._sorted, self._recent)))
+                self._recent = set()
+
+    def __contains__(self, key):
+        fingerprint = url_fingerprint(key)
+        with self._lock:
+            return self._has(fingerprint)
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+class CrawlStore:
+    """Per-clone scratch database for crawl state that would not fit in memory:
+    a private temporary SQLite file, kept mostly in a fixed page cache and
+    deleted when closed"""
+
+    def __init__(self, cache_kib=2048):
+        self._db = sqlite3.connect('', check_same_thread=False)
+        self._db.execute(f'PRAGMA cache_size=-{int(cache_kib)}')
+        self._lock = Lock()
+        self._tables = itertools.count()
+
+    def table(self, columns):
+        """Create a table with a fresh name and return the name"""
+        name = f"t{next(self._tables)}"
+        self.execute(f'CREATE TABLE {name} ({columns})')
+        return name
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def executemany(self, sql, rows):
+        with self._lock:
+            self._db.executemany(sql, rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class SpilledUrlMap:
+    """URL -> clone path mapping held in a CrawlStore rather than in memory"""
+
+    def __init__(self, store):
+        self.store = store
+        self.table = store.table('url TEXT PRIMARY KEY, path TEXT NOT NULL')
+
+    def __setitem__(self, key, path):
+        self.store.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)', (key, path))
+
+    def get(self, key, default=None):
+        rows = self.store.execute(f'SELECT path FROM {self.table} WHERE url = ?', (key,))
+        return rows[0][0] if rows else default
+
+    def __getitem__(self, key):
+        path = self.get(key)
+        if path is None:
+            raise KeyError(key)
+        return path
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.store.execute(f'SELECT count(*) FROM {self.table}')[0][0]
+
+    def items(self, batch=1000):
+        last = ''
+        while True:
+            rows = self.store.execute(f'SELECT url, path FROM {self.table} WHERE url > ? ORDER BY url LIMIT ?',
+                                      (last, batch))
+            yield from rows
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def values(self):
+        return (path for _, path in self.items())
+
+class SpilledList:
+    """Append-only list of URLs in a CrawlStore, iterable any number of times"""
+
+    def __init__(self, store, urls=()):
+        self.store = store
+        self.table = store.table('url TEXT NOT NULL')
+        self.extend(urls)
+
+    def extend(self, urls):
+        for chunk in iter(lambda: list(itertools.islice(urls, 1000)), []):
+            self.store.executemany(f'INSERT INTO {self.table} VALUES (?)', [(url,) for url in chunk])
+
+    def __len__(self):
+        return self.store.execute(f'SELECT count(*) FROM {self.table}')[0][0]
+
+    def __iter__(self, batch=1000):
+        last = 0
+        while True:
+            rows = self.store.execute(f'SELECT rowid, url FROM {self.table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                      (last, batch))
+            for _, url in rows:
+                yield url
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+class CrawlScheduler:
+    """Priority frontier of pages with a per-domain page budget and page pacing.
+    Given a CrawlStore, the frontier and the plan live there instead of in memory"""
+
+    def __init__(self, budget=10, rate=0, store=None):
+        self.budget = budget
+        self.rate = rate
+        self.store = store
+        self._heap = []
+        self._queued = set() if store is None else FingerprintSet()
+        self._order = itertools.count()
+        if store is not None:
+            self._frontier = store.table('rank REAL NOT NULL, seq INTEGER NOT NULL, url TEXT NOT NULL')
+            store.execute(f'CREATE INDEX {self._frontier}_order ON {self._frontier} (rank, seq)')
+        self._spent = {}
+        self._next_request = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _domain(url):
+        return urlparse(url).netloc.lower()
+
+    def spend(self, url):
+        """Count a page fetched outside the scheduler against its domain's budget"""
+        with self._lock:
+            domain = self._domain(url)
+            self._spent[domain] = self._spent.get(domain, 0) + 1
+
+    def remaining(self, url):
+        with self._lock:
+            return max(self.budget - self._spent.get(self._domain(url), 0), 0)
+
+    def add(self, url, priority=0.5):
+        """Queue a page; higher priority is fetched first, ties in insertion order"""
+        key = canonical_url(url)
+        with self._lock:
+            if key not in self._queued:
+                self._queued.add(key)
+                if self.store is None:
+                    heapq.heappush(self._heap, (-priority, next(self._order), url))
+                else:
+                    self.store.execute(f'INSERT INTO {self._frontier} VALUES (?, ?, ?)',
+                                       (-priority, next(self._order), url))
+
+    def _pop_all(self, batch=1000):
+        if self.store is None:
+            while self._heap:
+                yield heapq.heappop(self._heap)[2]
+            return
+        while True:
+            rows = self.store.execute(f'SELECT rowid, url FROM {self._frontier} ORDER BY rank, seq LIMIT ?', (batch,))
+            if not rows:
+                return
+            self.store.executemany(f'DELETE FROM {self._frontier} WHERE rowid = ?', [(row[0],) for row in rows])
+            for _, url in rows:
+                yield url
+
+    def plan(self, allowed=None):
+        """Pop queued pages in priority order until each domain's budget is spent"""
+        planned = [] if self.store is None else SpilledList(self.store)
+
+        def within_budget():
+            for url in self._pop_all():
+                domain = self._domain(url)
+                if self._spent.get(domain, 0) >= self.budget or (allowed and not allowed(url)):
+                    continue
+                self._spent[domain] = self._spent.get(domain, 0) + 1
+                yield url
+        with self._lock:
+            planned.extend(within_budget())
+        return planned
+
+    def throttle(self, url):
+        """Sleep until the configured page rate allows another page of the domain"""
+        if not self.rate:
+            return
+        domain = self._domain(url)
+        with self._lock:
+            interval = 1.0 / self.rate
+            now = time.monotonic()
+            start = max(now, self._next_request.get(domain, now))
+            self._next_request[domain] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+# Adaptive per-host pacing of every request, shared by all clones in the process
+host_initial_concurrency = int(os.environ.get('HOST_INITIAL_CONCURRENCY', asset_fetch_concurrency))
+host_max_concurrency = int(os.environ.get('HOST_MAX_CONCURRENCY', 32))
+host_max_backoff = float(os.environ.get('HOST_MAX_BACKOFF', 120))  # Longest Retry-After honored, seconds
+host_default_backoff = 1.0  # Pause after a 429/503 that has no Retry-After, seconds
+host_rate_increase = 0.2  # Requests/s added to a paced host's rate per successful response
+host_latency_factor = 3.0  # Latency this many times the host's best means it is struggling
+SLOW_DOWN_STATUSES = (429, 503)
+OVERLOAD_STATUSES = SLOW_DOWN_STATUSES + (502, 504)
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    value = (value or '').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+class RateLimitedError(Exception):
+    """The origin answered 429/503; retried once the host limiter lets requests through again"""
+
+class _HostState:
+    def __init__(self, limit):
+        self.limit = float(limit)  # Concurrent requests allowed
+        self.in_flight = 0
+        self.waiting = 0  # Requests queued for a slot, holding this state
+        self.interval = 0.0  # Spacing of request starts once congested; 0 = unpaced
+        self.crawl_delay = 0.0
+        self.next_start = 0.0
+        self.blocked_until = 0.0
+        self.latency = None  # EWMA of response latency
+        self.best_latency = None
+        self.last_decrease = 0.0
+
+class HostLimiter:
+    """AIMD concurrency and rate control per host. Each successful response
+    widens the host's concurrency window by 1/window (one request per round
+    trip); 429/503, overload 5xx, connection errors or latency well above the
+    host's best halve it, at most once per round trip. Congestion also paces
+    request starts at half the throughput the window allowed (Little's law),
+    a rate that then grows additively until pacing is no longer the limit.
+    Retry-After and robots.txt crawl-delay are floors the adaptation never
+    goes below. Latency is time to headers, so big bodies never look like
+    congestion. A streamed body is read after its slot is released: a
+    streamed page is read while its assets are fetched from the same host,
+    and holding its slot could deadlock a window of one"""
+
+    def __init__(self, initial=8, maximum=32, max_backoff=120, max_hosts=1024):
+        self.initial = max(1, initial)
+        self.maximum = max(self.initial, maximum)
+        self.max_backoff = max_backoff
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+        self._cond = Condition()
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState(self.initial)
+            if len(self._hosts) > self.max_hosts:
+                # A host in use or backing off keeps its state, or its next request would start afresh
+                now = time.monotonic()
+                idle = [h for h, s in self._hosts.items()
+                        if not s.in_flight and not s.waiting and s.blocked_until <= now]
+                for h in idle[:len(self._hosts) - self.max_hosts]:
+                    del self._hosts[h]
+        self._hosts.move_to_end(host)
+        return state
+
+    def set_crawl_delay(self, url, delay):
+        with self._cond:
+            self._state(urlparse(url).netloc.lower()).crawl_delay = float(delay or 0)
+
+    @contextmanager
+    def slot(self, url):
+        """Hold one of the host's request slots; the body reports the outcome
+        through the yielded callback: done(response) or done(error=True)"""
+        host = urlparse(url).netloc.lower()
+        with self._cond:
+            state = self._state(host)
+            state.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = max(state.blocked_until, state.next_start) - now
+                    if wait <= 0 and state.in_flight < int(state.limit):
+                        break
+                    self._cond.wait(wait if wait > 0 else 1.0)
+            finally:
+                state.waiting -= 1
+            state.in_flight += 1
+            state.next_start = now + max(state.interval, state.crawl_delay)
+        start = time.monotonic()
+        outcome = {}
+
+        def done(response=None, error=False):
+            outcome.update(response=response, error=error)
+        try:
+            yield done
+        except Exception:
+            outcome.setdefault('error', True)
+            raise
+        finally:
+            response = outcome.get('response')
+            elapsed = getattr(response, 'elapsed', None)  # requests' time to headers
+            latency = elapsed.total_seconds() if elapsed is not None else time.monotonic() - start
+            self._release(state, latency, response, outcome.get('error', True))
+
+    def _release(self, state, latency, response, error):
+        with self._cond:
+            state.in_flight -= 1
+            now = time.monotonic()
+            status = response.status_code if response is not None else None
+            if status in SLOW_DOWN_STATUSES:
+                retry_after = parse_retry_after(response.headers.get('retry-after'))
+                if retry_after is None:
+                    retry_after = host_default_backoff
+                state.blocked_until = max(state.blocked_until, now + min(retry_after, self.max_backoff))
+            congested = error or status in OVERLOAD_STATUSES
+            slow = False
+            if not congested:
+                state.latency = latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+                # The best latency slowly forgets, so a host that got slower for good is not punished forever
+                state.best_latency = min(state.best_latency * 1.01 if state.best_latency else state.latency,
+                                         state.latency)
+                slow = (state.latency > state.best_latency * host_latency_factor
+                        and state.latency - state.best_latency > 0.25)
+            round_trip = state.latency or 1.0
+            if congested or slow:
+                if now - state.last_decrease >= round_trip:
+                    state.last_decrease = now
+                    state.limit = max(1.0, state.limit / 2)
+                    if congested:
+                        state.interval = max(state.interval * 2, round_trip / state.limit)
+            else:
+                state.limit = min(float(self.maximum), state.limit + 1.0 / state.limit)
+                if state.interval:
+                    rate = 1.0 / state.interval + host_rate_increase
+                    # Pacing is lifted once the window alone would keep requests slower
+                    state.interval = 0.0 if rate * round_trip >= state.limit else 1.0 / rate
+            self._cond.notify_all()
+
+    def snapshot(self, url):
+        """Current limits of url's host, for logs and tests"""
+        with self._cond:
+            state = self._state(urlparse(url).netloc.lower())
+            return {'concurrency': int(state.limit), 'in_flight': state.in_flight,
+                    'rate': 1.0 / state.interval if state.interval else None,
+                    'crawl_delay': state.crawl_delay, 'latency': state.latency,
+                    'blocked_for': max(state.blocked_until - time.monotonic(), 0.0)}
+
+host_limiter = HostLimiter(host_initial_concurrency, host_max_concurrency, host_max_backoff)
+
+# Headless rendering for pages that build their DOM client-side (needs playwright)
+render_js = os.environ.get('RENDER_JS', '0') == '1'
+render_browsers = int(os.environ.get('RENDER_BROWSERS', 2))
+render_timeout = float(os.environ.get('RENDER_TIMEOUT', 30))
+render_max_uses = int(os.environ.get('RENDER_MAX_USES', 50))  # Renders before a browser is relaunched
+render_capture_max_bytes = int(os.environ.get('RENDER_CAPTURE_MAX_BYTES', 128 * 1024 * 1024))
+render_scroll_steps = 8
+
+def gevent_patched():
+    """True once gevent has monkey-patched threading (as the gunicorn launcher does).
+    Playwright's sync API then runs on greenlets, which it does not support"""
+    monkey = sys.modules.get('gevent.monkey')
+    return bool(monkey and monkey.is_module_patched('threading'))
+
+class BrowserPool:
+    """Reusable headless Chromium instances. Playwright's sync API is bound to the
+    thread that started it, so each browser lives on its own thread and clone
+    threads hand it render jobs through a queue"""
+
+    def __init__(self, size=2, max_uses=50, user_agent=None):
+        self.size = max(1, size)
+        self.max_uses = max_uses
+        self.user_agent = user_agent
+        self._jobs = queue.Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def render(self, url, timeout=30):
+        """Load url, let its scripts and lazy loaders run, and return
+        {'url', 'status', 'html', 'resources': {url: (body, content_type)}}"""
+        job = Future()
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.size:
+                thread = Thread(target=self._run, name='render-browser', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            # Queued under the lock: a thread failing its launch either sees the job or is replaced
+            self._jobs.put((job, url, timeout))
+        return job.result(timeout + 30)
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+
+    def _run(self):
+        browser = None
+        try:
+            with sync_playwright() as playwright:
+                while True:
+                    browser = None
+                    browser = playwright.chromium.launch(headless=True)
+                    try:
+                        context = browser.new_context(user_agent=self.user_agent)
+                        page = context.new_page()
+                        for _ in range(self.max_uses):
+                            job = self._jobs.get()
+                            if job is None:
+                                return
+                            if not self._serve(page, *job):
+                                break  # The page crashed; start over with a fresh browser
+                    finally:
+                        browser.close()
+        except Exception as e:
+            print(f"Render browser stopped: {e}")
+            if browser is None:
+                # Typically no browser installed: fail the waiting jobs rather than let them time out
+                self._fail_pending(e)
+                return
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None and job[0].set_running_or_notify_cancel():
+                job[0].set_exception(e)
+
+    def _fail_pending(self, error):
+        """Fail every queued job, from a thread that could not start a browser"""
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread is not current_thread()]
+            stops = 0
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stops += 1
+                elif job[0].set_running_or_notify_cancel():
+                    job[0].set_exception(error)
+            # Put back the shutdown sentinels of the other threads; one was for this thread
+            for _ in range(max(stops - 1, 0)):
+                self._jobs.put(None)
+
+    def _serve(self, page, job, url, timeout):
+        if not job.set_running_or_notify_cancel():
+            return True
+        resources = {}
+        budget = [render_capture_max_bytes]
+
+        def capture(route):
+            # Fetch on the page's behalf so every body it loads is kept
+            request = route.request
+            try:
+                response = route.fetch()
+                body = response.body()
+            except PlaywrightError:
+                route.abort()
+                return
+            if request.method == 'GET' and response.status == 200 and len(body) <= budget[0]:
+                budget[0] -= len(body)
+                resources[request.url] = (body, response.headers.get('content-type', ''))
+            route.fulfill(response=response, body=body)
+
+        healthy = True
+        try:
+            page.route('**/*', capture)
+            deadline = time.monotonic() + timeout
+            response = page.goto(url, wait_until='load', timeout=timeout * 1000)
+            # Scroll through the page so lazy images and infinite lists load their content
+            for step in range(1, render_scroll_steps + 1):
+                if time.monotonic() >= deadline:
+                    break
+                page.evaluate('f => window.scrollTo(0, document.body.scrollHeight * f)', step / render_scroll_steps)
+                page.wait_for_timeout(100)
+            try:
+                page.wait_for_load_state('networkidle', timeout=max(deadline - time.monotonic(), 0.001) * 1000)
+            except PlaywrightTimeoutError:
+                pass
+            job.set_result({'url': page.url, 'status': response.status if response else 0,
+                            'html': page.content(), 'resources': resources})
+        except Exception as e:
+            job.set_exception(e)
+            healthy = not page.is_closed()
+        finally:
+            try:
+                page.unroute('**/*', capture)
+                page.goto('about:blank')
+                page.context.clear_cookies()
+            except Exception:
+                healthy = False
+        return healthy
+
+_render_pool = None
+_render_pool_lock = Lock()
+
+def render_pool():
+    """Shared browser pool, started on first use"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = BrowserPool(render_browsers, render_max_uses, BROWSER_USER_AGENT)
+        return _render_pool
+
+# Clone output: a directory tree zipped once complete, one append-only WARC, or one ZIP written as it downloads
+output_format = os.environ.get('OUTPUT_FORMAT', 'dir')
+OUTPUT_FORMATS = ('dir', 'warc', 'zip')
+archive_only = os.environ.get('ARCHIVE_ONLY', '0') == '1'  # Directory clones keep just their ZIP once it is built
+archive_spool_bytes = 1024 * 1024  # Bodies of unknown length are buffered in memory up to this, then on disk
+# Hop-by-hop and coding headers describe the wire format, not the stored (decoded) payload
+ARCHIVE_RENAMED_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length')
+
+def _body_chunks(body):
+    return [body] if isinstance(body, (bytes, bytearray)) else body
+
+# Disk quotas (bytes, 0 = none) per clone and per tenant, the client a clone was requested by.
+# Past a soft quota a clone is trimmed: no more pages or heavy assets; past a hard one it is aborted
+clone_soft_quota_bytes = int(os.environ.get('CLONE_SOFT_QUOTA_BYTES', 0))
+clone_hard_quota_bytes = int(os.environ.get('CLONE_HARD_QUOTA_BYTES', 0))
+tenant_soft_quota_bytes = int(os.environ.get('TENANT_SOFT_QUOTA_BYTES', 0))
+tenant_hard_quota_bytes = int(os.environ.get('TENANT_HARD_QUOTA_BYTES', 0))
+tenant_header = os.environ.get('TENANT_HEADER', 'X-Tenant-ID')
+# Addresses of the reverse proxies that set the tenant header; from anyone else it is
+# ignored, since a client could otherwise pick its own tenant. Empty: never trusted
+tenant_trusted_proxies = {p.strip() for p in os.environ.get('TENANT_TRUSTED_PROXIES', '').split(',') if p.strip()}
+QUOTA_TRIMMED_TYPES = ('image', 'media', 'font', 'other')
+# Disk write throughput shared by all clones in the process (0 = unthrottled)
+disk_write_bytes_per_sec = int(os.environ.get('DISK_WRITE_BYTES_PER_SEC', 0))
+disk_write_burst_bytes = int(os.environ.get('DISK_WRITE_BURST_BYTES', 8 * 1024 * 1024))
+
+class QuotaExceededError(Exception):
+    """A clone or its tenant went over a hard disk quota"""
+
+class WriteRateLimiter:
+    """Token bucket for disk writes, kept as the time it next has a full
+    token's worth (GCRA). Writers reserve their bytes in arrival order, so
+    parallel clones get the bandwidth in turn rather than whoever wakes first"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._free_at = 0.0
+        self._lock = Lock()
+
+    def consume(self, nbytes):
+        if not self.rate or not nbytes:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Idle time refills the bucket, up to burst bytes
+            self._free_at = max(self._free_at, now - self.burst / self.rate) + nbytes / self.rate
+            wait = self._free_at - now
+        if wait > 0:
+            time.sleep(wait)
+
+disk_write_limiter = WriteRateLimiter(disk_write_bytes_per_sec, disk_write_burst_bytes)
+
+class DiskUsageLedger:
+    """Bytes on disk per clone and the tenant that owns it, in a SQLite file
+    shared by the web tier and workers"""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = Lock()
+
+    def _run(self, sql, params=()):
+        with self._lock:
+            if self._db is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('CREATE TABLE IF NOT EXISTS clones (name TEXT PRIMARY KEY, tenant TEXT, bytes INTEGER NOT NULL)')
+                self._db = db
+            with self._db:
+                return self._db.execute(sql, params).fetchall()
+
+    def record(self, name, tenant, nbytes):
+        self._run('INSERT OR REPLACE INTO clones VALUES (?, ?, ?)', (name, tenant, nbytes))
+
+    def remove(self, name):
+        self._run('DELETE FROM clones WHERE name = ?', (name,))
+
+    def tenant_bytes(self, tenant, exclude=None):
+        return self._run('SELECT coalesce(sum(bytes), 0) FROM clones WHERE tenant = ? AND name != ?',
+                         (tenant, exclude or ''))[0][0]
+
+# Kept outside base_output_dir, which /download serves. Multi-node deployments point
+# USAGE_LEDGER_PATH at storage shared by all workers, like CLONES_DIR
+usage_ledger_path = os.environ.get('USAGE_LEDGER_PATH', os.path.normpath(base_output_dir) + '.usage.sqlite')
+disk_usage_ledger = DiskUsageLedger(usage_ledger_path)
+
+class CloneDiskBudget:
+    """Bytes one clone writes, checked against its own and its tenant's quotas.
+    Every write is charged here before it reaches the disk, and goes through
+    the shared write-rate limiter"""
+
+    def __init__(self, name, tenant=None, ledger=None, limiter=None, flush_bytes=1024 * 1024):
+        self.name = name
+        self.tenant = tenant
+        self.ledger = ledger
+        self.limiter = limiter
+        self.flush_bytes = flush_bytes
+        self.used = 0
+        self.trimming = False
+        self.exhausted = None  # Reason the hard quota stopped the clone
+        self._flushed = 0
+        self._tenant_used = self._other_tenant_bytes()
+        self._lock = Lock()
+
+    def _other_tenant_bytes(self):
+        if not (self.ledger and self.tenant and (tenant_soft_quota_bytes or tenant_hard_quota_bytes)):
+            return 0
+        return self.ledger.tenant_bytes(self.tenant, exclude=self.name)
+
+    def charge(self, nbytes):
+        """Account for nbytes about to be written; raises QuotaExceededError past a hard quota"""
+        if self.exhausted:
+            raise QuotaExceededError(self.exhausted)
+        if self.limiter:
+            self.limiter.consume(nbytes)
+        with self._lock:
+            self.used += nbytes
+            flush = self.used - self._flushed >= self.flush_bytes
+            if flush:
+                self._flushed = self.used
+        if flush and self.ledger:
+            self.ledger.record(self.name, self.tenant, self.used)
+            self._tenant_used = self._other_tenant_bytes()  # Other clones of the tenant keep writing too
+        tenant_used = self._tenant_used + self.used
+        if clone_hard_quota_bytes and self.used > clone_hard_quota_bytes:
+            self.exhausted = f"Clone disk quota of {clone_hard_quota_bytes} bytes exceeded"
+        elif tenant_hard_quota_bytes and self.tenant and tenant_used > tenant_hard_quota_bytes:
+            self.exhausted = f"Disk quota of {tenant_hard_quota_bytes} bytes exceeded for this client"
+        if self.exhausted:
+            raise QuotaExceededError(self.exhausted)
+        if ((clone_soft_quota_bytes and self.used > clone_soft_quota_bytes)
+                or (tenant_soft_quota_bytes and self.tenant and tenant_used > tenant_soft_quota_bytes)):
+            self.trimming = True
+
+    def finish(self, nbytes):
+        """Record the clone's final size on disk"""
+        self.used = nbytes
+        if self.ledger:
+            self.ledger.record(self.name, self.tenant, nbytes)
+
+    def release(self, nbytes):
+        """Account for nbytes freed, e.g. by a file being rewritten"""
+        with self._lock:
+            self.used = max(self.used - nbytes, 0)
+            self._flushed = min(self._flushed, self.used)
+
+class ChargedWriter(io.RawIOBase):
+    """Raw file that charges a CloneDiskBudget for every write before it reaches the disk"""
+
+    def __init__(self, raw, disk):
+        super().__init__()
+        self._raw = raw
+        self._disk = disk
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._disk:
+            self._disk.charge(len(b))
+        return self._raw.write(b)
+
+    def seekable(self):
+        return self._raw.seekable()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._raw.seek(offset, whence)
+
+    def tell(self):
+        return self._raw.tell()
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+def open_charged(path, disk):
+    """Buffered binary file for writing, charged to disk (a CloneDiskBudget or None)"""
+    return io.BufferedWriter(ChargedWriter(open(path, 'wb', buffering=0), disk), stream_chunk_size)
+
+# Already compressed: stored as-is in ZIPs, which is faster to write and lets the preview sendfile them
+ZIP_STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.woff', '.woff2',
+                         '.mp3', '.mp4', '.m4a', '.ogg', '.webm', '.zip', '.gz', '.br'}
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+def zip_compress_type(path):
+    if os.path.splitext(path)[1].lower() in ZIP_STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+class CloneManifest:
+    """SHA-256 and size of every file of a clone, recorded as it is written.
+    Appended to a JSON-lines sidecar so a resumed clone keeps what it had, and
+    compacted to the files that made it into the clone on close"""
+
+    suffix = '.manifest'
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self.load(path)
+        self._lock = Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def load(path):
+        entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Torn last line
+                    entries[entry['path']] = entry
+        return entries
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def record(self, path, sha256, size, url=None, **extra):
+        entry = {'path': path, 'sha256': sha256, 'size': size}
+        if url:
+            entry['url'] = url
+        entry.update(extra)
+        with self._lock:
+            self.entries[path] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self, paths):
+        """Rewrite the sidecar with just the entries of paths"""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.close()
+            self.entries = {path: entry for path, entry in self.entries.items() if path in paths}
+            tmp_path = f"{self.path}.{uuid.uuid4().hex}.part"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for path in sorted(self.entries):
+                    f.write(json.dumps(self.entries[path]) + '\n')
+            os.replace(tmp_path, self.path)
+
+class DirectoryOutput:
+    """Clone written as a directory tree; the ZIP is built from it at the end"""
+
+    kind = 'dir'
+    records_responses = False
+    disk = None  # CloneDiskBudget charged for every write
+
+    def __init__(self, base_dir, name):
+        self.root = os.path.join(base_dir, name)
+        self._lock = Lock()
+        os.makedirs(os.path.join(self.root, 'assets'), exist_ok=True)
+        self.manifest = CloneManifest(os.path.join(base_dir, name + CloneManifest.suffix))
+
+    def _record(self, path, sha256, size, url=None):
+        # Files are identified by size and mtime so close() only rehashes what changed since
+        self.manifest.record(path, sha256, size, url, mtime=os.stat(os.path.join(self.root, path)).st_mtime_ns)
+
+    def exists(self, path):
+        return os.path.isfile(os.path.join(self.root, path))
+
+    def claim(self, path):
+        """Reserve a free file name like path, numbered if taken"""
+        name, ext = os.path.splitext(path)
+        candidate, counter = path, 1
+        with self._lock:
+            while os.path.exists(os.path.join(self.root, candidate)):
+                candidate = f"{name}_{counter}{ext}"
+                counter += 1
+            open(os.path.join(self.root, candidate), 'wb').close()  # Claim the name before other threads look
+        return candidate
+
+    def save(self, path, body, url=None, response=None, max_bytes=None):
+        """Store a body (bytes or an iterable of chunks) at path; returns its size,
+        or None, keeping nothing, once it grows past max_bytes. A None path only
+        records the response, which a directory has no place for"""
+        if path is None:
+            return None
+        file_path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        digest = hashlib.sha256()
+        size = charged = 0
+        with open(file_path, 'wb') as f:
+            for chunk in _body_chunks(body):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    break
+                if self.disk:
+                    self.disk.charge(len(chunk))
+                    charged += len(chunk)
+                digest.update(chunk)
+                f.write(chunk)
+        if max_bytes and size > max_bytes:
+            os.remove(file_path)
+            if self.disk:
+                self.disk.release(charged)
+            return None
+        self._record(path, digest.hexdigest(), size, url)
+        return size
+
+    def save_by_digest(self, directory, ext, chunks, mime_type=None):
+        """Store chunks under a name derived from their SHA-256; returns
+        (path, size, created)"""
+        digest = hashlib.sha256()
+        size = charged = 0
+        tmp_path = os.path.join(self.root, directory, f".{uuid.uuid4().hex}.part")
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    if self.disk:
+                        self.disk.charge(len(chunk))
+                        charged += len(chunk)
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            path = f"{directory}/data_{digest.hexdigest()[:16]}{ext}"
+            if self.exists(path):
+                # Same payload under a different encoding, or saved by another thread
+                return path, size, False
+            os.replace(tmp_path, os.path.join(self.root, path))
+            self._record(path, digest.hexdigest(), size)
+            return path, size, True
+        finally:
+            if os.path.exists(tmp_path):
+                # A duplicate, or a failed write: nothing of it stays on disk
+                os.remove(tmp_path)
+                if self.disk:
+                    self.disk.release(charged)
+
+    @contextmanager
+    def open_text(self, path, url=None, encoding='utf-8', errors='strict', newline=None):
+        """Text file for a document the clone rewrote"""
+        file_path = os.path.join(self.root, path)
+        with io.TextIOWrapper(open_charged(file_path, self.disk), encoding=encoding, errors=errors,
+                              newline=newline) as f:
+            yield f
+        self._record(path, file_sha256(file_path), os.path.getsize(file_path), url)
+
+    def tee(self, chunks, url, response):
+        """Pass a streamed body through, recording the original response if the format keeps them"""
+        return chunks
+
+    def close(self):
+        """Bring the manifest up to date with the tree: files changed after they
+        were saved (optimized images, WebP variants, a resumed clone) are rehashed"""
+        if self.manifest.closed:
+            return
+        paths = set()
+        for root, dirs, files in os.walk(self.root):
+            for file in files:
+                if file.endswith('.part'):
+                    continue
+                file_path = os.path.join(root, file)
+                path = os.path.relpath(file_path, self.root).replace(os.sep, '/')
+                stat = os.stat(file_path)
+                entry = self.manifest.entries.get(path)
+                if not entry or entry['size'] != stat.st_size or entry.get('mtime') != stat.st_mtime_ns:
+                    self.manifest.record(path, file_sha256(file_path), stat.st_size,
+                                         entry and entry.get('url'), mtime=stat.st_mtime_ns)
+                paths.add(path)
+        self.manifest.close(paths)
+
+class WarcOutput:
+    """Clone written as a single append-only, per-record gzipped WARC while it is
+    downloaded. Responses keep their status line and headers; rewritten pages
+    are conversion records. A JSON-lines sidecar maps clone paths to byte
+    offsets so the preview can serve straight from the archive"""
+
+    kind = 'warc'
+    records_responses = True
+    disk = None
+    suffix = '.warc.gz'
+    index_suffix = '.warc.idx'
+
+    def __init__(self, base_dir, name):
+        self.path = os.path.join(base_dir, name + self.suffix)
+        self.index_path = os.path.join(base_dir, name + self.index_suffix)
+        self.paths = {}
+        self.claimed = set()
+        self._record_ids = {}
+        self._lock = Lock()
+        end = 0
+        # Reopened by a resumed clone: keep every record the index vouches for
+        for entry in WarcArchive.read_index(self.index_path):
+            end = max(end, entry['offset'] + entry['length'])
+            if entry.get('path'):
+                self.paths[entry['path']] = entry
+            if entry.get('url') and entry.get('id'):
+                self._record_ids[entry['url']] = entry['id']
+        self._file = open(self.path, 'ab')
+        self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+        self._index = open(self.index_path, 'a', encoding='utf-8')
+        self.manifest = CloneManifest(os.path.join(base_dir, name + CloneManifest.suffix))
+        if not end:
+            self._append('warcinfo', None, [b'software: Web Cloner Pro\r\nformat: WARC File Format 1.1\r\n'],
+                         content_type='application/warc-fields')
+
+    def exists(self, path):
+        return path in self.paths
+
+    def claim(self, path):
+        name, ext = os.path.splitext(path)
+        candidate, counter = path, 1
+        with self._lock:
+            while candidate in self.paths or candidate in self.claimed:
+                candidate = f"{name}_{counter}{ext}"
+                counter += 1
+            self.claimed.add(candidate)
+        return candidate
+
+    def save(self, path, body, url=None, response=None, max_bytes=None):
+        with tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes) as spool:
+            size = 0
+            for chunk in _body_chunks(body):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    return None
+                spool.write(chunk)
+            spool.seek(0)
+            self._append_payload(path, url, spool, size, response)
+        return size
+
+    def save_by_digest(self, directory, ext, chunks, mime_type=None):
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes) as spool:
+            size = 0
+            for chunk in chunks:
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            path = f"{directory}/data_{digest.hexdigest()[:16]}{ext}"
+            if self.exists(path):
+                return path, size, False
+            spool.seek(0)
+            self._append_payload(path, f"urn:sha256:{digest.hexdigest()}", spool, size, None, mime_type=mime_type)
+        return path, size, True
+
+    @contextmanager
+    def open_text(self, path, url=None, encoding='utf-8', errors='strict', newline=None):
+        with tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes) as spool:
+            text = io.TextIOWrapper(spool, encoding=encoding, errors=errors, newline=newline, write_through=True)
+            yield text
+            text.flush()
+            text.detach()
+            size = spool.tell()
+            spool.seek(0)
+            self._append_payload(path, url, spool, size, None, mime_type=f'text/html; charset={encoding}',
+                                 record_type='conversion' if url else 'resource')
+
+    def tee(self, chunks, url, response):
+        spool = tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes)
+        try:
+            size = 0
+            for chunk in chunks:
+                spool.write(chunk)
+                size += len(chunk)
+                yield chunk
+            spool.seek(0)
+            self._append_payload(None, url, spool, size, response)
+        finally:
+            spool.close()
+
+    def _append_payload(self, path, url, payload, size, response, mime_type=None, record_type=None):
+        """Write one record whose payload is size bytes read from the payload file"""
+        if response is not None:
+            version = HTTP_VERSIONS.get(getattr(response.raw, 'version', None), '1.1')
+            head = [f"HTTP/{version} {response.status_code} {response.reason or ''}".rstrip()]
+            for name, value in response.headers.items():
+                prefix = 'X-Archive-Orig-' if name.lower() in ARCHIVE_RENAMED_HEADERS else ''
+                head.append(f"{prefix}{name}: {value}")
+            head.append(f"Content-Length: {size}")
+            http_head = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1', 'replace')
+            mime_type = response.headers.get('content-type')
+            record_type, content_type = 'response', 'application/http;msgtype=response'
+        else:
+            http_head = b''
+            mime_type = mime_type or (mimetypes.guess_type(path)[0] if path else None) or 'application/octet-stream'
+            record_type, content_type = record_type or 'resource', mime_type
+        digest = hashlib.sha256()
+        def read_payload():
+            chunk = payload.read(stream_chunk_size)
+            digest.update(chunk)
+            return chunk
+        entry = self._append(record_type, url, itertools.chain([http_head], iter(read_payload, b'')),
+                             content_type=content_type, length=len(http_head) + size, path=path)
+        if path:
+            self.manifest.record(path, digest.hexdigest(), size, url if record_type != 'resource' else None)
+        entry.update({'payload_offset': len(http_head), 'size': size,
+                      'status': response.status_code if response is not None else None,
+                      'mime': mime_type})
+        self._write_index(entry)
+
+    def _append(self, record_type, url, block, content_type, length=None, path=None):
+        """Append one gzip member holding a WARC record; returns its index entry"""
+        if length is None:
+            block = list(block)
+            length = sum(len(chunk) for chunk in block)
+        record_id = f"<urn:uuid:{uuid.uuid4()}>"
+        headers = [
+            'WARC/1.1',
+            f"WARC-Type: {record_type}",
+            f"WARC-Record-ID: {record_id}",
+            f"WARC-Date: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}",
+        ]
+        if url:
+            headers.append(f"WARC-Target-URI: {url}")
+            if record_type == 'conversion' and url in self._record_ids:
+                headers.append(f"WARC-Refers-To: {self._record_ids[url]}")
+        headers += [f"Content-Type: {content_type}", f"Content-Length: {length}"]
+        warc_head = ('\r\n'.join(headers) + '\r\n\r\n').encode('utf-8')
+        with self._lock:
+            offset = self._file.tell()
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            for chunk in itertools.chain([warc_head], block, [b'\r\n\r\n'], [None]):
+                data = compressor.flush() if chunk is None else compressor.compress(chunk)
+                if self.disk and data:
+                    self.disk.charge(len(data))
+                self._file.write(data)
+            self._file.flush()
+            entry = {'offset': offset, 'length': self._file.tell() - offset, 'type': record_type,
+                     'id': record_id, 'url': url, 'path': path, 'header_length': len(warc_head)}
+            if record_type == 'response' and url:
+                self._record_ids[url] = record_id
+            if path:
+                self.paths[path] = entry
+                self.claimed.discard(path)
+        if record_type == 'warcinfo':
+            self._write_index(entry)
+        return entry
+
+    def _write_index(self, entry):
+        # Indexed only once the record is complete, so a crash never indexes a torn record
+        with self._lock:
+            self._index.write(json.dumps(entry) + '\n')
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                self._index.close()
+                self.manifest.close(self.paths)
+
+class ZipOutput:
+    """Clone written straight into its downloadable ZIP, with no tree on disk.
+    An entry is written in one go, so bodies are spooled and added one at a
+    time. The archive is written beside its final path and renamed over it on
+    close, when the central directory is complete: a clone interrupted before
+    then starts over from an empty archive"""
+
+    kind = 'zip'
+    records_responses = False
+    disk = None
+    suffix = '_cloned.zip'
+    part_suffix = '.part'
+
+    def __init__(self, base_dir, name):
+        self.path = os.path.join(base_dir, name + self.suffix)
+        self.claimed = set()
+        self._lock = Lock()
+        self._zip = zipfile.ZipFile(self.path + self.part_suffix, 'w')
+        self.paths = set()
+        self.manifest = CloneManifest(os.path.join(base_dir, name + CloneManifest.suffix))
+
+    def exists(self, path):
+        return path in self.paths
+
+    def claim(self, path):
+        name, ext = os.path.splitext(path)
+        candidate, counter = path, 1
+        with self._lock:
+            while candidate in self.paths or candidate in self.claimed:
+                candidate = f"{name}_{counter}{ext}"
+                counter += 1
+            self.claimed.add(candidate)
+        return candidate
+
+    def save(self, path, body, url=None, response=None, max_bytes=None):
+        if path is None:
+            return None
+        with tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes) as spool:
+            size = 0
+            for chunk in _body_chunks(body):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    return None
+                spool.write(chunk)
+            spool.seek(0)
+            self._add(path, spool, size, url)
+        return size
+
+    def save_by_digest(self, directory, ext, chunks, mime_type=None):
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes) as spool:
+            size = 0
+            for chunk in chunks:
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            path = f"{directory}/data_{digest.hexdigest()[:16]}{ext}"
+            if self.exists(path):
+                return path, size, False
+            spool.seek(0)
+            self._add(path, spool, size)
+        return path, size, True
+
+    @contextmanager
+    def open_text(self, path, url=None, encoding='utf-8', errors='strict', newline=None):
+        with tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes) as spool:
+            text = io.TextIOWrapper(spool, encoding=encoding, errors=errors, newline=newline, write_through=True)
+            yield text
+            text.flush()
+            text.detach()
+            size = spool.tell()
+            spool.seek(0)
+            self._add(path, spool, size, url)
+
+    def tee(self, chunks, url, response):
+        return chunks
+
+    def _add(self, path, payload, size, url=None):
+        info = zipfile.ZipInfo(path, time.localtime()[:6])
+        info.compress_type = zip_compress_type(path)
+        info.external_attr = 0o644 << 16
+        digest = hashlib.sha256()
+        with self._lock:
+            with self._zip.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as dest:
+                for chunk in iter(lambda: payload.read(stream_chunk_size), b''):
+                    if self.disk:
+                        self.disk.charge(len(chunk))
+                    digest.update(chunk)
+                    dest.write(chunk)
+            self.paths.add(path)
+            self.claimed.discard(path)
+        self.manifest.record(path, digest.hexdigest(), size, url)
+
+    def close(self):
+        with self._lock:
+            if self._zip.fp is None:
+                return
+            self._zip.close()
+            # Never rewritten in place: a preview may have the previous archive memory-mapped
+            os.replace(self.path + self.part_suffix, self.path)
+            self.manifest.close(self.paths)
+
+def create_clone_output(kind, base_dir, name):
+    if kind == 'warc':
+        return WarcOutput(base_dir, name)
+    if kind == 'zip':
+        return ZipOutput(base_dir, name)
+    return DirectoryOutput(base_dir, name)
+
+class WarcArchive:
+    """Read side of a WARC clone: clone paths resolved through the offset index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        for entry in self.read_index(path[:-len(WarcOutput.suffix)] + WarcOutput.index_suffix):
+            if entry.get('path'):
+                self.entries[entry['path']] = entry
+
+    @staticmethod
+    def read_index(index_path):
+        if not os.path.exists(index_path):
+            return []
+        entries = []
+        with open(index_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # Torn last line
+        return entries
+
+    def exists(self, path):
+        return path in self.entries
+
+    def iter_payload(self, path):
+        """Decompress just the record's gzip member and yield its payload"""
+        entry = self.entries[path]
+        skip = entry['header_length'] + entry['payload_offset']
+        remaining = entry['size']
+        decompressor = zlib.decompressobj(31)
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            left = entry['length']
+            while left > 0 and remaining > 0:
+                data = decompressor.decompress(f.read(min(stream_chunk_size, left)))
+                left -= stream_chunk_size
+                if skip:
+                    data, skip = data[skip:], max(skip - len(data), 0)
+                if data:
+                    data = data[:remaining]
+                    remaining -= len(data)
+                    yield data
+
+    def response(self, path):
+        entry = self.entries[path]
+        response = Response(self.iter_payload(path), content_type=entry.get('mime') or 'application/octet-stream',
+                            direct_passthrough=True)
+        response.content_length = entry['size']
+        return response
+
+class FileRange:
+    """Read-only window of size bytes of an open file, from its current position.
+    Servers that sendfile wsgi.file_wrapper bodies use fileno() and the file
+    position, bounded by Content-Length; any other server just reads it"""
+
+    def __init__(self, f, size):
+        self._file = f
+        self._end = f.tell() + size
+
+    def read(self, n=-1):
+        remaining = max(self._end - self._file.tell(), 0)
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        return self._file.read(n) if n else b''
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+class ZipArchive:
+    """Read side of a ZIP clone. The central directory is parsed once into
+    payload offsets; entries are read from a shared memory map, and stored ones
+    go out through the server's wsgi.file_wrapper (sendfile) when it has one"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        with open(path, 'rb') as f:
+            with zipfile.ZipFile(f) as zf:
+                infos = zf.infolist()
+            for info in infos:
+                if info.is_dir() or info.flag_bits & 0x1:  # Encrypted entries are never written
+                    continue
+                f.seek(info.header_offset)
+                fields = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+                if fields[0] != b'PK\x03\x04':
+                    continue
+                offset = info.header_offset + ZIP_LOCAL_HEADER.size + fields[9] + fields[10]
+                self.entries[info.filename] = (offset, info.compress_size, info.file_size, info.compress_type)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def exists(self, path):
+        return path in self.entries
+
+    def iter_payload(self, path):
+        offset, compressed, size, method = self.entries[path]
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with zipfile.ZipFile(self.path) as zf, zf.open(path) as f:
+                yield from iter(lambda: f.read(stream_chunk_size), b'')
+            return
+        view = memoryview(self._map)[offset:offset + compressed]
+        try:
+            inflater = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+            for start in range(0, compressed, stream_chunk_size):
+                chunk = view[start:start + stream_chunk_size]
+                data = inflater.decompress(chunk) if inflater else bytes(chunk)
+                if data:
+                    yield data
+            if inflater:
+                data = inflater.flush()
+                if data:
+                    yield data
+        finally:
+            view.release()
+
+    def response(self, path):
+        offset, compressed, size, method = self.entries[path]
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if method == zipfile.ZIP_STORED and file_wrapper:
+            f = open(self.path, 'rb')
+            f.seek(offset)
+            body = file_wrapper(FileRange(f, size), stream_chunk_size)
+        else:
+            body = self.iter_payload(path)
+        response = Response(body, mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                            direct_passthrough=True)
+        response.content_length = size
+        return response
+
+ARCHIVE_READERS = ((WarcOutput.suffix, WarcArchive), (ZipOutput.suffix, ZipArchive))
+_open_archives = OrderedDict()
+_open_archives_lock = Lock()
+
+def open_clone_archive(domain, max_open=64):
+    """Archive-backed clone by name, or None; indexes are cached until the archive changes"""
+    for suffix, reader in ARCHIVE_READERS:
+        path = os.path.join(base_output_dir, domain + suffix)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        with _open_archives_lock:
+            cached = _open_archives.get(path)
+            if cached and cached[0] == mtime:
+                _open_archives.move_to_end(path)
+                return cached[1]
+        try:
+            archive = reader(path)
+        except (zipfile.BadZipFile, ValueError, OSError):
+            continue  # Still being written
+        with _open_archives_lock:
+            _open_archives[path] = (mtime, archive)
+            while len(_open_archives) > max_open:
+                _open_archives.popitem(last=False)
+        return archive
+    return None
+
+# Snapshot diffs: text diffs of changed pages are capped to keep responses compact
+diff_text_max_pages = int(os.environ.get('DIFF_TEXT_MAX_PAGES', 20))
+diff_text_max_lines = int(os.environ.get('DIFF_TEXT_MAX_LINES', 200))
+
+def load_clone_manifest(domain):
+    """path -> {'sha256', 'size', ...} for a clone, or None if there is no such clone.
+    Clones made before manifests are hashed in full"""
+    manifest_path = os.path.join(base_output_dir, domain + CloneManifest.suffix)
+    if os.path.exists(manifest_path):
+        return CloneManifest.load(manifest_path)
+    directory = os.path.join(base_output_dir, domain)
+    if os.path.isdir(directory):
+        paths = [os.path.relpath(os.path.join(root, file), directory).replace(os.sep, '/')
+                 for root, dirs, files in os.walk(directory) for file in files]
+    else:
+        archive = open_clone_archive(domain)
+        if archive is None:
+            return None
+        paths = list(archive.entries)
+    entries = {}
+    for path in paths:
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in iter_clone_file(domain, path):
+            digest.update(chunk)
+            size += len(chunk)
+        entries[path] = {'path': path, 'sha256': digest.hexdigest(), 'size': size}
+    return entries
+
+def iter_clone_file(domain, path):
+    """Chunks of one file of a clone, whatever its output format"""
+    directory = os.path.join(base_output_dir, domain)
+    if os.path.isdir(directory):
+        with open(os.path.join(directory, path), 'rb') as f:
+            yield from iter(lambda: f.read(stream_chunk_size), b'')
+    else:
+        yield from open_clone_archive(domain).iter_payload(path)
+
+def diff_clone_manifests(old, new):
+    """Added, removed and changed files between two manifests, by content hash"""
+    def describe(entry):
+        return {'path': entry['path'], 'kind': 'page' if entry['path'].endswith('.html') else 'asset',
+                'size': entry['size']}
+    changed = []
+    for path in sorted(set(old) & set(new)):
+        if old[path]['sha256'] != new[path]['sha256']:
+            item = describe(new[path])
+            item['old_size'] = old[path]['size']
+            changed.append(item)
+    return {
+        'added': [describe(new[path]) for path in sorted(set(new) - set(old))],
+        'removed': [describe(old[path]) for path in sorted(set(old) - set(new))],
+        'changed': changed,
+        'unchanged': len(set(old) & set(new)) - len(changed),
+    }
+
+def clone_text_diff(old_domain, new_domain, path, max_lines):
+    """Unified diff of one text file between two clones; (lines, truncated)"""
+    def lines(domain):
+        return b''.join(iter_clone_file(domain, path)).decode('utf-8', 'replace').splitlines()
+    diff = difflib.unified_diff(lines(old_domain), lines(new_domain), f"{old_domain}/{path}",
+                                f"{new_domain}/{path}", lineterm='')
+    head = list(itertools.islice(diff, max_lines + 1))
+    return head[:max_lines], len(head) > max_lines
+
+# Full-text index of cloned pages (SQLite FTS5), shared by the web tier and workers
+search_enabled = os.environ.get('SEARCH_INDEX', '1') == '1'
+search_index_path = os.environ.get('SEARCH_INDEX_PATH', os.path.join(base_output_dir, '.search.sqlite'))
+search_text_max_chars = int(os.environ.get('SEARCH_TEXT_MAX_CHARS', 256 * 1024))
+SEARCH_MARKS = ('\x02', '\x03')  # Snippet highlight markers, turned into <mark> after escaping
+
+class SearchIndex:
+    """Visible text of every saved page, keyed by clone and path. Pages are
+    indexed as they are saved and dropped with their clone"""
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = search_enabled
+        self._db = None
+        self._lock = Lock()
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    id INTEGER PRIMARY KEY, domain TEXT NOT NULL, path TEXT NOT NULL, url TEXT,
+                    UNIQUE (domain, path));
+                CREATE VIRTUAL TABLE IF NOT EXISTS pages_text USING fts5(
+                    title, body, tokenize='unicode61 remove_diacritics 2');
+            """)
+            self._db = db
+        return self._db
+
+    def _run(self, fn):
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                db = self._connect()
+                with db:
+                    return fn(db)
+            except sqlite3.OperationalError as e:
+                if self._db is None:
+                    print(f"Search index unavailable, disabling: {e}")
+                    self.enabled = False
+                    return None
+                raise
+
+    def add(self, domain, path, url, title, text):
+        def add(db):
+            row = db.execute('SELECT id FROM pages WHERE domain = ? AND path = ?', (domain, path)).fetchone()
+            if row:
+                db.execute('DELETE FROM pages_text WHERE rowid = ?', row)
+                db.execute('UPDATE pages SET url = ? WHERE id = ?', (url, row[0]))
+                page_id = row[0]
+            else:
+                page_id = db.execute('INSERT INTO pages (domain, path, url) VALUES (?, ?, ?)',
+                                     (domain, path, url)).lastrowid
+            db.execute('INSERT INTO pages_text (rowid, title, body) VALUES (?, ?, ?)', (page_id, title, text))
+        self._run(add)
+
+    def remove_clone(self, domain):
+        def remove(db):
+            db.execute('DELETE FROM pages_text WHERE rowid IN (SELECT id FROM pages WHERE domain = ?)', (domain,))
+            db.execute('DELETE FROM pages WHERE domain = ?', (domain,))
+        self._run(remove)
+
+    def search(self, query, limit=20, offset=0, domain=None):
+        """(total, [{'domain', 'path', 'url', 'title', 'snippet'}]) for pages containing
+        every word of query, best matches first"""
+        # Words are matched as quoted strings so user input is never FTS5 syntax;
+        # FTS5 strings cannot hold NUL, so it separates words like a space
+        words = query.replace('\0', ' ').split()
+        if not words:
+            return 0, []
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+        where = 'pages_text MATCH ?' + (' AND pages.domain = ?' if domain else '')
+        params = (match, domain) if domain else (match,)
+        def search(db):
+            total = db.execute(f'SELECT count(*) FROM pages_text JOIN pages ON pages.id = pages_text.rowid '
+                               f'WHERE {where}', params).fetchone()[0]
+            rows = db.execute(
+                f'SELECT pages.domain, pages.path, pages.url, pages_text.title, '
+                f"snippet(pages_text, 1, ?, ?, '…', 24) FROM pages_text JOIN pages ON pages.id = pages_text.rowid "
+                f'WHERE {where} ORDER BY rank LIMIT ? OFFSET ?', SEARCH_MARKS + params + (limit, offset)).fetchall()
+            return total, rows
+        found = self._run(search)
+        if found is None:
+            return None
+        total, rows = found
+        results = []
+        for domain, path, url, title, snippet in rows:
+            snippet = html_lib.escape(snippet).replace(SEARCH_MARKS[0], '<mark>').replace(SEARCH_MARKS[1], '</mark>')
+            results.append({'domain': domain, 'path': path, 'url': url, 'title': title, 'snippet': snippet})
+        return total, results
+
+search_index = SearchIndex(search_index_path)
+
+def clone_name_of(item):
+    """Clone name of an entry of base_output_dir: the clone's directory or one of its files"""
+    for suffix in (ZipOutput.suffix, WarcOutput.suffix, WarcOutput.index_suffix, CloneManifest.suffix):
+        if item.endswith(suffix):
+            return item[:-len(suffix)]
+    return item
+
+def clone_paths(base_dir, name):
+    """Everything a clone keeps in base_dir: its tree, archives and sidecars"""
+    return [os.path.join(base_dir, name + suffix)
+            for suffix in ('', ZipOutput.suffix, ZipOutput.suffix + ZipOutput.part_suffix, WarcOutput.suffix,
+                           WarcOutput.index_suffix, CloneManifest.suffix)]
+
+def clone_disk_bytes(base_dir, name):
+    total = 0
+    for path in clone_paths(base_dir, name):
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+def trash_clone_files(base_dir, name):
+    """Move a clone's files to the trash; False if it had none"""
+    # Renaming is atomic and O(1); the reaper removes the files afterwards
+    deleted = False
+    for path in clone_paths(base_dir, name):
+        if os.path.exists(path):
+            trash_reaper.move_to_trash(path)
+            deleted = True
+    return deleted
+
 class WebClonerCore:
     """Core web cloning functionality"""
     
-    def __init__(self, socketio_instance=None, sid=None, namespace='/'):
+    def __init__(self, socketio_instance=None, sid=None, namespace='/', profile=None,
+                 session=None, asset_cache=None, low_memory=False, journal=None, policy=None,
+                 optimize_images=None, render=None, output_format=None, tenant=None):
         self.socketio = socketio_instance
         self.sid = sid
         self.namespace = namespace
-        self.downloaded_resources = set()
-        self.visited_pages = set()
-        self.max_pages = 10  # Limit internal pages to prevent overload
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        compact = crawl_state == 'compact' or (crawl_state == 'auto' and crawl_max_pages >= crawl_state_compact_pages)
+        self.crawl_store = CrawlStore(crawl_store_cache_kib) if compact else None
+        self.downloaded_resources = FingerprintSet() if compact else set()
+        self.resource_paths = SpilledUrlMap(self.crawl_store) if compact else {}
+        self._resource_lock = Lock()
+        self.visited_pages = FingerprintSet() if compact else set()
+        self.page_paths = SpilledUrlMap(self.crawl_store) if compact else {}
+        self.journal = journal
+        self.policy = policy or default_resource_policy
+        self.skipped_resources = FingerprintSet() if compact else set()
+        self.third_party_hosts = set()
+        self.data_uri_paths = {}
+        self.optimize_images = image_optimize if optimize_images is None else optimize_images
+        self.render = render_js if render is None else render
+        self.output_format = output_format or globals()['output_format']
+        self.output = None
+        self.clone_name = None
+        self.index_pages = False
+        self.tenant = tenant
+        self.disk = None
+        self.scheduler = CrawlScheduler(budget=crawl_max_pages, rate=crawl_rate, store=self.crawl_store)
+        self.metrics = CloneMetrics()
+        self.profile = profile_clones if profile is None else profile
+        self.asset_cache = asset_cache
+        self.low_memory = low_memory
+        self.session = session or self.create_session()
+    
+    def checkpoint(self, record):
+        """Append a progress record to the clone journal, if there is one"""
+        if self.journal:
+            self.journal.append(record)
+    
+    def restore_checkpoint(self, output_dir):
+        """Reload progress saved by an interrupted run; returns the journal state"""
+        state = self.journal.read()
+        for url, path in state['resources'].items():
+            if self.output.exists(path):
+                self.resource_paths[canonical_url(url)] = path
+                self.downloaded_resources.add(canonical_url(url))
+        for url, path in state['pages'].items():
+            if self.output.exists(path):
+                self.page_paths[canonical_url(url)] = path
+                self.visited_pages.add(canonical_url(url))
+        if state['resources'] or state['pages']:
+            self.emit_status(f"Resuming: {len(self.resource_paths)} resources and "
+                             f"{len(self.page_paths)} pages already saved", 5)
+        return state
+    
+    @staticmethod
+    def create_session():
+        """Create an HTTP session with browser-like default headers"""
+        session = requests.Session()
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, http2_adapters.get(prefix, shared_adapter))
+        session.headers.update({
+            'User-Agent': BROWSER_USER_AGENT,
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate',
+            # Adds br / zstd when urllib3 has decoders for them
+            'Accept-Encoding': ACCEPT_ENCODING,
             'Connection': 'keep-alive',
             'Upgrade-Insecure-Requests': '1',
         })
+        return session
     
     def emit_status(self, message, progress=None):
         """Emit status update via SocketIO with explicit sid and namespace"""
@@ -80,8 +3518,35 @@ class WebClonerCore:
             self.socketio.emit('status_update', data, room=self.sid, namespace=self.namespace)
         print(f"Status: {message} ({progress}%)" if progress else f"Status: {message}")
     
+    @property
+    def max_pages(self):
+        """Limit internal pages to prevent overload"""
+        return self.scheduler.budget
+    
+    @max_pages.setter
+    def max_pages(self, value):
+        self.scheduler.budget = value
+    
     def clone_website(self, url, output_base_dir, clone_name=None):
         """Main cloning function"""
+        profiler = cProfile.Profile() if self.profile else None
+        if profiler:
+            profiler.enable()
+        try:
+            result = self._clone_website(url, output_base_dir, clone_name)
+        finally:
+            if self.crawl_store:
+                self.crawl_store.close()
+            if profiler:
+                profiler.disable()
+                self.metrics.profile = self._save_profile(profiler, output_base_dir, clone_name or urlparse(url).netloc)
+        result['metrics'] = self.metrics.to_dict()
+        recent_clone_metrics.append({'url': url, 'domain': result.get('domain'),
+                                     'success': result['success'], 'metrics': result['metrics']})
+        return result
+
+    def _clone_website(self, url, output_base_dir, clone_name=None):
+        stage = self.metrics.stage
         try:
             self.emit_status("Starting website cloning...", 0)
             
@@ -90,80 +3555,412 @@ class WebClonerCore:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             unique_dir = clone_name or f"{domain}_{timestamp}"
             output_dir = os.path.join(output_base_dir, unique_dir)
-            
-            os.makedirs(output_dir, exist_ok=True)
             assets_dir = os.path.join(output_dir, 'assets')
-            os.makedirs(assets_dir, exist_ok=True)
-            
-            self.emit_status(f"Downloading main page from {url}...", 10)
-            response = self._get_with_retry(url, timeout=60)
-            if not response:
-                raise Exception("Failed to download main page after retries")
-            response.raise_for_status()
-            self.visited_pages.add(url)
-            
-            self.emit_status("Parsing HTML content...", 20)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            self.emit_status("Processing images and resources...", 30)
-            self.process_images(soup, url, assets_dir)
-            self.emit_status("Images processed", 50)
-            
-            self.emit_status("Processing CSS files...", 60)
-            self.process_css_files(soup, url, assets_dir)
-            
-            self.emit_status("Processing JavaScript files...", 70)
-            self.process_js_files(soup, url, assets_dir)
+            self.output = create_clone_output(self.output_format, output_base_dir, unique_dir)
+            self.clone_name = unique_dir
+            # Search results link to previews and quotas cover clones, both of base_output_dir only
+            shared = os.path.realpath(output_base_dir) == os.path.realpath(base_output_dir)
+            self.index_pages = search_index.enabled and shared
+            self.disk = CloneDiskBudget(unique_dir, self.tenant, disk_usage_ledger if shared else None,
+                                        disk_write_limiter)
+            self.output.disk = self.disk
+            self.disk.charge(0)  # A tenant already over its hard quota gets nothing
             
-            self.emit_status("Processing fonts and other resources...", 75)
-            self.process_fonts_and_resources(soup, url, assets_dir)
+            checkpoint = self.restore_checkpoint(output_dir) if self.journal else None
+            if checkpoint and checkpoint['main_saved']:
+                # The main page was written before the interruption; only pages are left
+                self.visited_pages.add(canonical_url(url))
+                self.emit_status("Processing internal links...", 80)
+                with stage('internal_pages'):
+                    self.download_internal_pages(
+                        [u for u in checkpoint['frontier'] if canonical_url(u) not in self.visited_pages], output_dir)
+                return self._finish_clone(output_dir, unique_dir)
             
-            self.emit_status("Processing internal links...", 80)
-            self.process_internal_links(soup, url, output_dir)
+            rendered = self.render_main_page(url) if self.render else None
+            if rendered:
+                self.visited_pages.add(canonical_url(url))
+                self.visited_pages.add(canonical_url(rendered['url']))
+                self.scheduler.spend(url)
+                self._process_document(rendered['html'], rendered['url'], output_dir, assets_dir, 'index.html')
+                self.checkpoint({'t': 'main'})
+                return self._finish_clone(output_dir, unique_dir)
             
-            self.emit_status("Saving HTML file...", 90)
-            html_file = os.path.join(output_dir, 'index.html')
-            with open(html_file, 'w', encoding='utf-8') as f:
-                f.write(str(soup))
+            self.emit_status(f"Downloading main page from {url}...", 10)
+            with stage('fetch_main'):
+                response = self._get_with_retry(url, timeout=60, stream=True)
+                if not response:
+                    raise Exception("Failed to download main page after retries")
+                response.raise_for_status()
+            self.visited_pages.add(canonical_url(url))
+            if response.url != url:
+                self.visited_pages.add(canonical_url(response.url))
+            self.scheduler.spend(url)
+            html_path = 'index.html'
             
-            self.emit_status("Creating downloadable archive...", 95)
-            zip_path = self.create_zip_archive(output_dir, unique_dir)
+            content_length = int(response.headers.get('content-length') or 0)
+            if self.low_memory or content_length > low_memory_html_bytes:
+                self.low_memory = True
+                self.emit_status("Streaming HTML and resources (low-memory mode)...", 20)
+                with stage('stream_rewrite'):
+                    internal_links = self.stream_rewrite_html(response, url, assets_dir, html_path)
+                
+                self.emit_status("Processing internal links...", 80)
+                with stage('internal_pages'):
+                    internal_links = self.plan_internal_pages(url, internal_links)
+                    self.checkpoint_frontier(internal_links)
+                    self.checkpoint({'t': 'main'})
+                    self.download_internal_pages(internal_links, output_dir)
+            else:
+                self.output.save(None, response.content, url, response)  # The original, kept by archive formats
+                self._process_document(response.content, url, output_dir, assets_dir, html_path)
+                self.checkpoint({'t': 'main'})
             
-            self.emit_status(f"Website cloned successfully!", 100)
+            return self._finish_clone(output_dir, unique_dir)
             
+        except QuotaExceededError as e:
+            # Aborted rather than left half-written: the space goes back to the other jobs
+            self.emit_status(f"Error: {str(e)}", 0)
+            self.output.close()
+            trash_clone_files(output_base_dir, unique_dir)
+            search_index.remove_clone(unique_dir)
+            if self.disk.ledger:
+                self.disk.ledger.remove(unique_dir)
             return {
-                'success': True,
-                'output_dir': output_dir,
-                'zip_path': zip_path,
-                'domain': unique_dir
+                'success': False,
+                'error': str(e)
             }
-            
         except Exception as e:
             self.emit_status(f"Error: {str(e)}", 0)
             return {
                 'success': False,
                 'error': str(e)
             }
+        finally:
+            if self.output:
+                self.output.close()
+
+    def _finish_clone(self, output_dir, unique_dir):
+        if self.disk.exhausted:
+            raise QuotaExceededError(self.disk.exhausted)
+        if self.output.kind != 'dir':
+            # Archive formats are complete as soon as the last record is written
+            if self.optimize_images:
+                print("Image optimization works on directory output only; skipping")
+            self.output.close()
+            self.disk.finish(clone_disk_bytes(os.path.dirname(output_dir), unique_dir))
+            self.emit_status("Website cloned successfully!", 100)
+            return {
+                'success': True,
+                'output_dir': None,
+                'zip_path': None,
+                'archive_path': self.output.path,
+                'domain': unique_dir,
+                'trimmed': self.disk.trimming
+            }
+        
+        if self.optimize_images:
+            self.emit_status("Optimizing images...", 92)
+            with self.metrics.stage('optimize_images'):
+                self.optimize_saved_images(output_dir)
+        
+        self.output.close()  # Manifest final before the tree is zipped
+        self.emit_status("Creating downloadable archive...", 95)
+        with self.metrics.stage('zip'):
+            zip_path = self.create_zip_archive(output_dir, unique_dir)
+        
+        if archive_only:
+            trash_reaper.move_to_trash(output_dir)
+            output_dir = None
+        self.disk.finish(clone_disk_bytes(os.path.dirname(zip_path), unique_dir))
+        
+        self.emit_status("Website cloned successfully!", 100)
+        
+        return {
+            'success': True,
+            'output_dir': output_dir,
+            'zip_path': zip_path,
+            'archive_path': zip_path,
+            'domain': unique_dir,
+            'trimmed': self.disk.trimming
+        }
+
+    def optimize_saved_images(self, output_dir):
+        """Shrink the clone's JPEG/PNG/WebP files in the shared process pool"""
+        global _image_pool
+        if Image is None:
+            print("Image optimization needs Pillow; skipping")
+            return
+        # Identical images saved under several names are optimized once
+        groups = OrderedDict()
+        for path in sorted(set(self.resource_paths.values())):
+            file_path = os.path.join(output_dir, path)
+            if os.path.splitext(path)[1].lower() in OPTIMIZABLE_IMAGE_FORMATS and os.path.isfile(file_path):
+                groups.setdefault(file_sha256(file_path), []).append(file_path)
+        pool = image_pool()
+        futures = [pool.submit(optimize_image_files, paths, digest, image_max_dimension, image_quality,
+                               image_webp_variants, image_cache_dir) for digest, paths in groups.items()]
+        for paths, future in zip(groups.values(), futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                print("Image optimization pool died; starting a new one for the next clone")
+                with _image_pool_lock:
+                    _image_pool = None
+                return
+            except Exception as e:
+                print(f"Error optimizing image {paths[0]}: {e}")
+                continue
+            try:
+                self.write_optimized_images(paths, result)
+            except OSError as e:
+                print(f"Error writing optimized image {paths[0]}: {e}")
+                continue
+            self.metrics.incr('images_optimized', len(paths))
+            self.metrics.incr('image_bytes_saved', (result['before'] - result['after']) * len(paths))
+
+    def write_optimized_images(self, paths, result):
+        """Copy an optimized image out of the shared cache, charging the clone's disk budget"""
+        for path in paths:
+            for source, target in ((result['encoded_path'], path), (result['variant_path'], path + '.webp')):
+                if source is None:
+                    continue
+                replaced = os.path.getsize(target) if os.path.exists(target) else 0
+                with open(source, 'rb') as src, open_charged(target, self.disk) as dest:
+                    for chunk in iter(lambda: src.read(stream_chunk_size), b''):
+                        dest.write(chunk)
+                if self.disk:
+                    self.disk.release(replaced)
+
+    def render_main_page(self, url):
+        """Load the main page in a pooled headless browser and seed the asset store
+        with everything it fetched; None falls back to a plain HTTP fetch"""
+        if sync_playwright is None:
+            print("Render mode needs playwright; fetching the server HTML instead")
+            return None
+        if gevent_patched():
+            print("Render mode needs native threads, which gevent has patched; run clones in worker.py "
+                  "to render. Fetching the server HTML instead")
+            return None
+        self.emit_status(f"Rendering main page {url} in a headless browser...", 10)
+        try:
+            with self.metrics.stage('render'):
+                rendered = render_pool().render(url, render_timeout)
+        except Exception as e:
+            print(f"Error rendering {url}: {e}; fetching the server HTML instead")
+            return None
+        if rendered['status'] >= 400:
+            print(f"Rendering {url} returned HTTP {rendered['status']}; fetching the server HTML instead")
+            return None
+        # Captured bodies go into the same store download_resource reads, so nothing is fetched twice
+        if self.asset_cache is None:
+            self.asset_cache = AssetCache(max_bytes=render_capture_max_bytes)
+        for resource_url, (body, content_type) in rendered['resources'].items():
+            self.asset_cache.put(canonical_url(resource_url), body, content_type)
+        self.metrics.incr('rendered_resources', len(rendered['resources']))
+        return rendered
+    
+    def _process_document(self, content, url, output_dir, assets_dir, html_path):
+        """Parse the main page into a soup, rewrite it and save it"""
+        stage = self.metrics.stage
+        self.emit_status("Parsing HTML content...", 20)
+        with stage('parse'):
+            soup = BeautifulSoup(content, 'html.parser')
+        canonical = soup.find('link', rel='canonical', href=True)
+        if canonical:
+            self.note_canonical(url, canonical['href'])
+        
+        self.emit_status("Prefetching assets...", 25)
+        with stage('prefetch'):
+            self.prefetch_resources(self.collect_resource_urls(soup), url, assets_dir)
+        
+        self.emit_status("Processing images and resources...", 30)
+        with stage('images'):
+            self.process_images(soup, url, assets_dir)
+        self.emit_status("Images processed", 50)
+        
+        self.emit_status("Processing CSS files...", 60)
+        with stage('css'):
+            self.process_css_files(soup, url, assets_dir)
+        
+        self.emit_status("Processing JavaScript files...", 70)
+        with stage('js'):
+            self.process_js_files(soup, url, assets_dir)
+        
+        self.emit_status("Processing fonts and other resources...", 75)
+        with stage('fonts_and_resources'):
+            self.process_fonts_and_resources(soup, url, assets_dir)
+        
+        self.emit_status("Processing internal links...", 80)
+        with stage('internal_pages'):
+            self.process_internal_links(soup, url, output_dir)
+        
+        self.emit_status("Saving HTML file...", 90)
+        with stage('serialize_html'), self.output.open_text(html_path, url) as out:
+            written = write_html(soup, out)
+        self.metrics.record_asset('html', written)
+        if self.index_pages:
+            with stage('search_index'):
+                self.index_page(html_path, url, *soup_visible_text(soup, search_text_max_chars))
+
+    def stream_rewrite_html(self, response, base_url, assets_dir, html_path):
+        """Rewrite the main page while streaming it to disk; returns internal links to fetch"""
+        internal_links = OrderedDict()
+        chunks = self.output.tee(response.iter_content(chunk_size=stream_chunk_size), base_url, response)
+        head = next(chunks, b'')
+        encoding = sniff_html_encoding(response, head)
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        text = VisibleText(search_text_max_chars) if self.index_pages else None
+        received = 0
+
+        def rewrite_tag(tag, attrs):
+            return self._rewrite_streamed_tag(tag, attrs, base_url, assets_dir, internal_links)
+
+        def rewrite_css(css):
+            return self.rewrite_css_urls(css, base_url, assets_dir)
+
+        try:
+            # Keep the source encoding so <meta charset> stays truthful
+            with self.output.open_text(html_path, base_url, encoding=encoding, errors='xmlcharrefreplace',
+                                       newline='') as out:
+                rewriter = StreamingHTMLRewriter(out, rewrite_tag, rewrite_css, text)
+                for chunk in itertools.chain([head], chunks):
+                    received += len(chunk)
+                    rewriter.feed(decoder.decode(chunk))
+                rewriter.feed(decoder.decode(b'', final=True))
+                rewriter.close()
+        finally:
+            response.close()
+        self.metrics.record_asset('html', received)
+        if text:
+            self.index_page(html_path, base_url, *text.result())
+        return list(internal_links.values())
+
+    def _rewrite_streamed_tag(self, tag, attrs, base_url, assets_dir, internal_links):
+        """Apply the process_* rewrites to one streamed tag; None means unchanged"""
+        values = dict(attrs)
+        new_values = {}
+        removed = set()
+        try:
+            if tag in ('img', 'source'):
+                # No parent is known while streaming; a media <source> is typed by its response
+                kind = 'image' if tag == 'img' else None
+                for attr in ('srcset', 'data-srcset'):
+                    if values.get(attr):
+                        srcset = self.rewrite_srcset(values[attr], base_url, assets_dir, kind)
+                        if srcset:
+                            new_values[attr] = srcset
+                        else:
+                            removed.add(attr)
+                img_url = values.get('src') or values.get('data-src') or values.get('data-lazy-src')
+                if img_url:
+                    local_path = self.download_resource(img_url, base_url, assets_dir, kind)
+                    if local_path:
+                        new_values['src'] = local_path
+                        removed.update(['data-src', 'data-lazy-src', 'loading'])
+            elif tag == 'link':
+                rels = (values.get('rel') or '').lower().split()
+                if 'canonical' in rels and values.get('href'):
+                    self.note_canonical(base_url, values['href'])
+                if self.policy.allows_rel(rels):
+                    if values.get('href'):
+                        local_path = self.download_resource(values['href'], base_url, assets_dir,
+                                                            link_asset_type(rels, values.get('as')))
+                        if local_path:
+                            new_values['href'] = local_path
+                    if values.get('imagesrcset'):
+                        srcset = self.rewrite_srcset(values['imagesrcset'], base_url, assets_dir, 'image')
+                        if srcset:
+                            new_values['imagesrcset'] = srcset
+                        else:
+                            removed.add('imagesrcset')
+            elif tag == 'script' and values.get('src'):
+                local_path = self.download_resource(values['src'], base_url, assets_dir, 'js')
+                if local_path:
+                    new_values['src'] = local_path
+            elif tag == 'a' and values.get('href'):
+                full_url, fragment = urldefrag(urljoin(base_url, values['href']))
+                key = canonical_url(full_url)
+                if urlparse(full_url).netloc == urlparse(base_url).netloc:
+                    rel_path = self.page_paths.get(key)
+                    if (rel_path is None and key not in self.visited_pages and key not in internal_links
+                            and len(internal_links) < self.scheduler.remaining(base_url)):
+                        internal_links[key] = full_url
+                    if rel_path is None and key in internal_links:
+                        # The page is fetched after this tag is written: link it where it will be saved
+                        rel_path = page_rel_path(internal_links[key])
+                    if rel_path:
+                        new_values['href'] = f"{rel_path}#{fragment}" if fragment else rel_path
+
+            if values.get('style'):
+                style = self.rewrite_css_urls(values['style'], base_url, assets_dir)
+                if style != values['style']:
+                    new_values['style'] = style
+        except Exception as e:
+            print(f"Error rewriting <{tag}>: {e}")
+
+        if not new_values and not (removed & set(values)):
+            return None
+        result = [(name, new_values.pop(name, value)) for name, value in attrs if name not in removed]
+        return result + list(new_values.items())
+
+    def _save_profile(self, profiler, output_base_dir, name):
+        """Dump cProfile stats next to the clones and return a short summary"""
+        try:
+            profile_dir = os.path.join(output_base_dir, '.profiles')
+            os.makedirs(profile_dir, exist_ok=True)
+            profile_path = os.path.join(profile_dir, f"{name.replace(':', '_')}_{int(time.time())}.prof")
+            profiler.dump_stats(profile_path)
+
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+            return {'path': profile_path, 'top': summary.getvalue()}
+        except Exception as e:
+            print(f"Error saving profile: {e}")
+            return None
     
-    def _get_with_retry(self, url, timeout=30):
+    def _get_with_retry(self, url, timeout=30, stream=False):
         """Get with retry"""
-        @retry(max_retries=3, delay=2)
+        # The host limiter spaces retries of rate-limited requests by Retry-After and its pacing
+        @retry(max_retries=3, delay=2, on_retry=lambda attempt, e: self.metrics.incr('retries'),
+               paced=(RateLimitedError,))
         def get_request():
-            self.session.headers['Referer'] = urlparse(url).scheme + '://' + urlparse(url).netloc
-            return self.session.get(url, timeout=timeout)
+            # Per request rather than on the session: assets are fetched from several threads
+            referer = urlparse(url).scheme + '://' + urlparse(url).netloc
+            with host_limiter.slot(url) as done:
+                start = time.perf_counter()
+                try:
+                    response = self.session.get(url, timeout=timeout, stream=stream, headers={'Referer': referer})
+                except Exception:
+                    self.metrics.observe_request(url, time.perf_counter() - start, error=True)
+                    raise
+                done(response)
+            if response.status_code in SLOW_DOWN_STATUSES:
+                http_slow_down_total.inc()
+                self.metrics.incr('slowed_down')
+                response.close()
+                raise RateLimitedError(f"{response.status_code} from {url}")
+            http_responses_by_protocol.inc(1, (HTTP_VERSIONS.get(getattr(response.raw, 'version', None), 'other'),))
+            size = int(response.headers.get('content-length') or 0) if stream else len(response.content)
+            self.metrics.observe_request(url, time.perf_counter() - start, size,
+                                         error=response.status_code >= 400)
+            return response
         return get_request()
     
     def create_zip_archive(self, source_dir, unique_name):
         """Create ZIP archive of cloned website"""
-        zip_name = f"{unique_name}_cloned.zip"
-        zip_path = os.path.join(base_output_dir, zip_name)
+        zip_name = f"{unique_name}{ZipOutput.suffix}"
+        zip_path = os.path.join(os.path.dirname(source_dir), zip_name)
+        part_path = zip_path + ZipOutput.part_suffix
         
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        # The archive is the clone's biggest write: charged and throttled like the rest
+        with open_charged(part_path, self.disk) as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for root, dirs, files in os.walk(source_dir):
                 for file in files:
                     file_path = os.path.join(root, file)
                     arc_name = os.path.relpath(file_path, source_dir)
-                    zipf.write(file_path, arc_name)
+                    zipf.write(file_path, arc_name, compress_type=zip_compress_type(arc_name))
+        # Renamed over the old archive, which a preview may still have memory-mapped
+        os.replace(part_path, zip_path)
         
         return zip_path
     
@@ -173,6 +3970,11 @@ class WebClonerCore:
         
         for tag in img_tags:
             try:
+                kind = self._image_tag_kind(tag)
+                for attr in ('srcset', 'data-srcset'):
+                    if tag.get(attr):
+                        self._rewrite_srcset_attr(tag, attr, base_url, assets_dir, kind)
+                
                 img_url = None
                 if tag.get('src'):
                     img_url = tag['src']
@@ -182,12 +3984,7 @@ class WebClonerCore:
                     img_url = tag['data-lazy-src']
                 
                 if img_url:
-                    if tag.get('srcset'):
-                        srcset_urls = self.parse_srcset(tag['srcset'])
-                        for srcset_url in srcset_urls:
-                            self.download_resource(srcset_url, base_url, assets_dir)
-                    
-                    local_path = self.download_resource(img_url, base_url, assets_dir)
+                    local_path = self.download_resource(img_url, base_url, assets_dir, kind)
                     if local_path:
                         tag['src'] = local_path
                         for attr in ['data-src', 'data-lazy-src', 'loading']:
@@ -199,43 +3996,105 @@ class WebClonerCore:
         
         self.process_css_background_images(soup, base_url, assets_dir)
     
-    def parse_srcset(self, srcset):
-        """Parse srcset attribute to extract URLs"""
-        urls = []
+    @staticmethod
+    def _image_tag_kind(tag):
+        if tag.name == 'source' and tag.parent is not None and tag.parent.name in ('video', 'audio'):
+            return 'media'
+        return 'image'
+    
+    def collect_resource_urls(self, soup):
+        """(url, asset type, below the fold) for each asset the process_* passes will
+        ask for, in document order"""
+        resources = []
+        for tag in soup.find_all(['img', 'source']):
+            kind = self._image_tag_kind(tag)
+            # Lazy-loaded images are the ones a browser leaves for later too
+            lazy = (tag.get('loading') == 'lazy'
+                    or any(tag.get(attr) for attr in ('data-src', 'data-lazy-src', 'data-srcset')))
+            for attr in ('srcset', 'data-srcset'):
+                if tag.get(attr):
+                    resources.extend((url, kind, lazy)
+                                     for url, _ in self.policy.choose_srcset(parse_srcset(tag[attr])))
+            img_url = tag.get('src') or tag.get('data-src') or tag.get('data-lazy-src')
+            if img_url:
+                resources.append((img_url, kind, lazy))
+        for tag in soup.find_all(attrs={'style': True}):
+            resources.extend((url, None, False) for url in CSS_URL_RE.findall(tag['style']))
+        for style_tag in soup.find_all('style'):
+            if style_tag.string:
+                resources.extend((url, None, False) for url in CSS_URL_RE.findall(style_tag.string))
+        for link in soup.find_all('link'):
+            rels = link.get('rel', [])
+            if self.policy.allows_rel(rels):
+                if link.get('href'):
+                    resources.append((link['href'], link_asset_type(rels, link.get('as')), False))
+                if link.get('imagesrcset'):
+                    resources.extend((url, 'image', False)
+                                     for url, _ in self.policy.choose_srcset(parse_srcset(link['imagesrcset'])))
+        resources.extend((script['src'], 'js', False) for script in soup.find_all('script', src=True))
+        return resources
+    
+    def prefetch_resources(self, resources, base_url, assets_dir):
+        """Download assets concurrently, render-critical ones first, so the
+        process_* passes find them already saved"""
+        pending = {}
+        for url, kind, lazy in resources:
+            if not url.startswith('data:'):
+                pending.setdefault(canonical_url(urljoin(base_url, url)), (url, kind, lazy))
+        
+        def rank(item):
+            index, (url, kind, lazy) = item
+            asset_type = kind or guess_asset_type(urljoin(base_url, url))
+            return (self.policy.priority('media' if lazy else asset_type), index)
+        ordered = [resource for _, resource in sorted(enumerate(pending.values()), key=rank)]
+        
+        # Over HTTP/2 these share one connection per origin
+        with ThreadPoolExecutor(max_workers=max(1, asset_fetch_concurrency)) as executor:
+            for _ in executor.map(lambda r: self.download_resource(r[0], base_url, assets_dir, r[1]), ordered):
+                pass
+    
+    def rewrite_srcset(self, srcset, base_url, assets_dir, kind='image'):
+        """Download the policy's choice of srcset candidates and return the attribute
+        pointing at the local copies only, or None when none could be saved"""
+        local_candidates = []
+        for url, descriptor in self.policy.choose_srcset(parse_srcset(srcset)):
+            local_path = self.download_resource(url, base_url, assets_dir, kind)
+            if local_path:
+                local_candidates.append((local_path, descriptor))
+        return serialize_srcset(local_candidates) if local_candidates else None
+    
+    def _rewrite_srcset_attr(self, tag, attr, base_url, assets_dir, kind='image'):
+        # Remote candidates are dropped, so previews never reach back to the origin
+        srcset = self.rewrite_srcset(tag[attr], base_url, assets_dir, kind)
         if srcset:
-            parts = srcset.split(',')
-            for part in parts:
-                url = part.strip().split()[0]
-                urls.append(url)
-        return urls
+            tag[attr] = srcset
+        else:
+            del tag[attr]
+    
+    def rewrite_css_urls(self, css_content, base_url, assets_dir):
+        """Download url() references in CSS text and point them at the local copies"""
+        for url in set(CSS_URL_RE.findall(css_content)):
+            local_path = self.download_resource(url, base_url, assets_dir)
+            if local_path:
+                css_content = css_content.replace(url, local_path)
+        return css_content
     
     def process_css_background_images(self, soup, base_url, assets_dir):
         """Process CSS background images"""
         for tag in soup.find_all(attrs={'style': True}):
-            style = tag['style']
-            urls = re.findall(r'url\(["\']?([^"\']+)["\']?\)', style)
-            for url in urls:
-                local_path = self.download_resource(url, base_url, assets_dir)
-                if local_path:
-                    tag['style'] = style.replace(url, local_path)
+            tag['style'] = self.rewrite_css_urls(tag['style'], base_url, assets_dir)
         
         for style_tag in soup.find_all('style'):
             if style_tag.string:
-                css_content = style_tag.string
-                urls = re.findall(r'url\(["\']?([^"\']+)["\']?\)', css_content)
-                for url in urls:
-                    local_path = self.download_resource(url, base_url, assets_dir)
-                    if local_path:
-                        css_content = css_content.replace(url, local_path)
-                style_tag.string = css_content
+                style_tag.string = self.rewrite_css_urls(style_tag.string, base_url, assets_dir)
     
     def process_css_files(self, soup, base_url, assets_dir):
         """Download and process CSS files"""
         css_links = soup.find_all('link', rel='stylesheet')
         for link in css_links:
             href = link.get('href')
-            if href:
-                local_path = self.download_resource(href, base_url, assets_dir)
+            if href and self.policy.allows_rel(link.get('rel', [])):
+                local_path = self.download_resource(href, base_url, assets_dir, 'css')
                 if local_path:
                     link['href'] = local_path
     
@@ -245,18 +4104,22 @@ class WebClonerCore:
         for script in js_scripts:
             src = script.get('src')
             if src:
-                local_path = self.download_resource(src, base_url, assets_dir)
+                local_path = self.download_resource(src, base_url, assets_dir, 'js')
                 if local_path:
                     script['src'] = local_path
     
     def process_fonts_and_resources(self, soup, base_url, assets_dir):
         """Process font files and other resources"""
         for link in soup.find_all('link'):
+            if link.get('imagesrcset') and self.policy.allows_rel(link.get('rel', [])):
+                self._rewrite_srcset_attr(link, 'imagesrcset', base_url, assets_dir)
             href = link.get('href')
             if href:
                 rel = link.get('rel', [])
-                if 'stylesheet' not in rel:
-                    local_path = self.download_resource(href, base_url, assets_dir)
+                # Hints like preconnect or canonical name no asset worth saving
+                if 'stylesheet' not in rel and self.policy.allows_rel(rel):
+                    local_path = self.download_resource(href, base_url, assets_dir,
+                                                        link_asset_type(rel, link.get('as')))
                     if local_path:
                         link['href'] = local_path
     
@@ -264,69 +4127,264 @@ class WebClonerCore:
         """Process internal page links with limits"""
         base_domain = urlparse(base_url).netloc
         internal_links = []
+        anchors = {}
         
         for link in soup.find_all('a', href=True):
             href = link['href']
-            full_url = urljoin(base_url, href)
+            full_url, fragment = urldefrag(urljoin(base_url, href))
             link_domain = urlparse(full_url).netloc
+            key = canonical_url(full_url)
             
-            if link_domain == base_domain and full_url not in self.visited_pages:
-                internal_links.append(full_url)
+            # Pages saved before an interruption are still linked, not fetched again
+            if link_domain == base_domain and (key not in self.visited_pages or key in self.page_paths):
+                if key not in anchors and key not in self.page_paths:
+                    internal_links.append(full_url)
+                anchors.setdefault(key, []).append((link, fragment))
+        
+        internal_links = self.plan_internal_pages(base_url, internal_links)
+        self.checkpoint_frontier(internal_links)
+        self.download_internal_pages(internal_links, output_dir)
+        for key, links in anchors.items():
+            rel_path = self.page_paths.get(key)
+            if rel_path:
+                for link, fragment in links:
+                    link['href'] = f"{rel_path}#{fragment}" if fragment else rel_path
+    
+    def plan_internal_pages(self, base_url, links):
+        """Choose and order the pages to fetch: the page's own links first, then
+        sitemap entries, within the domain's page budget and robots.txt rules"""
+        budget = self.scheduler.remaining(base_url)
+        if not budget:
+            return []
+        robots = None
+        if respect_robots:
+            robots = robots_cache.get(base_url, lambda robots_url: self._get_with_retry(robots_url, timeout=15))
+            host_limiter.set_crawl_delay(base_url, robots.crawl_delay(robots_user_agent))
         
-        # Limit to max_pages
-        for full_url in internal_links[:self.max_pages - len(self.visited_pages)]:
+        def allowed(url):
+            return canonical_url(url) not in self.visited_pages and (robots is None or robots.can_fetch(robots_user_agent, url))
+        
+        for url in links:
+            self.scheduler.add(url, 1.0)
+        if sitemap_discovery and sum(map(allowed, links)) < budget:
+            with self.metrics.stage('sitemaps'):
+                for url, priority in self.discover_sitemap_pages(base_url, robots, allowed, budget):
+                    self.scheduler.add(url, priority)
+        return self.scheduler.plan(allowed)
+    
+    def discover_sitemap_pages(self, base_url, robots, allowed, limit):
+        """The limit highest-priority same-domain pages listed in the site's sitemaps"""
+        parsed = urlparse(base_url)
+        sitemaps = (robots.site_maps() if robots else None) or [f"{parsed.scheme}://{parsed.netloc}/sitemap.xml"]
+        
+        def fetch(url):
+            self.scheduler.throttle(url)
+            return self._get_with_retry(url, timeout=30, stream=True)
+        
+        candidates = ((url, priority)
+                      for sitemap in sitemaps
+                      for url, priority in iter_sitemap(sitemap, fetch, sitemap_max_urls)
+                      if urlparse(url).netloc == parsed.netloc and allowed(url))
+        if self.scheduler.store is not None:
+            return candidates  # The spilled frontier orders them without holding them in memory
+        # Bounded heap: only the best `limit` entries are ever held, however large the sitemap
+        pages = heapq.nlargest(limit, candidates, key=lambda candidate: candidate[1])
+        if pages:
+            self.emit_status(f"Found {len(pages)} more pages in sitemaps", None)
+        return pages
+    
+    def download_internal_pages(self, urls, output_dir):
+        """Save internal pages, recording their paths relative to output_dir in page_paths"""
+        for full_url in urls:
+            if self.disk and (self.disk.trimming or self.disk.exhausted):
+                self.emit_status("Disk quota reached; skipping the remaining pages", None)
+                break
+            key = canonical_url(full_url)
+            if key in self.page_paths:
+                continue  # Saved already under another URL that declared this one canonical
             try:
                 self.emit_status(f"Downloading internal page: {full_url}", None)
-                response = self._get_with_retry(full_url, timeout=45)
+                self.scheduler.throttle(full_url)
+                response = self._get_with_retry(full_url, timeout=45, stream=self.low_memory)
                 if response and response.status_code == 200:
-                    self.visited_pages.add(full_url)
-                    path = urlparse(full_url).path
-                    if path.endswith('/') or not path:
-                        filename = 'index.html'
-                        local_dir = os.path.join(output_dir, path.strip('/'))
-                    else:
-                        filename = os.path.basename(path)
-                        if not filename.endswith('.html'):
-                            filename += '.html'
-                        local_dir = os.path.join(output_dir, os.path.dirname(path).strip('/'))
+                    self.visited_pages.add(key)
+                    rel_path = page_rel_path(full_url)
                     
-                    if local_dir != output_dir:
-                        os.makedirs(local_dir, exist_ok=True)
-                    
-                    file_path = os.path.join(local_dir, filename)
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(response.text)
+                    text = VisibleTextParser(search_text_max_chars) if self.index_pages else None
+                    if self.low_memory:
+                        head = bytearray()
+                        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                        
+                        def body():
+                            # Keep the start of the page to look for rel=canonical in
+                            for chunk in response.iter_content(chunk_size=stream_chunk_size):
+                                if len(head) < canonical_scan_chars:
+                                    head.extend(chunk[:canonical_scan_chars - len(head)])
+                                if text:
+                                    text.feed(decoder.decode(chunk))
+                                yield chunk
+                        try:
+                            size = self.output.save(rel_path, body(), full_url, response)
+                        finally:
+                            response.close()
+                        head = head.decode('utf-8', 'replace')
+                    else:
+                        head = response.text
+                        # Archives keep the bytes as served; the directory tree has always held UTF-8
+                        self.output.save(rel_path, response.content if self.output.records_responses
+                                         else head.encode('utf-8'), full_url, response)
+                        size = len(response.content)
+                        if text:
+                            text.feed(head)
+                    self.metrics.record_asset('html', size)
+                    if text:
+                        text.close()
+                        self.index_page(rel_path, full_url, *text.text.result())
                     
-                    rel_path = os.path.relpath(file_path, output_dir).replace('\\', '/')
-                    # Update link href to relative path (this is approximate, as it's for main page links)
-                    link['href'] = rel_path
+                    self.page_paths[key] = rel_path
+                    self.checkpoint({'t': 'page', 'u': key, 'p': rel_path})
+                    for alias in (response.url, find_canonical_link(head)):
+                        if alias:
+                            self.note_canonical(response.url, alias, rel_path)
                 else:
                     print(f"Failed to download internal page {full_url}")
             except Exception as e:
                 print(f"Error downloading internal page {full_url}: {e}")
     
+    def checkpoint_frontier(self, urls, chunk_size=1000):
+        """Journal the planned pages, a bounded number of URLs per record"""
+        if not self.journal:
+            return
+        urls = iter(urls)
+        kind = 'frontier'
+        for chunk in iter(lambda: list(itertools.islice(urls, chunk_size)), []):
+            self.checkpoint({'t': kind, 'u': chunk})
+            kind = 'frontier+'
+        if kind == 'frontier':
+            self.checkpoint({'t': kind, 'u': []})
+    
+    def index_page(self, rel_path, url, title, text):
+        """Add a saved page to the full-text search index"""
+        try:
+            search_index.add(self.clone_name, rel_path, url, title, text)
+        except Exception as e:
+            print(f"Error indexing {rel_path}: {e}")
+    
+    def note_canonical(self, page_url, href, rel_path=None):
+        """Treat a same-site canonical URL as the page itself: it is not fetched
+        again, and links to it point at rel_path when one is given"""
+        canonical = urljoin(page_url, href)
+        if urlparse(canonical).netloc != urlparse(page_url).netloc:
+            return
+        key = canonical_url(canonical)
+        self.visited_pages.add(key)
+        if rel_path and key not in self.page_paths:
+            self.page_paths[key] = rel_path
+            self.checkpoint({'t': 'page', 'u': key, 'p': rel_path})
+    
+    def _write_stream(self, response, path, url=None, max_bytes=None):
+        """Save a streamed response body chunk by chunk; None if it grows past
+        max_bytes, in which case nothing is kept"""
+        try:
+            return self.output.save(path, response.iter_content(chunk_size=stream_chunk_size),
+                                    url, response, max_bytes)
+        finally:
+            response.close()
+    
+    def _read_body(self, response, max_bytes=None):
+        """Response body, or None once it grows past max_bytes"""
+        if not max_bytes:
+            return response.content
+        body = bytearray()
+        try:
+            for chunk in response.iter_content(chunk_size=stream_chunk_size):
+                body += chunk
+                if len(body) > max_bytes:
+                    return None
+        finally:
+            response.close()
+        return bytes(body)
+    
+    def allow_resource(self, full_url, page_url, kind=None):
+        """Apply the resource policy to an asset URL before it is fetched"""
+        asset_type = kind or guess_asset_type(full_url)
+        if self.disk and (self.disk.exhausted or (self.disk.trimming and asset_type in QUOTA_TRIMMED_TYPES)):
+            return False
+        # An unknown type is checked again once the response says what it is
+        if asset_type != 'other' and not self.policy.allows_type(asset_type):
+            return False
+        host = (urlparse(full_url).hostname or '').lower()
+        if not self.policy.allows_host(host):
+            return False
+        if self.policy.max_third_party_hosts is not None and is_third_party(host, urlparse(page_url).hostname):
+            with self._resource_lock:
+                if host not in self.third_party_hosts:
+                    if len(self.third_party_hosts) >= self.policy.max_third_party_hosts:
+                        return False
+                    self.third_party_hosts.add(host)
+        return True
+    
+    def _skip_resource(self, full_url):
+        with self._resource_lock:
+            self.skipped_resources.add(full_url)
+        self.metrics.incr('skipped')
+        return None
+    
     @retry(max_retries=3, delay=1)
-    def download_resource(self, url, base_url, assets_dir):
-        """Download a resource and return local path"""
+    def download_resource(self, url, base_url, assets_dir, kind=None):
+        """Download a resource and return local path; kind is the asset type the
+        referencing markup implies, if any"""
         try:
             if url.startswith('data:'):
                 return self.save_data_uri(url, assets_dir)
             
-            full_url = urljoin(base_url, url)
+            full_url = urldefrag(urljoin(base_url, url))[0]
+            key = canonical_url(full_url)
             
-            if full_url in self.downloaded_resources:
-                return self.get_local_path(full_url, assets_dir)
+            if key in self.downloaded_resources:
+                self.metrics.incr('cache_hits')
+                return self.get_local_path(key, assets_dir)
+            if key in self.skipped_resources:
+                return None
+            if not self.allow_resource(full_url, base_url, kind):
+                return self._skip_resource(key)
             
-            response = self._get_with_retry(full_url, timeout=30)
-            if not response:
-                raise Exception("Download failed after retries")
-            response.raise_for_status()
+            cached = self.asset_cache.get(key) if self.asset_cache else None
+            if cached:
+                content, content_type = cached
+                asset_type = classify_content_type(content_type) if content_type else kind or 'other'
+                size_limit = self.policy.size_limit(asset_type)
+                if not self.policy.allows_type(asset_type) or (size_limit and len(content) > size_limit):
+                    return self._skip_resource(key)
+                self.metrics.incr('cache_hits')
+                response = None  # No original headers to archive
+            else:
+                # In low-memory mode the body goes straight from the socket to disk, and with
+                # a size limit it is only read once the headers say it fits
+                response = self._get_with_retry(full_url, timeout=30,
+                                                stream=self.low_memory or self.policy.max_bytes is not None)
+                if not response:
+                    raise Exception("Download failed after retries")
+                response.raise_for_status()
+                content_type = response.headers.get('content-type', '')
+                asset_type = classify_content_type(content_type) if content_type else kind or 'other'
+                size_limit = self.policy.size_limit(asset_type)
+                if (not self.policy.allows_type(asset_type)
+                        or (size_limit and int(response.headers.get('content-length') or 0) > size_limit)):
+                    response.close()
+                    return self._skip_resource(key)
+                content = None
+                if not self.low_memory:
+                    content = self._read_body(response, size_limit)
+                    if content is None:
+                        return self._skip_resource(key)
+                if self.asset_cache and content is not None:
+                    self.asset_cache.put(key, content, content_type)
             
             parsed_url = urlparse(full_url)
             filename = os.path.basename(parsed_url.path) or 'resource'
             
             if '.' not in filename:
-                content_type = response.headers.get('content-type', '')
                 if 'image' in content_type:
                     ext = mimetypes.guess_extension(content_type) or '.jpg'
                     filename += ext
@@ -335,39 +4393,46 @@ class WebClonerCore:
                 elif 'javascript' in content_type:
                     filename += '.js'
             
-            counter = 1
-            original_filename = filename
-            while os.path.exists(os.path.join(assets_dir, filename)):
-                name, ext = os.path.splitext(original_filename)
-                filename = f"{name}_{counter}{ext}"
-                counter += 1
-            
-            file_path = os.path.join(assets_dir, filename)
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
+            local_path = self.output.claim(f"assets/{filename}")
+            if content is None:
+                size = self._write_stream(response, local_path, full_url, size_limit)
+                if size is None:
+                    return self._skip_resource(key)
+            else:
+                self.output.save(local_path, content, full_url, response)
+                size = len(content)
+            self.metrics.record_asset(asset_type, size)
             
-            self.downloaded_resources.add(full_url)
-            return f"assets/{filename}"
+            with self._resource_lock:
+                self.resource_paths[key] = local_path
+                self.downloaded_resources.add(key)
+            self.checkpoint({'t': 'res', 'u': key, 'p': local_path})
+            return local_path
             
         except Exception as e:
             print(f"Error downloading resource {url}: {e}")
             return None
     
     def save_data_uri(self, data_uri, assets_dir):
-        """Save data URI as file"""
+        """Save a data URI as a file named after its content and return the local
+        path; small URIs are returned unchanged and stay inline"""
+        if len(data_uri) <= data_uri_inline_max_bytes:
+            return data_uri
+        memo_key = hashlib.sha256(data_uri.encode()).digest()
+        with self._resource_lock:
+            local_path = self.data_uri_paths.get(memo_key)
+        if local_path:
+            self.metrics.incr('cache_hits')
+            return local_path
         try:
-            header, data = data_uri.split(',', 1)
-            mime_type = header.split(';')[0].split(':')[1]
-            
+            mime_type, chunks = parse_data_uri(data_uri)
             ext = mimetypes.guess_extension(mime_type) or '.bin'
-            filename = f"data_uri_{len(self.downloaded_resources)}{ext}"
-            
-            file_data = base64.b64decode(data)
-            file_path = os.path.join(assets_dir, filename)
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            
-            return f"assets/{filename}"
+            local_path, size, created = self.output.save_by_digest('assets', ext, chunks, mime_type)
+            if created:
+                self.metrics.record_asset(classify_content_type(mime_type), size)
+            with self._resource_lock:
+                self.data_uri_paths[memo_key] = local_path
+            return local_path
             
         except Exception as e:
             print(f"Error saving data URI: {e}")
@@ -375,13 +4440,517 @@ class WebClonerCore:
     
     def get_local_path(self, url, assets_dir):
         """Get local path for already downloaded resource"""
+        if url in self.resource_paths:
+            return self.resource_paths[url]
         filename = os.path.basename(urlparse(url).path) or 'resource'
         return f"assets/{filename}"
 
+# Clone job queue
+def new_clone_job(url, clone_name=None, sid=None, namespace='/', policy=None, tenant=None):
+    """Build a clone job record"""
+    return {
+        'id': uuid.uuid4().hex,
+        'url': url,
+        'clone_name': clone_name,
+        'policy': policy,
+        'tenant': tenant,
+        'sid': sid,
+        'namespace': namespace,
+        'status': 'queued',
+        'submitted_at': time.time(),
+    }
+
+class LocalJobQueue:
+    """In-process job queue, used without Redis and as a stand-in for tests"""
+
+    def __init__(self, max_jobs=10000):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = Lock()
+        self.max_jobs = max_jobs
+
+    def add(self, job):
+        """Store a job record without scheduling it"""
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+            if len(self._jobs) > self.max_jobs:
+                self._prune()
+        return job
+
+    def _prune(self):
+        # Forget the oldest finished jobs; dicts keep insertion order
+        for job_id in [k for k, v in self._jobs.items() if v.get('status') in ('done', 'error')]:
+            if len(self._jobs) <= self.max_jobs:
+                break
+            del self._jobs[job_id]
+
+    def enqueue(self, job):
+        self.add(job)
+        self._queue.put(job['id'])
+        return job
+
+    def dequeue(self, timeout=None):
+        try:
+            job_id = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def ack(self, job_id):
+        """Jobs cannot outlive this process, so there is nothing to recover"""
+
+    def depth(self):
+        return self._queue.qsize()
+
+class RedisJobQueue:
+    """Redis-backed job queue shared by the web tier and worker processes.
+
+    A dequeued job moves atomically onto its process's processing list and
+    stays there until acknowledged, so a worker dying before its journal
+    exists loses nothing: once its heartbeat expires, any live worker moves
+    the list back onto the queue"""
+
+    def __init__(self, url, prefix='webcloner', job_ttl=7 * 24 * 3600, heartbeat_ttl=60):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.queue_key = f'{prefix}:jobs'
+        self.job_prefix = f'{prefix}:job:'
+        self.processing_prefix = f'{prefix}:processing:'
+        self.alive_prefix = f'{prefix}:alive:'
+        self.job_ttl = job_ttl
+        self.heartbeat_ttl = heartbeat_ttl
+        self._heartbeat_pid = None
+        self._heartbeat_lock = Lock()
+
+    @property
+    def worker_id(self):
+        # Per process; a forked worker gets its own
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _start_heartbeat(self):
+        with self._heartbeat_lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+            self.redis.set(self.alive_prefix + self.worker_id, 1, ex=self.heartbeat_ttl)
+            Thread(target=self._heartbeat, daemon=True).start()
+
+    def _heartbeat(self):
+        while True:
+            try:
+                self.redis.set(self.alive_prefix + self.worker_id, 1, ex=self.heartbeat_ttl)
+                self.requeue_orphans()
+            except Exception as e:
+                print(f"Error in job queue heartbeat: {e}")
+            time.sleep(self.heartbeat_ttl / 3)
+
+    def requeue_orphans(self):
+        """Put the unacknowledged jobs of workers whose heartbeat expired back on the queue"""
+        requeued = 0
+        for key in self.redis.scan_iter(match=self.processing_prefix + '*'):
+            worker_id = key.decode()[len(self.processing_prefix):]
+            if self.redis.exists(self.alive_prefix + worker_id):
+                continue
+            # One item at a time and atomically, so workers recovering the same list never duplicate a job
+            while self.redis.lmove(key, self.queue_key, 'LEFT', 'RIGHT'):
+                requeued += 1
+        if requeued:
+            print(f"Re-queued {requeued} job(s) from workers that stopped")
+        return requeued
+
+    def _store(self, pipe, job):
+        key = self.job_prefix + job['id']
+        pipe.hset(key, mapping={k: json.dumps(v) for k, v in job.items()})
+        pipe.expire(key, self.job_ttl)
+
+    def add(self, job):
+        """Store a job record without scheduling it"""
+        pipe = self.redis.pipeline()
+        self._store(pipe, job)
+        pipe.execute()
+        return job
+
+    def enqueue(self, job):
+        pipe = self.redis.pipeline()
+        self._store(pipe, job)
+        pipe.lpush(self.queue_key, job['id'])
+        pipe.execute()
+        return job
+
+    def dequeue(self, timeout=None):
+        """Next job; call ack(job['id']) once it has finished"""
+        self._start_heartbeat()
+        job_id = self.redis.blmove(self.queue_key, self.processing_prefix + self.worker_id,
+                                   int(timeout or 0), 'RIGHT', 'LEFT')
+        if not job_id:
+            return None
+        job = self.get(job_id.decode())
+        if not job:
+            self.ack(job_id.decode())  # Expired
+        return job
+
+    def ack(self, job_id):
+        """Drop a finished job from this worker's processing list"""
+        self.redis.lrem(self.processing_prefix + self.worker_id, 1, job_id)
+
+    def get(self, job_id):
+        fields = self.redis.hgetall(self.job_prefix + job_id)
+        if not fields:
+            return None
+        return {k.decode(): json.loads(v) for k, v in fields.items()}
+
+    def update(self, job_id, **fields):
+        self.redis.hset(self.job_prefix + job_id, mapping={k: json.dumps(v) for k, v in fields.items()})
+
+    def depth(self):
+        return self.redis.llen(self.queue_key)
+
+job_queue = RedisJobQueue(redis_url) if redis_url else LocalJobQueue()
+
+def run_clone_job(job, jobs, emitter, session=None, asset_cache=None):
+    """Run one clone job, publish progress to its client and record the outcome"""
+    sid, namespace = job.get('sid'), job.get('namespace') or '/'
+    clone_name = job.get('clone_name')
+    if not clone_name:
+        # Named up front so the journal, and a resumed run, use the same directory
+        domain = urlparse(job['url']).netloc.replace(':', '_')
+        clone_name = f"{domain}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        if job.get('batch_id'):
+            # Batch jobs for one host can start within the same second
+            clone_name += f"_{job['id'][:6]}"
+
+    journal = CloneJournal.for_clone(clone_name)
+    if not journal.open():
+        print(f"Clone {clone_name} is already running in another worker; skipping job {job['id']}")
+        running_id = journal.read()['job_id']
+        error = 'Clone is already running'
+        if running_id != job['id']:
+            # Otherwise the record belongs to the run in progress, which will settle it
+            jobs.update(job['id'], status='error', finished_at=time.time(), error=error, duplicate_of=running_id)
+            if emitter and sid:
+                emitter.emit('clone_error', {'error': error}, room=sid, namespace=namespace)
+        return {'success': False, 'error': error}
+    if journal.read()['url'] != job['url']:
+        journal.reset({'t': 'start', 'job': job['id'], 'u': job['url'], 'policy': job.get('policy'),
+                       'tenant': job.get('tenant')})
+
+    jobs.update(job['id'], status='running', started_at=time.time(), clone_name=clone_name)
+    clones_active.inc()
+    try:
+        cloner = WebClonerCore(emitter, sid, namespace, session=session, asset_cache=asset_cache,
+                               journal=journal, policy=default_resource_policy.merged(job.get('policy')),
+                               tenant=job.get('tenant'))
+        with clone_duration.time():
+            result = cloner.clone_website(job['url'], base_output_dir, clone_name)
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    finally:
+        clones_active.dec()
+    # Only a crash leaves the journal behind
+    journal.discard()
+    clones_total.inc(1, ('success',) if result['success'] else ('error',))
+
+    if result['success']:
+        archive_filename = os.path.basename(result['archive_path'])
+        payload = {
+            'domain': result['domain'],
+            'download_url': f'/download/{archive_filename}',
+            'preview_url': f"/preview/{result['domain']}/",
+            'folder_path': result['output_dir'],
+            'trimmed': result.get('trimmed', False)
+        }
+        jobs.update(job['id'], status='done', finished_at=time.time(), result=payload)
+        if emitter and sid:
+            emitter.emit('clone_complete', payload, room=sid, namespace=namespace)
+    else:
+        jobs.update(job['id'], status='error', finished_at=time.time(), error=result['error'])
+        if emitter and sid:
+            emitter.emit('clone_error', {'error': result['error']}, room=sid, namespace=namespace)
+    return result
+
+def resume_interrupted_clones(jobs):
+    """Re-queue clones whose journal outlived the process that was running them"""
+    if not os.path.isdir(journal_dir):
+        return []
+    resumed = []
+    for filename in sorted(os.listdir(journal_dir)):
+        if not filename.endswith('.jsonl'):
+            continue
+        journal = CloneJournal(os.path.join(journal_dir, filename))
+        if not journal.open():
+            continue  # Still being written by a live worker
+        try:
+            state = journal.read()
+            job = jobs.get(state['job_id']) if state['job_id'] else None
+            if not state['url'] or (job and job.get('status') in ('done', 'error')):
+                journal.discard()
+                continue
+            if job and job.get('status') == 'queued':
+                continue  # Already re-queued
+            job = dict(job or new_clone_job(state['url'], policy=state['policy'], tenant=state['tenant']),
+                       id=state['job_id'] or uuid.uuid4().hex,
+                       clone_name=filename[:-len('.jsonl')], status='queued', resumed_at=time.time())
+            jobs.enqueue(job)
+            resumed.append(job)
+        except Exception as e:
+            print(f"Error resuming clone from {filename}: {e}")
+        finally:
+            journal.close()
+    if resumed:
+        print(f"Resuming {len(resumed)} interrupted clone(s)")
+    return resumed
+
+def run_batch_group(group, jobs, emitter):
+    """Run same-host batch jobs back to back on one connection pool and asset cache"""
+    session = WebClonerCore.create_session()
+    asset_cache = AssetCache()
+    try:
+        for job_id in group['job_ids']:
+            job = jobs.get(job_id)
+            if job and job.get('status') in ('queued', 'running'):
+                run_clone_job(job, jobs, emitter, session, asset_cache)
+    finally:
+        session.close()
+        jobs.update(group['id'], status='done', finished_at=time.time())
+        update_batch_status(jobs, group['batch_id'])
+
+def batch_status(batch_jobs):
+    """Status of a batch from the records of its jobs (None once expired)"""
+    statuses = {job['status'] if job else 'expired' for job in batch_jobs}
+    if statuses <= {'done', 'error', 'expired'}:
+        return 'done'
+    return 'queued' if statuses == {'queued'} else 'running'
+
+def update_batch_status(jobs, batch_id):
+    batch = jobs.get(batch_id)
+    if not batch or batch['status'] == 'done':
+        return
+    status = batch_status([jobs.get(job_id) for job_id in batch['job_ids']])
+    if status != batch['status']:
+        jobs.update(batch_id, status=status, **({'finished_at': time.time()} if status == 'done' else {}))
+
+def worker_loop(jobs, emitter, stop_event=None, poll_timeout=5):
+    """Consume clone jobs until stop_event is set"""
+    while stop_event is None or not stop_event.is_set():
+        try:
+            job = jobs.dequeue(timeout=poll_timeout)
+        except Exception as e:
+            print(f"Error reading job queue: {e}")
+            time.sleep(poll_timeout)
+            continue
+        if not job:
+            continue
+        try:
+            # 'running' jobs come back from workers that stopped (requeue_orphans); if the
+            # same clone is in fact still running, its journal lock turns the copy away
+            if job.get('status') not in ('queued', 'running'):
+                pass  # Queued twice, e.g. recovered from a stopped worker and resumed from its journal
+            elif job.get('kind') == 'batch_group':
+                run_batch_group(job, jobs, emitter)
+            else:
+                run_clone_job(job, jobs, emitter)
+        finally:
+            jobs.ack(job['id'])
+
+_local_workers = []
+_local_workers_lock = Lock()
+
+def start_local_workers():
+    """Start the in-process clone workers once (lazily, so it is safe after fork)"""
+    with _local_workers_lock:
+        _local_workers[:] = [t for t in _local_workers if t.is_alive()]
+        for _ in range(clone_workers - len(_local_workers)):
+            thread = Thread(target=worker_loop, args=(job_queue, socketio), daemon=True)
+            thread.start()
+            _local_workers.append(thread)
+
+def normalize_clone_url(url):
+    if not url.startswith(('http://', 'https://')):
+        url = 'https://' + url
+    return url
+
+def validate_policy(policy):
+    """Raise ValueError unless policy is a usable resource policy override"""
+    default_resource_policy.merged(policy)
+    return policy or None
+
+def validate_clone_name(clone_name):
+    """Raise ValueError unless clone_name names a directory directly inside base_output_dir"""
+    if not clone_name:
+        return None
+    if (not isinstance(clone_name, str) or '/' in clone_name or '\\' in clone_name or '..' in clone_name
+            or '\0' in clone_name or is_reserved_name(clone_name)):
+        raise ValueError('Invalid clone name')
+    base = os.path.realpath(base_output_dir)
+    if os.path.dirname(os.path.realpath(os.path.join(base, clone_name))) != base:
+        raise ValueError('Invalid clone name')
+    return clone_name
+
+def request_tenant():
+    """Who a request counts against for disk quotas: the tenant header when a trusted
+    proxy set it, else the client address"""
+    tenant = request.headers.get(tenant_header) if request.remote_addr in tenant_trusted_proxies else None
+    return (tenant or request.remote_addr or 'anonymous')[:128]
+
+def check_tenant_quota(tenant):
+    if tenant_hard_quota_bytes and tenant and disk_usage_ledger.tenant_bytes(tenant) >= tenant_hard_quota_bytes:
+        raise ValueError(f"Disk quota of {tenant_hard_quota_bytes} bytes exceeded for this client")
+
+def submit_clone_job(url, clone_name=None, sid=None, namespace='/', policy=None, tenant=None):
+    """Queue a clone job for the local or remote workers"""
+    check_tenant_quota(tenant)
+    job = job_queue.enqueue(new_clone_job(normalize_clone_url(url), validate_clone_name(clone_name), sid,
+                                          namespace, validate_policy(policy), tenant))
+    start_local_workers()
+    return job
+
+# Same-host batch jobs are grouped so they share connections and cached assets,
+# in groups of at most this size so several workers can still share a big host
+batch_group_size = int(os.environ.get('BATCH_GROUP_SIZE', 25))
+max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+
+def submit_batch(entries, policy=None, tenant=None):
+    """Queue many clone jobs, grouped by host; returns the batch record.
+    policy applies to entries that bring none of their own"""
+    check_tenant_quota(tenant)
+    policies = [validate_policy(entry.get('policy') or policy) for entry in entries]
+    clone_names = [validate_clone_name(entry.get('clone_name')) for entry in entries]
+    batch = dict(new_clone_job(None), kind='batch', job_ids=[])
+    by_host = OrderedDict()
+    for entry, entry_policy, clone_name in zip(entries, policies, clone_names):
+        job = dict(new_clone_job(normalize_clone_url(entry['url']), clone_name,
+                                 policy=entry_policy, tenant=tenant),
+                   batch_id=batch['id'])
+        job_queue.add(job)
+        batch['job_ids'].append(job['id'])
+        by_host.setdefault(urlparse(job['url']).netloc.lower(), []).append(job['id'])
+
+    job_queue.add(batch)
+    for host_job_ids in by_host.values():
+        for i in range(0, len(host_job_ids), batch_group_size):
+            group = dict(new_clone_job(None), kind='batch_group', batch_id=batch['id'],
+                         job_ids=host_job_ids[i:i + batch_group_size])
+            job_queue.enqueue(group)
+    start_local_workers()
+    return batch
+
+def wait_for_job(job_id, timeout):
+    """Poll a job until it finishes or timeout seconds pass"""
+    deadline = time.time() + timeout
+    job = job_queue.get(job_id)
+    while job and job.get('status') not in ('done', 'error') and time.time() < deadline:
+        socketio.sleep(0.25)
+        job = job_queue.get(job_id)
+    return job
+
 # Flask routes
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', socketio_transports=socketio_transports)
+
+def _wait_seconds():
+    try:
+        return max(0.0, min(float(request.args.get('wait', 0)), 300.0))
+    except ValueError:
+        return 0.0
+
+def _job_view(job):
+    view = {k: v for k, v in job.items() if k not in ('sid', 'namespace')}
+    view['status_url'] = f"/api/jobs/{job['id']}"
+    return view
+
+@app.route('/api/clone', methods=['POST'])
+def api_clone():
+    """Submit one clone job; ?wait=<seconds> blocks until it finishes"""
+    try:
+        data = request.get_json(silent=True) or {}
+        url = data.get('url')
+        if not url:
+            return jsonify({'error': 'No URL provided'}), 400
+
+        job = submit_clone_job(url, data.get('clone_name'), policy=data.get('policy'), tenant=request_tenant())
+        wait = _wait_seconds()
+        if wait:
+            # None once a finished job has been pruned; report what was submitted
+            job = wait_for_job(job['id'], wait) or job
+            if job.get('status') in ('done', 'error'):
+                return jsonify(_job_view(job))
+        return jsonify(_job_view(job)), 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/clone/batch', methods=['POST'])
+def api_clone_batch():
+    """Submit many clone jobs as {"urls": [...]} or {"jobs": [{"url", "clone_name", "policy"}]};
+    a top-level "policy" applies to jobs without one"""
+    try:
+        data = request.get_json(silent=True) or {}
+        entries = [{'url': url} for url in data.get('urls', [])] + list(data.get('jobs', []))
+        if not entries or any(not isinstance(e, dict) or not e.get('url') for e in entries):
+            return jsonify({'error': 'Provide a non-empty list of urls or jobs with a url'}), 400
+        if len(entries) > max_batch_size:
+            return jsonify({'error': f'Batches are limited to {max_batch_size} jobs'}), 400
+
+        batch = submit_batch(entries, data.get('policy'), request_tenant())
+        return jsonify({'batch_id': batch['id'], 'job_ids': batch['job_ids'],
+                        'status_url': f"/api/batches/{batch['id']}"}), 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>')
+def api_job_status(job_id):
+    """Status and result of a clone job; ?wait=<seconds> blocks until it finishes"""
+    job = wait_for_job(job_id, _wait_seconds())
+    if not job or job.get('kind'):
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_view(job))
+
+@app.route('/api/jobs/<job_id>/download')
+def api_job_download(job_id):
+    """Download the ZIP produced by a finished clone job"""
+    job = job_queue.get(job_id)
+    if not job or job.get('kind'):
+        return jsonify({'error': 'Job not found'}), 404
+    if job.get('status') != 'done':
+        return jsonify({'error': f"Job is {job.get('status')}"}), 409
+    return download_file(os.path.basename(job['result']['download_url']))
+
+@app.route('/api/batches/<batch_id>')
+def api_batch_status(batch_id):
+    """Per-job status of a batch plus counts by status"""
+    batch = job_queue.get(batch_id)
+    if not batch or batch.get('kind') != 'batch':
+        return jsonify({'error': 'Batch not found'}), 404
+
+    jobs = [job_queue.get(job_id) for job_id in batch['job_ids']]
+    status = batch_status(jobs)
+    if status != batch['status']:
+        job_queue.update(batch_id, status=status, **({'finished_at': time.time()} if status == 'done' else {}))
+    counts = {}
+    for job in jobs:
+        job_status = job['status'] if job else 'expired'
+        counts[job_status] = counts.get(job_status, 0) + 1
+    return jsonify({
+        'batch_id': batch_id,
+        'status': status,
+        'counts': counts,
+        'finished': all(not job or job['status'] in ('done', 'error') for job in jobs),
+        'jobs': [_job_view(job) for job in jobs if job],
+    })
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
@@ -389,6 +4958,10 @@ def download_file(filename):
     try:
         if '..' in filename or filename.startswith('/'):
             return jsonify({'error': 'Invalid filename'}), 400
+        # Sidecars (search index, journals, manifests...) share the directory but are private
+        if (any(is_reserved_name(part) for part in filename.replace('\\', '/').split('/'))
+                or filename.endswith((CloneManifest.suffix, ZipOutput.part_suffix))):
+            return jsonify({'error': 'File not found'}), 404
             
         file_path = os.path.join(base_output_dir, filename)
         if os.path.exists(file_path) and os.path.commonpath([file_path, base_output_dir]) == base_output_dir:
@@ -398,6 +4971,16 @@ def download_file(filename):
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Process-wide metrics in the Prometheus text format"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/metrics/clones')
+def get_clone_metrics():
+    """Structured metrics of the most recent clones"""
+    return jsonify({'clones': list(recent_clone_metrics)})
+
 @app.route('/api/get_cloned_websites')
 def get_cloned_websites():
     """Get list of cloned websites"""
@@ -413,6 +4996,14 @@ def get_cloned_websites():
                         'path': item_path,
                         'has_preview': True  # Previews are always available via Flask
                     })
+            elif not is_reserved_name(item):
+                for kind, suffix in (('warc', WarcOutput.suffix), ('zip', ZipOutput.suffix)):
+                    domain = item[:-len(suffix)]
+                    if not item.endswith(suffix) or os.path.isdir(os.path.join(base_output_dir, domain)):
+                        continue
+                    archive = open_clone_archive(domain)
+                    if archive and archive.exists('index.html'):
+                        websites.append({'domain': domain, 'path': item_path, 'format': kind, 'has_preview': True})
         
         websites.sort(key=lambda x: os.path.getctime(x['path']), reverse=True)
         
@@ -424,16 +5015,17 @@ def get_cloned_websites():
 def preview_website(domain):
     """Get preview URL for a cloned website"""
     try:
-        if '..' in domain or '/' in domain:
+        if '..' in domain or '/' in domain or is_reserved_name(domain):
             return jsonify({'error': 'Invalid domain'}), 400
             
         website_path = os.path.join(base_output_dir, domain)
+        archive = None if os.path.exists(website_path) else open_clone_archive(domain)
         
-        if not os.path.exists(website_path):
+        if not os.path.exists(website_path) and not archive:
             return jsonify({'error': 'Website not found'}), 404
         
         index_path = os.path.join(website_path, 'index.html')
-        if not os.path.exists(index_path):
+        if not (archive.exists('index.html') if archive else os.path.exists(index_path)):
             return jsonify({'error': 'No index.html found'}), 404
         
         preview_url = f"/preview/{domain}/"
@@ -455,55 +5047,140 @@ def preview_file(domain, path):
     return serve_cloned_file(domain, path)
 
 def serve_cloned_file(domain, path):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = _serve_cloned_file(domain, path)
+        status = response.status_code
+        return response
+    except HTTPException as e:
+        status = e.code
+        raise
+    finally:
+        preview_request_duration.observe(time.perf_counter() - start)
+        preview_requests_total.inc(1, (str(status),))
+
+def _serve_cloned_file(domain, path):
     directory = os.path.join(base_output_dir, domain)
-    if '..' in domain or '..' in path:
-        abort(404)
-    if not os.path.exists(directory):
+    if '..' in domain or '..' in path or is_reserved_name(domain):
         abort(404)
+    archive = None
+    if os.path.exists(directory):
+        def exists(candidate):
+            return os.path.isfile(os.path.join(directory, candidate))
+    else:
+        # Archive-format clones are served from their records, with no tree on disk
+        archive = open_clone_archive(domain)
+        if archive is None:
+            abort(404)
+        exists = archive.exists
 
     if not path:
         path = 'index.html'
     elif path.endswith('/'):
         path += 'index.html'
 
-    full_path = os.path.join(directory, path)
-    if not os.path.exists(full_path) and '.' not in os.path.basename(path):
+    if not exists(path) and '.' not in os.path.basename(path):
         html_path = path + '.html'
-        if os.path.exists(os.path.join(directory, html_path)):
+        if exists(html_path):
             path = html_path
         else:
-            index_path = os.path.join(path, 'index.html')
-            if os.path.exists(os.path.join(directory, index_path)):
+            index_path = path + '/index.html'
+            if exists(index_path):
                 path = index_path
 
-    if not os.path.exists(os.path.join(directory, path)) or not os.path.isfile(os.path.join(directory, path)):
+    if not exists(path):
         abort(404)
 
-    response = send_from_directory(directory, path)
+    # WebP variants written by the image optimizer go to browsers that accept them
+    webp_variant = path + '.webp'
+    negotiated = exists(webp_variant)
+    if negotiated and 'image/webp' in request.headers.get('Accept', ''):
+        path = webp_variant
+
+    response = archive.response(path) if archive else send_from_directory(directory, path)
+    if negotiated:
+        response.headers['Vary'] = 'Accept'
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     response.headers['Access-Control-Allow-Origin'] = '*'
     return response
 
+@app.route('/api/diff/<old>/<new>')
+def diff_websites(old, new):
+    """Compare two clones of a site: files added, removed and changed, with
+    optional text diffs of changed pages (?text=1)"""
+    try:
+        for domain in (old, new):
+            if '..' in domain or '/' in domain or is_reserved_name(domain):
+                return jsonify({'error': 'Invalid domain'}), 400
+        manifests = [load_clone_manifest(old), load_clone_manifest(new)]
+        if None in manifests:
+            return jsonify({'error': 'Website not found'}), 404
+        
+        diff = diff_clone_manifests(*manifests)
+        summary = {key: len(diff[key]) for key in ('added', 'removed', 'changed')}
+        summary['unchanged'] = diff.pop('unchanged')
+        diff.update({'old': old, 'new': new, 'summary': summary})
+        if request.args.get('text') == '1':
+            max_lines = min(request.args.get('max_lines', diff_text_max_lines, type=int), diff_text_max_lines)
+            # Only the changed pages are read; everything else is settled by the manifests
+            for item in [item for item in diff['changed'] if item['kind'] == 'page'][:diff_text_max_pages]:
+                item['diff'], item['truncated'] = clone_text_diff(old, new, item['path'], max_lines)
+        
+        return jsonify(diff)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/search')
+def search_websites():
+    """Full-text search over cloned pages: ?q=words[&domain=clone][&page=1&per_page=20]"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        if not search_index.enabled:
+            return jsonify({'error': 'Search index is disabled'}), 503
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        
+        found = search_index.search(query, per_page, (page - 1) * per_page, request.args.get('domain'))
+        if found is None:
+            return jsonify({'error': 'Search index is disabled'}), 503
+        total, results = found
+        for result in results:
+            result['preview_url'] = f"/preview/{result['domain']}/{result['path']}"
+        
+        return jsonify({'query': query, 'page': page, 'per_page': per_page, 'total': total, 'results': results})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/usage')
+def get_disk_usage():
+    """Disk used by the requesting client's clones, and its quotas"""
+    try:
+        tenant = request_tenant()
+        return jsonify({'tenant': tenant, 'bytes': disk_usage_ledger.tenant_bytes(tenant),
+                        'soft_quota': tenant_soft_quota_bytes or None, 'hard_quota': tenant_hard_quota_bytes or None,
+                        'clone_soft_quota': clone_soft_quota_bytes or None,
+                        'clone_hard_quota': clone_hard_quota_bytes or None})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/delete_website/<domain>', methods=['DELETE'])
 def delete_website(domain):
     """Delete a specific cloned website"""
     try:
-        if '..' in domain or '/' in domain:
+        if '..' in domain or '/' in domain or is_reserved_name(domain):
             return jsonify({'error': 'Invalid domain'}), 400
             
-        website_path = os.path.join(base_output_dir, domain)
-        zip_path = os.path.join(base_output_dir, f"{domain}_cloned.zip")
+        deleted = trash_clone_files(base_output_dir, domain)
         
-        deleted = False
-        if os.path.exists(website_path):
-            shutil.rmtree(website_path)
-            deleted = True
-        
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-            deleted = True
+        # Don't let a half-finished clone come back on the next restart
+        CloneJournal.for_clone(domain).discard()
+        search_index.remove_clone(domain)
+        disk_usage_ledger.remove(domain)
         
         if deleted:
             return jsonify({'success': True, 'message': f'Website {domain} deleted'})
@@ -522,22 +5199,27 @@ def cleanup_old_files():
         max_age_hours = 24
         
         for item in os.listdir(base_output_dir):
+            if is_reserved_name(item):
+                continue
             item_path = os.path.join(base_output_dir, item)
-            if os.path.isfile(item_path):
-                file_age = current_time - os.path.getctime(item_path)
-                if file_age > (max_age_hours * 3600):
-                    try:
-                        os.remove(item_path)
-                        cleanup_count += 1
-                    except:
-                        pass
-            elif os.path.isdir(item_path):
-                dir_age = current_time - os.path.getctime(item_path)
-                if dir_age > (max_age_hours * 3600):
+            item_age = current_time - os.path.getctime(item_path)
+            if item_age > (max_age_hours * 3600):
+                try:
+                    trash_reaper.move_to_trash(item_path)
+                    CloneJournal.for_clone(item).discard()
+                    search_index.remove_clone(clone_name_of(item))
+                    disk_usage_ledger.remove(clone_name_of(item))
+                    cleanup_count += 1
+                except:
+                    pass
+        
+        # Optimized images no clone has used for as long
+        if os.path.isdir(image_cache_dir):
+            for entry in os.scandir(image_cache_dir):
+                if current_time - entry.stat().st_mtime > max_age_hours * 3600:
                     try:
-                        shutil.rmtree(item_path)
-                        cleanup_count += 1
-                    except:
+                        os.remove(entry.path)
+                    except OSError:
                         pass
         
         return jsonify({'success': True, 'cleaned': cleanup_count})
@@ -559,32 +5241,19 @@ def handle_clone_request(data):
     sid = request.sid
     namespace = request.namespace
     
-    def clone_task():
-        url = data.get('url')
-        clone_name = data.get('clone_name', None)  # User-provided clone name
-        if not url:
-            socketio.emit('clone_error', {'error': 'No URL provided'}, room=sid, namespace=namespace)
-            return
-        
-        if not url.startswith(('http://', 'https://')):
-            url = 'https://' + url
-        
-        cloner = WebClonerCore(socketio, sid, namespace)
-        result = cloner.clone_website(url, base_output_dir, clone_name)
-        
-        if result['success']:
-            zip_filename = os.path.basename(result['zip_path'])
-            socketio.emit('clone_complete', {
-                'domain': result['domain'],
-                'download_url': f'/download/{zip_filename}',
-                'folder_path': result['output_dir']
-            }, room=sid, namespace=namespace)
-        else:
-            socketio.emit('clone_error', {'error': result['error']}, room=sid, namespace=namespace)
+    url = data.get('url')
+    clone_name = data.get('clone_name', None)  # User-provided clone name
+    if not url:
+        socketio.emit('clone_error', {'error': 'No URL provided'}, room=sid, namespace=namespace)
+        return
     
-    thread = Thread(target=clone_task)
-    thread.daemon = True
-    thread.start()
+    try:
+        job = submit_clone_job(url, clone_name, sid, namespace, data.get('policy'), request_tenant())
+    except ValueError as e:
+        socketio.emit('clone_error', {'error': str(e)}, room=sid, namespace=namespace)
+        return
+    socketio.emit('status_update', {'message': 'Clone queued...', 'progress': 0, 'job_id': job['id']},
+                  room=sid, namespace=namespace)
 
 # Create templates directory and files
 def create_templates():
@@ -1284,7 +5953,7 @@ def create_templates():
     </div>
 
     <script>
-        const socket = io();
+        const socket = io({transports: {{ socketio_transports|tojson }}});
         const form = document.getElementById('cloneForm');
         const urlInput = document.getElementById('url');
         const cloneNameInput = document.getElementById('cloneName');
@@ -1511,8 +6180,17 @@ def create_templates():
 </body>
 </html>'''
     
-    with open(os.path.join(templates_dir, 'index.html'), 'w', encoding='utf-8') as f:
+    # Rewriting an unchanged file would only bump its mtime and make Jinja reload it
+    template_path = os.path.join(templates_dir, 'index.html')
+    try:
+        with open(template_path, encoding='utf-8') as f:
+            if f.read() == html_content:
+                return
+    except OSError:
+        pass
+    with open(template_path + '.tmp', 'w', encoding='utf-8') as f:
         f.write(html_content)
+    os.replace(template_path + '.tmp', template_path)
 
 if __name__ == '__main__':
     create_templates()
@@ -1534,6 +6212,10 @@ if __name__ == '__main__':
     print("📁 Download Location:", base_output_dir)
     print()
     print("🔧 Keep this terminal open to run the server")
+    print("🏭 Production: gunicorn -c gunicorn.conf.py cloner:app")
     print("=" * 60)
     
+    trash_reaper.start()
+    if clone_workers and resume_interrupted_clones(job_queue):
+        start_local_workers()
     socketio.run(app, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""Production server settings.
+
+Runs one gevent worker per core, each serving Socket.IO over WebSocket.
+Progress events emitted by one worker reach clients connected to another
+through the REDIS_URL message queue, which is required with more than one
+worker. The app is loaded once in the master and forked, so workers start
+fast and share its memory.
+
+Threads are gevent-patched here, which Playwright's sync API does not
+support, so headless rendering (RENDER_JS) is skipped for clones run in
+these workers. To render, set CLONE_WORKERS=0 and run clones in worker.py.
+
+Usage:
+    REDIS_URL=redis://localhost:6379/0 gunicorn -c gunicorn.conf.py cloner:app
+"""
+import multiprocessing
+import os
+
+# Patch before the app is preloaded, so the libraries it imports (ssl, requests)
+# are patched too rather than behind the worker's back after the fork
+from gevent import monkey
+monkey.patch_all()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() if os.environ.get('REDIS_URL') else 1))
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+preload_app = True
+
+if workers > 1:
+    if not os.environ.get('REDIS_URL'):
+        raise RuntimeError('REDIS_URL must be set to run more than one worker, '
+                           'so Socket.IO events and clone jobs are shared between them')
+    # gunicorn has no sticky sessions, so long-polling requests could land on the wrong worker
+    os.environ.setdefault('SOCKETIO_TRANSPORTS', 'websocket')
+
+resumed = []
+
+
+def when_ready(server):
+    """Runs once in the master, before the workers are forked"""
+    import cloner
+    cloner.create_templates()
+    global resumed
+    if cloner.clone_workers:
+        resumed = cloner.resume_interrupted_clones(cloner.job_queue)
+        if cloner.render_js:
+            print("RENDER_JS is ignored for clones run in gevent workers; set CLONE_WORKERS=0 and use worker.py")
+
+
+def post_fork(server, worker):
+    # Threads do not survive the fork; each worker starts its own
+    import cloner
+    cloner.trash_reaper.start()
+    if resumed:
+        cloner.start_local_workers()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# cloner reads its configuration at import: every test run gets fresh directories
+os.environ['CLONES_DIR'] = tempfile.mkdtemp(prefix='cloner-tests-')
+os.environ.pop('REDIS_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
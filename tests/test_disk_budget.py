@@ -0,0 +1,28 @@
+import os
+
+import cloner
+
+
+def directory_output(tmp_path, name):
+    output = cloner.DirectoryOutput(str(tmp_path), name)
+    output.disk = cloner.CloneDiskBudget(name)
+    return output
+
+
+def test_oversized_body_is_not_charged(tmp_path):
+    output = directory_output(tmp_path, 'oversized')
+    assert output.save('assets/big.bin', [b'x' * 100] * 5, max_bytes=250) is None
+    assert not output.exists('assets/big.bin')
+    assert output.disk.used == 0
+    assert output.save('assets/small.bin', [b'x' * 100], max_bytes=250) == 100
+    assert output.disk.used == 100
+
+
+def test_duplicate_by_digest_is_not_charged(tmp_path):
+    output = directory_output(tmp_path, 'duplicate')
+    path, size, created = output.save_by_digest('assets', '.bin', [b'payload'])
+    assert created and output.disk.used == size
+    again, _, created = output.save_by_digest('assets', '.bin', [b'pay', b'load'])
+    assert again == path and not created
+    assert output.disk.used == size
+    assert os.listdir(os.path.join(output.root, 'assets')) == [os.path.basename(path)]
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import cloner
+
+
+def touch(path, data=b'private'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def client():
+    return cloner.app.test_client()
+
+
+@pytest.mark.parametrize('filename', [
+    '.search.sqlite',
+    '.usage.sqlite',
+    '.journals/site.jsonl',
+    '.trash/site.0123/index.html',
+    'site.manifest',
+    'site_cloned.zip.part',
+    'site/.hidden',
+])
+def test_sidecar_files_are_not_downloadable(client, filename):
+    touch(os.path.join(cloner.base_output_dir, filename))
+    assert client.get(f'/download/{filename}').status_code == 404
+
+
+def test_clone_archive_is_downloadable(client):
+    touch(os.path.join(cloner.base_output_dir, 'site_cloned.zip'), b'PK')
+    response = client.get('/download/site_cloned.zip')
+    assert response.status_code == 200
+    assert response.data == b'PK'
+
+
+def test_usage_ledger_is_outside_served_directory():
+    base = os.path.realpath(cloner.base_output_dir)
+    ledger = os.path.realpath(cloner.disk_usage_ledger.path)
+    assert os.path.commonpath([base, ledger]) != base
@@ -0,0 +1,60 @@
+import os
+import time
+from threading import Event, Thread
+
+import pytest
+
+import benchmark
+import cloner
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+class NamedRedisJobQueue(cloner.RedisJobQueue):
+    """RedisJobQueue on a fake server, standing in for a worker on another node"""
+
+    def __init__(self, server, worker_id):
+        super().__init__('redis://localhost')
+        self.redis = fakeredis.FakeRedis(server=server)
+        self._worker_id = worker_id
+
+    @property
+    def worker_id(self):
+        return self._worker_id
+
+
+def wait_for(predicate, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_job_of_dead_worker_is_finished_by_another():
+    server = fakeredis.FakeServer()
+    dead = NamedRedisJobQueue(server, 'dead-node:1')
+    dead._heartbeat_pid = os.getpid()  # Its heartbeat never runs: the node is gone
+    live = NamedRedisJobQueue(server, 'live-node:1')
+
+    site = benchmark.FixtureSite(benchmark.SiteShape(pages=2, assets_per_page=2))
+    with benchmark.FixtureServer(site) as srv:
+        job = dead.enqueue(cloner.new_clone_job(srv.url, clone_name='orphaned'))
+        assert dead.dequeue(timeout=1)['id'] == job['id']
+        # The dead worker had started the clone when it stopped
+        dead.update(job['id'], status='running', started_at=time.time())
+
+        assert live.requeue_orphans() == 1
+        stop = Event()
+        worker = Thread(target=cloner.worker_loop, args=(live, None, stop, 1), daemon=True)
+        worker.start()
+        try:
+            assert wait_for(lambda: live.get(job['id'])['status'] in ('done', 'error'))
+        finally:
+            stop.set()
+            worker.join(10)
+
+    assert live.get(job['id'])['status'] == 'done'
+    assert live.redis.llen(live.processing_prefix + 'dead-node:1') == 0
+    assert live.redis.llen(live.processing_prefix + 'live-node:1') == 0
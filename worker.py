@@ -0,0 +1,49 @@
+"""Standalone clone worker.
+
+Consumes clone jobs from the Redis job queue and publishes progress to the
+web tier over the Socket.IO message queue. Run as many workers, on as many
+nodes, as needed; they must share CLONES_DIR and USAGE_LEDGER_PATH with
+the web tier.
+
+Usage:
+    REDIS_URL=redis://localhost:6379/0 python worker.py --threads 4
+"""
+import argparse
+import signal
+from threading import Thread, Event
+
+from flask_socketio import SocketIO
+
+import cloner
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Web Cloner Pro clone worker')
+    parser.add_argument('--threads', type=int, default=2, help='Concurrent clone jobs in this process')
+    args = parser.parse_args()
+
+    if not cloner.redis_url:
+        parser.error('REDIS_URL must be set so jobs and progress can be shared with the web tier')
+
+    # Write-only emitter: progress events are relayed by the web tier's message queue listener
+    emitter = SocketIO(message_queue=cloner.redis_url, async_mode='threading')
+    stop_event = Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    cloner.resume_interrupted_clones(cloner.job_queue)
+    threads = [Thread(target=cloner.worker_loop, args=(cloner.job_queue, emitter, stop_event), daemon=True)
+               for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+
+    print(f"Clone worker started with {args.threads} thread(s), clones in {cloner.base_output_dir}")
+    while not stop_event.is_set():
+        stop_event.wait(1)
+    print("Stopping after current jobs...")
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()